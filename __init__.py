@@ -0,0 +1,604 @@
+bl_info = {
+    "name":         "Blender Export Suite",
+    "author":       "Brandon Surmanski",
+    "blender":      (2,7,3),
+    "version":      (0,1,0),
+    "location":     "File > Import-Export",
+    "description":  "Export custom SCN, MDL, MSH, PHY, POS, VAT and SEQ formats",
+    "category":     "Import-Export"
+}
+
+"""
+Addon entry point for the export suite.
+
+Only the operators are defined here. The exporter modules (io_export_*) are
+imported the first time their operator runs, so registering the addon does not
+touch bpy.context or the scene, and works the same under --background.
+Import and registration times are printed to the console.
+
+Every exporter runs as a generator of small steps (see steps.py).
+With Background set, an operator advances it from a timer instead of all at
+once, so the interface stays responsive during large exports.
+"""
+
+import time
+_import_start = time.perf_counter()
+
+import bpy
+import importlib
+import os
+import sys
+
+# ExportHelper is a helper class, defines filename and
+# invoke() function which calls the file selector.
+from bpy_extras.io_utils import ExportHelper
+from bpy.props import StringProperty, BoolProperty, EnumProperty, FloatProperty, IntProperty
+from bpy.types import Operator
+
+if "_exporters" in locals(): # the addon was reloaded (F8), its modules are stale
+    _stale = [name for name in sys.modules if name.startswith(__name__ + ".")]
+else:
+    _stale = []
+_exporters = dict()
+
+EXPORT_TICK = 0.05 # seconds between two timer ticks of a background export
+EXPORT_TICK_BUDGET = 0.03 # seconds of exporting per tick
+
+def load_exporter(name):
+    """ imports (or reloads, after an addon reload) an exporter module on first use """
+    module = _exporters.get(name)
+    if module is None:
+        start = time.perf_counter()
+        if _stale: # the addon was reloaded, import every module afresh to pick up source changes
+            for stale in _stale:
+                sys.modules.pop(stale, None)
+                globals().pop(stale[len(__name__) + 1:], None) # or "from . import" finds the old one
+            del _stale[:]
+        module = importlib.import_module(__name__ + "." + name)
+        _exporters[name] = module
+        print("%s: loaded %s in %.2f ms" % (__name__, name, (time.perf_counter() - start) * 1000.0))
+    return module
+
+def write_file(filepath, data):
+    f = open(filepath, 'wb')
+    f.write(data)
+    f.close()
+
+def lod_property():
+    return IntProperty(
+            name="LOD Levels",
+            description="Number of automatically decimated levels of detail to store",
+            default=0,
+            min=0,
+            max=8,)
+
+def lod_ratio_property():
+    return FloatProperty(
+            name="LOD Ratio",
+            description="Fraction of the previous level's triangles kept by each LOD",
+            default=0.5,
+            min=0.01,
+            max=0.99,)
+
+def compression_property():
+    return EnumProperty(
+            name="Compression",
+            description="Compress large sections in independently decodable blocks",
+            items=(('NONE', "None", "Sections are stored as is"),
+                   ('ZLIB', "zlib", "Fast to decode"),
+                   ('LZMA', "LZMA", "Smaller, slower to decode")),
+            default='NONE',)
+
+def mesh_codec_property():
+    return BoolProperty(
+            name="Delta Encode",
+            description="Store indices as varint deltas and vertices as byte transposed "
+                        "deltas, which compress much better",
+            default=False,)
+
+def lod_ratios(op):
+    return [op.lodRatio ** (i + 1) for i in range(op.lodLevels)]
+
+class SteppedExport(object):
+    """
+    mixin running the generator returned by the operator's export_steps. In the
+    background, it advances a little on every timer tick, showing progress on the
+    cursor; Esc cancels, and no file is written.
+    Objects are read over several ticks, edits made meanwhile may or may not be exported.
+    """
+    background = BoolProperty(
+            name="Background",
+            description="Export in small steps without blocking the interface (Esc cancels)",
+            default=False,)
+
+    updateManifest = BoolProperty(
+            name="Update Manifest",
+            description="Rewrite the index of every exported file in the directory once written",
+            default=False,)
+
+    _steps = None
+    _timer = None
+
+    def execute(self, context):
+        self._steps = self.export_steps(context)
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        if not self.background:
+            return self.advance(context, None)
+        self._timer = wm.event_timer_add(EXPORT_TICK, context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.stop(context)
+            self.report({'INFO'}, "Export cancelled")
+            return {'CANCELLED'}
+        if event.type == 'TIMER':
+            return self.advance(context, EXPORT_TICK_BUDGET)
+        return {'PASS_THROUGH'}
+
+    def advance(self, context, budget):
+        """ runs steps for about budget seconds (None runs them all), writes the file once done """
+        start = time.perf_counter()
+        try:
+            while budget is None or time.perf_counter() - start < budget:
+                context.window_manager.progress_update(int(next(self._steps) * 100))
+        except StopIteration as stop:
+            self.stop(context)
+            write_file(self.filepath, stop.value)
+            if self.updateManifest:
+                load_exporter("manifest").write_manifest(os.path.dirname(self.filepath))
+            return {'FINISHED'}
+        except Exception:
+            self.stop(context)
+            raise
+        return {'RUNNING_MODAL'}
+
+    def stop(self, context):
+        wm = context.window_manager
+        if self._timer:
+            wm.event_timer_remove(self._timer)
+            self._timer = None
+        wm.progress_end()
+        self._steps.close()
+
+def require_mesh(context):
+    obj = context.object
+    if obj is None or not obj.type == "MESH":
+        raise Exception("Mesh must be selected, " + (obj.type if obj else "nothing") + " was given")
+    return obj
+
+
+class ScnExport(Operator, ExportHelper, SteppedExport):
+    """Export the current scene's entities"""
+    bl_idname = "export.scn"
+    bl_label = "Export Custom Scene"
+
+    # ExportHelper mixin class uses this
+    filename_ext = ".scn"
+
+    filter_glob = StringProperty(
+            default="*.scn",
+            options={'HIDDEN'},
+            )
+
+    packData = BoolProperty(
+            name="Pack Data",
+            description="Embed the models of mesh entities in a PACK section, "
+                        "shared between entities with identical data",
+            default=True,)
+
+    meshFormat = EnumProperty(
+            name="Mesh Format",
+            description="Format of packed models",
+            items=(('MDL', "MDL", "Packed models are MDL files"),
+                   ('MSH', "MSH", "Packed models are MSH files")),
+            default='MDL',)
+
+    sliceUvs = BoolProperty(
+            name="Slice UV mapping",
+            description="If true, vertices of packed MDL models will be split so there "
+                        "is one vertex entry per unique UV",
+            default=True,)
+
+    packPhysics = BoolProperty(
+            name="Pack Physics",
+            description="Embed a PHY collision description for each entity",
+            default=False,)
+
+    packPoses = BoolProperty(
+            name="Pack Poses",
+            description="Embed the POS pose library of skinned meshes",
+            default=False,)
+
+    buildBvh = BoolProperty(
+            name="Build BVH",
+            description="Store a bounding volume hierarchy over the world space bounds "
+                        "of all entities",
+            default=True,)
+
+    streamCells = BoolProperty(
+            name="Streaming Layout",
+            description="Partition entities into a grid of cells that can each be "
+                        "loaded with a single read",
+            default=False,)
+
+    cellSize = FloatProperty(
+            name="Cell Size",
+            description="Width of a streaming cell, in blender units",
+            default=64.0,
+            min=0.001,)
+
+    packCells = BoolProperty(
+            name="Pack Data in Cells",
+            description="Store packed data used by a single cell in that cell's chunk",
+            default=True,)
+
+    compression = compression_property()
+    meshCodec = mesh_codec_property()
+
+    workers = IntProperty(
+            name="Workers",
+            description="Number of processes encoding packed MDL models, on Linux "
+                        "(1 encodes on the main thread, output is identical)",
+            default=1,
+            min=1,
+            max=64,)
+
+    def export_steps(self, context):
+        scn = load_exporter("io_export_scn")
+        settings = {'workers': self.workers,
+                    'compression': self.compression,
+                    'meshCodec': self.meshCodec,
+                    'buildBvh': self.buildBvh,
+                    'streamCells': self.streamCells,
+                    'cellSize': self.cellSize,
+                    'packCells': self.packCells,
+                    'packData': self.packData,
+                    'meshFormat': self.meshFormat,
+                    'sliceUvs': self.sliceUvs,
+                    'packPhysics': self.packPhysics,
+                    'packPoses': self.packPoses}
+        # the context is only valid during execute, the steps run in later timer events
+        return scn.iter_scn_scene(context.scene, settings)
+
+
+class MdlExport(Operator, ExportHelper, SteppedExport):
+    """Export the active mesh as a MDL model"""
+    bl_idname = "export.mdl"
+    bl_label = "Export Custom Model"
+
+    filename_ext = ".mdl"
+
+    filter_glob = StringProperty(
+            default="*.mdl",
+            options={'HIDDEN'},
+            )
+
+    sliceUvs = BoolProperty(
+            name="Slice UV mapping",
+            description="If true, vertices will be split so there "
+                        "is one vertex entry per unique UV",
+            default=True,)
+
+    lodLevels = lod_property()
+    lodRatio = lod_ratio_property()
+    compression = compression_property()
+    meshCodec = mesh_codec_property()
+
+    def export_steps(self, context):
+        obj = require_mesh(context)
+        mdl = load_exporter("io_export_mdl")
+        settings = {'sliceUvs': self.sliceUvs,
+                    'lodRatios': lod_ratios(self),
+                    'compression': self.compression,
+                    'meshCodec': self.meshCodec}
+        return mdl.iter_mdl_mesh(obj, settings)
+
+
+class MshExport(Operator, ExportHelper, SteppedExport):
+    """Export the active mesh as a MSH mesh"""
+    bl_idname = "export.msh"
+    bl_label = "Export Custom Mesh"
+
+    filename_ext = ".msh"
+
+    filter_glob = StringProperty(
+            default="*.msh",
+            options={'HIDDEN'},
+            )
+
+    exportTangents = BoolProperty(
+            name="Tangents",
+            description="Store MikkTSpace tangents and bitangent signs of every uv entry, "
+                        "matching what normal maps were baked against",
+            default=False,)
+
+    exportAdjacency = BoolProperty(
+            name="Adjacency",
+            description="Store a triangles with adjacency index buffer (6 indices per "
+                        "triangle) for silhouette and shadow volume rendering",
+            default=False,)
+
+    lodLevels = lod_property()
+    lodRatio = lod_ratio_property()
+    compression = compression_property()
+    meshCodec = mesh_codec_property()
+
+    def export_steps(self, context):
+        obj = require_mesh(context)
+        msh = load_exporter("io_export_msh")
+        settings = {'tangents': self.exportTangents,
+                    'adjacency': self.exportAdjacency,
+                    'lodRatios': lod_ratios(self),
+                    'compression': self.compression,
+                    'meshCodec': self.meshCodec}
+        return msh.iter_serialize_mesh(obj, settings)
+
+
+class PhyExport(Operator, ExportHelper, SteppedExport):
+    """Export the active object's collision volumes"""
+    bl_idname = "export.phy"
+    bl_label = "Export Physics Info"
+
+    filename_ext = ".phy"
+
+    filter_glob = StringProperty(
+            default="*.phy",
+            options={'HIDDEN'},
+            )
+
+    fitShape = EnumProperty(
+            name="Fit Shape",
+            description="Primitives generated when the object has no collision children",
+            items=(('BOUNDS', "Bounding Box", "One box from the object's bound_box"),
+                   ('BOX', "Oriented Boxes", "PCA oriented boxes fitted to the mesh"),
+                   ('SPHERE', "Spheres", "Spheres fitted to k-means clusters of the mesh"),
+                   ('CAPSULE', "Capsules", "Capsules along the principal axes of the mesh"),
+                   ('BONES', "Bone Capsules", "One capsule per armature bone, around the vertices "
+                                              "weighted to it (capsules if not skinned)"),
+                   ('HULL', "Convex Hull", "Convex hull of the mesh, up to the hull vertex budget")),
+            default='BOUNDS',)
+
+    fitBudget = IntProperty(
+            name="Primitive Budget",
+            description="Maximum number of fitted primitives",
+            default=1,
+            min=1,
+            max=64,)
+
+    hullBudget = IntProperty(
+            name="Hull Vertex Budget",
+            description="Maximum number of vertices of a convex hull",
+            default=32,
+            min=4,
+            max=1024,)
+
+    bvhThreshold = IntProperty(
+            name="BVH Threshold",
+            description="Store a bounding volume hierarchy over the primitives when "
+                        "there are at least this many (0 never stores one)",
+            default=16,
+            min=0,)
+
+    compression = compression_property()
+
+    def export_steps(self, context):
+        phy = load_exporter("io_export_phy")
+        settings = {'fitShape': self.fitShape,
+                    'fitBudget': self.fitBudget,
+                    'hullBudget': self.hullBudget,
+                    'bvhThreshold': self.bvhThreshold,
+                    'compression': self.compression}
+        return phy.iter_phy_object(context.object, settings)
+
+
+class PosExport(Operator, ExportHelper, SteppedExport):
+    """Export the pose library of the active mesh's armature"""
+    bl_idname = "export.pos"
+    bl_label = "Export Custom Pose"
+
+    filename_ext = ".pos"
+
+    filter_glob = StringProperty(
+            default="*.pos",
+            options={'HIDDEN'},
+            )
+
+    use_setting = BoolProperty(
+            name="Append Pose Name",
+            description="Append the name of the pose to the filename",
+            default=True,
+            )
+
+    compression = compression_property()
+
+    def export_steps(self, context):
+        #TODO: use setting
+        obj = require_mesh(context)
+        pos = load_exporter("io_export_pos")
+        return pos.iter_pos_pose(obj, {'compression': self.compression})
+
+
+class VatExport(Operator, ExportHelper, SteppedExport):
+    """Bake the active skinned mesh's pose library to a vertex animation texture"""
+    bl_idname = "export.vat"
+    bl_label = "Export Vertex Animation Texture"
+
+    filename_ext = ".vat"
+
+    filter_glob = StringProperty(
+            default="*.vat",
+            options={'HIDDEN'},
+            )
+
+    vertexOrder = EnumProperty(
+            name="Vertex Order",
+            description="Export whose vertex order the texels follow",
+            items=(('MDL', "MDL", "Vertices of the MDL export"),
+                   ('MSH', "MSH", "Vertices of the MSH export")),
+            default='MDL',)
+
+    sliceUvs = BoolProperty(
+            name="Slice UV mapping",
+            description="Match a MDL exported with vertices split per unique UV",
+            default=True,)
+
+    compression = compression_property()
+
+    def export_steps(self, context):
+        obj = require_mesh(context)
+        vat = load_exporter("io_export_vat")
+        settings = {'vatOrder': self.vertexOrder,
+                    'sliceUvs': self.sliceUvs,
+                    'compression': self.compression}
+        return vat.iter_vat(obj, settings)
+
+
+class SeqExport(Operator, ExportHelper, SteppedExport):
+    """Export the active mesh over the scene's frame range, as a mesh and per frame vertex changes"""
+    bl_idname = "export.seq"
+    bl_label = "Export Mesh Sequence"
+
+    filename_ext = ".seq"
+
+    filter_glob = StringProperty(
+            default="*.seq",
+            options={'HIDDEN'},
+            )
+
+    baseFormat = EnumProperty(
+            name="Mesh Format",
+            description="Format of the mesh stored once, whose vertices the frames update",
+            items=(('MDL', "MDL", "The mesh is a MDL file"),
+                   ('MSH', "MSH", "The mesh is a MSH file")),
+            default='MDL',)
+
+    sliceUvs = BoolProperty(
+            name="Slice UV mapping",
+            description="If true, MDL vertices will be split so there "
+                        "is one vertex entry per unique UV",
+            default=True,)
+
+    compression = compression_property()
+    meshCodec = mesh_codec_property()
+
+    def export_steps(self, context):
+        obj = require_mesh(context)
+        seq = load_exporter("io_export_seq")
+        settings = {'seqFormat': self.baseFormat,
+                    'sliceUvs': self.sliceUvs,
+                    'compression': self.compression,
+                    'meshCodec': self.meshCodec}
+        return seq.iter_seq(obj, settings)
+
+
+class WatchExport(Operator):
+    """Export the scene to a directory, then keep the files up to date while editing (run again to stop)"""
+    bl_idname = "export.watch"
+    bl_label = "Watch Exports"
+
+    directory = StringProperty(
+            subtype='DIR_PATH',)
+
+    exportPhysics = BoolProperty(
+            name="Physics",
+            description="Keep a PHY file for every object",
+            default=False,)
+
+    exportPoses = BoolProperty(
+            name="Poses",
+            description="Keep a POS file for every mesh with a pose library",
+            default=False,)
+
+    updateManifest = BoolProperty(
+            name="Update Manifest",
+            description="Keep an index of every exported file in the directory",
+            default=False,)
+
+    _timer = None
+
+    def invoke(self, context, event):
+        watch = load_exporter("watch")
+        if watch.is_watching():
+            watch.stop()
+            self.report({'INFO'}, "Stopped watching")
+            return {'FINISHED'}
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        watch = load_exporter("watch")
+        settings = {'sliceUvs': True,
+                    'exportPhysics': self.exportPhysics,
+                    'exportPoses': self.exportPoses,
+                    'updateManifest': self.updateManifest}
+        watch.start(context, self.directory, settings)
+        self._timer = context.window_manager.event_timer_add(watch.WATCH_TICK, context.window)
+        context.window_manager.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        watch = load_exporter("watch")
+        if not watch.is_watching():
+            context.window_manager.event_timer_remove(self._timer)
+            return {'FINISHED'}
+        if event.type == 'TIMER':
+            watch.flush(context)
+        return {'PASS_THROUGH'}
+
+
+class ManifestExport(Operator):
+    """Write an index of every exported file in a directory, for loaders to plan from one read"""
+    bl_idname = "export.manifest"
+    bl_label = "Export Asset Manifest"
+
+    directory = StringProperty(
+            subtype='DIR_PATH',)
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        manifest = load_exporter("manifest")
+        nassets = manifest.write_manifest(bpy.path.abspath(self.directory))
+        self.report({'INFO'}, "Indexed %d assets in %s" % (nassets, manifest.MANIFEST_NAME))
+        return {'FINISHED'}
+
+
+classes = (ScnExport, MdlExport, MshExport, PhyExport, PosExport, VatExport, SeqExport, WatchExport,
+           ManifestExport)
+
+def menu_func_export(self, context):
+    self.layout.operator(ScnExport.bl_idname, text="Custom Scene (.scn)")
+    self.layout.operator(MdlExport.bl_idname, text="Custom Model (.mdl)")
+    self.layout.operator(MshExport.bl_idname, text="Custom Mesh (.msh)")
+    self.layout.operator(PhyExport.bl_idname, text="Custom Physics Object (.phy)")
+    self.layout.operator(PosExport.bl_idname, text="Custom Pose (.pos)")
+    self.layout.operator(VatExport.bl_idname, text="Vertex Animation Texture (.vat)")
+    self.layout.operator(SeqExport.bl_idname, text="Custom Mesh Sequence (.seq)")
+    self.layout.operator(WatchExport.bl_idname, text="Watch Custom Exports")
+    self.layout.operator(ManifestExport.bl_idname, text="Custom Asset Manifest (.man)")
+
+
+def register():
+    start = time.perf_counter()
+    for cls in classes:
+        bpy.utils.register_class(cls)
+    bpy.types.INFO_MT_file_export.append(menu_func_export)
+    print("%s: imported in %.2f ms, registered in %.2f ms" %
+          (__name__, _import_time * 1000.0, (time.perf_counter() - start) * 1000.0))
+
+
+def unregister():
+    if "watch" in _exporters:
+        _exporters["watch"].stop()
+    bpy.types.INFO_MT_file_export.remove(menu_func_export)
+    for cls in reversed(classes):
+        bpy.utils.unregister_class(cls)
+    _exporters.clear()
+
+
+_import_time = time.perf_counter() - _import_start
@@ -1,29 +1,93 @@
 import bpy
-from bpy_extras.io_utils import ExportHelper
-from mathutils import *
-from math import *
 import struct
+import numpy as np
+from mathutils import Matrix
+from math import sqrt, floor
+
+from .section_codec import CODECS, CODEC_NONE, compress_section, read_section_directory, read_section
+from .mesh_codec import ENCODING_NONE
+from .steps import EXPORT_CHUNK, run_steps, scale_steps
+
+"""
+Section layout shared by every format (SCN, MDL, MSH, PHY, POS).
+
+HEADER:
+    32 byte format specific header
+    32
+
+SECTION_DIRECTORY:
+    4 byte: label 'SDIR'
+    4 byte: number of sections
+    8 byte: padding
+    SECTION * number of sections
+    16 + 24 * number of sections
+
+SECTION:
+    4 byte: tag
+    4 byte: offset (from start of file)
+    4 byte: size in bytes
+    4 byte: stride (size of one element, 0 if the section is not a plain array)
+    4 byte: element count
+    2 byte: codec (0=none, 1=zlib, 2=lzma, see section_codec.py)
+    2 byte: transform (0=none, 1=index stream, 2=vertex stream, see mesh_codec.py)
+    24
+
+Sections follow the directory, each starting 16 byte aligned; sections
+meant to be uploaded as GPU buffers (vertices, indices) are 64 byte aligned.
+A loader can find, map or skip any section from the directory alone.
+
+Meshes (MDL, MSH) store their faces sorted by material, with a 'SUBM'
+section giving the range of each material, so every material can be drawn
+with a single call (LOD faces have their own table, 'LODM', see decimate.py):
+
+SUBMESH:
+    2 byte: material index
+    2 byte: padding
+    4 byte: first face (element of the FACE section)
+    4 byte: number of faces
+    4 byte: first vertex used by the faces
+    4 byte: number of vertices, up to the last one used
+    12 byte: bounds minimum (3 * 4 byte float)
+    12 byte: bounds maximum (3 * 4 byte float)
+    4 byte: padding
+    48
+
+When exported with compression, large array sections are stored compressed
+in independently decodable blocks; size is then the stored size, while
+stride and count still describe the decompressed array. Mesh sections may
+also be transformed before compression; a loader decompresses, then undoes
+the transform.
+"""
+
+SECTION_ALIGN = 16
+BUFFER_ALIGN = 64
+
+# exporters are generators of small steps, see steps.py
+
+# converts blender's z-up coordinates to the y-up coordinates used by all formats
+def y_up_matrix():
+    return Matrix([[1, 0, 0, 0],
+                   [0, 0, 1, 0],
+                   [0,-1, 0, 0],
+                   [0, 0, 0, 1]])
 
 #normalizes all vertices, projecting them onto a sphere
 def normalizeAll():
     for m in bpy.data.meshes:
-        for v in m.vertices:
-            sum = 0.0
-            for i in range(0, 3):
-                sum += v.co[i] * v.co[i]
-            sum = sqrt(sum)
-            for i in range(0, 3):
-                v.co[i] = v.co[i] / sum
+        co = mesh_vertex_array(m)
+        length = np.sqrt(co[:, 0] * co[:, 0] + co[:, 1] * co[:, 1] + co[:, 2] * co[:, 2])
+        if (length == 0.0).any():
+            raise Exception("Mesh " + m.name + " has vertices at the origin, they can not be normalized")
+        set_mesh_vertex_array(m, co / length[:, None])
 
 #sperically project onto plane z=1, produces x/y coords: {-1 <= x <= 1}
 def planet_co_to_uv():
-    sqrt2 = sqrt(2)
-    sqrt3inv = 1/sqrt(3)
     for m in bpy.data.meshes:
-        for v in m.vertices:
-            ratio = 1 / v.co[2]
-            for i in range(0, 3):
-                v.co[i] = v.co[i] * (ratio)
+        co = mesh_vertex_array(m)
+        if (co[:, 2] == 0.0).any():
+            raise Exception("Mesh " + m.name + " has vertices on the z=0 plane, they can not be projected")
+        ratio = 1.0 / co[:, 2]
+        set_mesh_vertex_array(m, co * ratio[:, None])
 
 def float_to_ushort(val):
     if val >= 1.0:
@@ -52,6 +116,182 @@ def vec2_to_uhvec2(val):
 def vec3_to_hvec3(val):
     return tuple((float_to_short(val[0]), float_to_short(val[1]), float_to_short(val[2])))
 
+# array versions of the above, element for element identical to the scalar ones
+# (floor for unsigned shorts, round half to even for shorts and bytes)
+def floats_to_ushort(vals):
+    vals = np.asarray(vals, dtype=np.float64)
+    q = np.floor(np.clip(vals, 0.0, 1.0) * (2**16-1))
+    return np.where(vals >= 1.0, 2**16-1, np.where(vals <= 0.0, 0, q)).astype(np.uint16)
+
+def floats_to_short(vals):
+    vals = np.asarray(vals, dtype=np.float64)
+    q = np.rint(np.clip(vals, -1.0, 1.0) * (2**15-1))
+    return np.where(vals >= 1.0, 2**15-1, np.where(vals <= -1.0, -(2**15)+1, q)).astype(np.int16)
+
+def floats_to_ubyte(vals):
+    vals = np.asarray(vals, dtype=np.float64)
+    q = np.rint(np.clip(vals, 0.0, 1.0) * (2**8-1))
+    return np.where(vals >= 1.0, 2**8-1, np.where(vals <= 0.0, 0, q)).astype(np.uint8)
+
+# (N, 2) floats to (N, 2) unsigned shorts
+def vec2s_to_uhvec2(vals):
+    return floats_to_ushort(vals)
+
+# (N, 3) floats to (N, 3) shorts
+def vec3s_to_hvec3(vals):
+    return floats_to_short(vals)
+
+# (N, 3) unit vectors to (N, 2) shorts, octahedral encoded: the vector is projected
+# onto the octahedron |x|+|y|+|z| = 1, and the lower half folded over the upper one
+def vec3s_to_octvec2(vals):
+    vals = np.asarray(vals, dtype=np.float64)
+    length = np.abs(vals).sum(axis=1)[:, None]
+    p = vals / np.where(length > 0.0, length, 1.0)
+    sign = np.where(p[:, :2] >= 0.0, 1.0, -1.0)
+    folded = (1.0 - np.abs(p[:, [1, 0]])) * sign
+    return floats_to_short(np.where(p[:, 2:] < 0.0, folded, p[:, :2]))
+
+# rounds n up to the next multiple of align
+def align_up(n, align):
+    return (n + align - 1) // align * align
+
+# pads a list of byte strings with zeros to a multiple of align, returns the new length
+def buf_align(buf, align):
+    size = sum(len(b) for b in buf)
+    buf.append(bytes(align_up(size, align) - size))
+    return align_up(size, align)
+
+class SectionWriter(object):
+    """
+    lays out a file as HEADER, SECTION_DIRECTORY, then the aligned sections.
+    compression is a key of section_codec.CODECS, used by the sections written with compress set
+    """
+    def __init__(self, nsections, compression='NONE'):
+        self.nsections = nsections
+        self.codec = CODECS[compression]
+        self.buf = [bytes(32), bytes(16 + 24 * nsections)] # header and directory placeholders
+        self.entries = []
+        self.start = len(self.buf)
+
+    def size(self):
+        return sum(len(b) for b in self.buf)
+
+    def begin(self, align=SECTION_ALIGN):
+        """ starts a section written directly to buf, returns its file offset """
+        offset = buf_align(self.buf, align)
+        self.start = len(self.buf)
+        return offset
+
+    def end(self, tag, offset, stride=0, count=0, compress=False, encoding=ENCODING_NONE):
+        codec = CODEC_NONE
+        if compress and self.codec != CODEC_NONE:
+            codec, data = compress_section(self.codec, b''.join(self.buf[self.start:]))
+            self.buf[self.start:] = [data]
+        self.entries.append(struct.pack("4sIIIIHH", tag, offset, self.size() - offset, stride, count,
+                                        codec, encoding))
+
+    def section(self, tag, data, stride=0, count=0, align=SECTION_ALIGN, compress=False, encoding=ENCODING_NONE):
+        """ data is already transformed with encoding (see mesh_codec.encode_section) """
+        offset = self.begin(align)
+        self.buf.append(data)
+        self.end(tag, offset, stride, count, compress, encoding)
+        return offset
+
+    def finish(self, header):
+        assert(len(header) == 32)
+        assert(len(self.entries) == self.nsections)
+        self.buf[0] = header
+        self.buf[1] = struct.pack("4sI8x", b"SDIR", self.nsections) + b''.join(self.entries)
+        return b''.join(self.buf)
+
+def serialize_submeshes(materials, faces, positions, base=0):
+    """
+    SUBMESH table of faces already sorted by material; materials holds the material of
+    each face, faces 3 vertex indices each, positions the (y up) position of each vertex.
+    base is added to the first face of every submesh
+    """
+    buf = []
+    first = 0
+    while first < len(faces):
+        end = first
+        while end < len(faces) and materials[end] == materials[first]:
+            end += 1
+        verts = [i for face in faces[first:end] for i in face]
+        pts = np.array([positions[i] for i in verts], dtype=np.float64)
+        bmin = pts.min(axis=0)
+        bmax = pts.max(axis=0)
+        buf.append(struct.pack("H2xIIII3f3f4x", materials[first], base + first, end - first,
+                               min(verts), max(verts) - min(verts) + 1,
+                               bmin[0], bmin[1], bmin[2], bmax[0], bmax[1], bmax[2]))
+        first = end
+    return b''.join(buf)
+
+def serialize_lod_submeshes(lods, materials, positions):
+    """
+    LODM section of a LOD chain (see decimate.py) over faces with the given materials,
+    and the number of submeshes of each LOD
+    """
+    buf = []
+    counts = []
+    first = 0
+    for tris, error, faces in lods:
+        table = serialize_submeshes([materials[fi] for fi in faces], tris, positions, first)
+        buf.append(table)
+        counts.append(len(table) // 48)
+        first += len(tris)
+    return b''.join(buf), counts
+
+# (N, 3) array of the mesh's vertex positions, in object space
+def mesh_vertex_array(mesh):
+    co = np.zeros(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3).astype(np.float64)
+
+# (N, 3) arrays of the vertex positions and normals of the object's mesh after its
+# modifiers (e.g. skinning or cloth) at the scene's current frame, in y up coordinates
+def mesh_evaluated_arrays(obj, scene):
+    mesh = obj.to_mesh(scene, True, 'PREVIEW')
+    try:
+        if len(mesh.vertices) != len(obj.data.vertices):
+            raise Exception("Modifiers of " + obj.name + " change its vertex count, only deforming ones can be exported")
+        co = mesh_vertex_array(mesh)
+        normal = mesh_normal_array(mesh)
+    finally:
+        bpy.data.meshes.remove(mesh)
+    return y_up_array(co), y_up_array(normal)
+
+# (N, 3) array of the mesh's vertex normals, in object space
+def mesh_normal_array(mesh):
+    normal = np.zeros(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("normal", normal)
+    return normal.reshape(-1, 3).astype(np.float64)
+
+# (N, 3) array of z up vectors to y up, as y_up_matrix
+def y_up_array(v):
+    return np.column_stack((v[:, 0], v[:, 2], -v[:, 1]))
+
+# writes an (N, 3) array back as the mesh's vertex positions
+def set_mesh_vertex_array(mesh, co):
+    mesh.vertices.foreach_set("co", np.ascontiguousarray(co, dtype=np.float32).ravel())
+    mesh.update()
+
+# (N, 3) array of vertex indices, polygons fan triangulated
+def mesh_triangle_array(mesh):
+    loop_start = np.zeros(len(mesh.polygons), dtype=np.int64)
+    loop_total = np.zeros(len(mesh.polygons), dtype=np.int64)
+    loop_verts = np.zeros(len(mesh.loops), dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", loop_start)
+    mesh.polygons.foreach_get("loop_total", loop_total)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+
+    ntri = np.maximum(loop_total - 2, 0)
+    poly = np.repeat(np.arange(len(loop_start)), ntri)
+    corner = np.arange(ntri.sum()) - np.repeat(np.cumsum(ntri) - ntri, ntri) + 1
+    first = loop_start[poly]
+    return np.column_stack((loop_verts[first],
+                            loop_verts[first + corner],
+                            loop_verts[first + corner + 1]))
+
 def is_trimesh(mesh):
     ret = True
     for face in mesh.tessfaces:
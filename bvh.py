@@ -0,0 +1,126 @@
+import struct
+
+"""
+Bounding volume hierarchy shared by the SCN and PHY exporters.
+
+Nodes are split using a binned surface area heuristic (SAH) and stored
+depth first, so an interior node's left child is always the next node,
+and only the right child index needs to be stored.
+
+BVH_NODE:
+    12 byte: bounds minimum (3 * 4 byte float)
+    12 byte: bounds maximum (3 * 4 byte float)
+    4 byte: interior: index of right child node
+            leaf: index of first primitive reference
+    2 byte: number of primitive references (0 for interior nodes)
+    2 byte: split axis (0=x, 1=y, 2=z)
+    32
+"""
+
+BVH_BINS = 12
+BVH_NODE_SIZE = 32
+
+class BvhNode(object):
+    def __init__(self, bmin, bmax):
+        self.bmin = bmin
+        self.bmax = bmax
+        self.offset = 0 # right child or first reference
+        self.count = 0
+        self.axis = 0
+
+    def serialize(self):
+        pack = struct.pack("3f3fIHH",
+                self.bmin[0], self.bmin[1], self.bmin[2],
+                self.bmax[0], self.bmax[1], self.bmax[2],
+                self.offset, self.count, self.axis)
+        assert(len(pack) == BVH_NODE_SIZE)
+        return pack
+
+def bounds_union(bounds):
+    bmin = tuple(min(b[0][i] for b in bounds) for i in range(3))
+    bmax = tuple(max(b[1][i] for b in bounds) for i in range(3))
+    return (bmin, bmax)
+
+def surface_area(bmin, bmax):
+    dx = bmax[0] - bmin[0]
+    dy = bmax[1] - bmin[1]
+    dz = bmax[2] - bmin[2]
+    return 2.0 * (dx * dy + dy * dz + dz * dx)
+
+def sah_split(refs, bounds, centers, axis, cmin, cmax):
+    """ returns the bin boundary with the lowest SAH cost, and the bin of each ref """
+    scale = BVH_BINS / (cmax - cmin)
+    bins = [min(BVH_BINS - 1, int((centers[r][axis] - cmin) * scale)) for r in refs]
+
+    binbounds = [[] for i in range(BVH_BINS)]
+    for r, b in zip(refs, bins):
+        binbounds[b].append(bounds[r])
+
+    # sweep from the right to get the area and count of every right hand side
+    rightcost = [0.0] * BVH_BINS
+    acc = []
+    for i in range(BVH_BINS - 1, 0, -1):
+        acc.extend(binbounds[i])
+        if acc:
+            rightcost[i] = surface_area(*bounds_union(acc)) * len(acc)
+
+    best = None
+    bestcost = float("inf")
+    acc = []
+    for i in range(1, BVH_BINS):
+        acc.extend(binbounds[i - 1])
+        if not acc or not rightcost[i]:
+            continue
+        cost = surface_area(*bounds_union(acc)) * len(acc) + rightcost[i]
+        if cost < bestcost:
+            best = i
+            bestcost = cost
+    return best, bins
+
+def build_bvh(bounds, leafsize=4):
+    """
+    builds a BVH over a list of (min, max) bounds.
+    returns (nodes, refs); leaves reference the range refs[offset:offset+count],
+    which holds indices into bounds.
+    """
+    nodes = []
+    refs = list(range(len(bounds)))
+    if not refs:
+        return nodes, refs
+    centers = [tuple((b[0][i] + b[1][i]) * 0.5 for i in range(3)) for b in bounds]
+
+    stack = [(0, len(refs), None)] # (first ref, end ref, parent waiting for its right child)
+    while stack:
+        start, end, parent = stack.pop()
+        if parent is not None:
+            parent.offset = len(nodes)
+
+        nodebounds = bounds_union([bounds[r] for r in refs[start:end]])
+        node = BvhNode(nodebounds[0], nodebounds[1])
+        nodes.append(node)
+
+        count = end - start
+        cmin = [min(centers[r][i] for r in refs[start:end]) for i in range(3)]
+        cmax = [max(centers[r][i] for r in refs[start:end]) for i in range(3)]
+        extent = [cmax[i] - cmin[i] for i in range(3)]
+        axis = extent.index(max(extent))
+        if count <= leafsize or extent[axis] <= 0.0:
+            node.offset = start
+            node.count = count
+            continue
+
+        split, bins = sah_split(refs[start:end], bounds, centers, axis, cmin[axis], cmax[axis])
+        if split is None: # fall back to a median split
+            ordered = sorted(refs[start:end], key=lambda r: centers[r][axis])
+            mid = count // 2
+        else:
+            left = [r for r, b in zip(refs[start:end], bins) if b < split]
+            right = [r for r, b in zip(refs[start:end], bins) if b >= split]
+            ordered = left + right
+            mid = len(left)
+        refs[start:end] = ordered
+
+        node.axis = axis
+        stack.append((start + mid, end, node)) # right, visited after the whole left subtree
+        stack.append((start, start + mid, None))
+    return nodes, refs
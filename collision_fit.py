@@ -0,0 +1,277 @@
+import numpy as np
+
+try:
+    from .steps import run_steps
+except ImportError: # imported on its own, e.g. by the tests
+    from steps import run_steps
+
+"""
+Collision primitive fitting for the PHY exporter.
+
+Works on an (N, 3) array of mesh vertex positions, in the object's local space.
+Boxes are oriented by principal component analysis (PCA); several boxes come from
+recursively splitting the vertices in two (2-means seeded along the principal axis),
+several spheres from k-means clustering. Capsules follow the principal axis
+(or a given axis, e.g. a bone's) and are split like boxes.
+
+Boxes are (center, dimensions, 3x3 rotation), dimensions being full widths along
+the rotation's columns; spheres are (center, radius); capsules are
+(center, radius, height, 3x3 rotation), height being the distance between the
+cap centers along the rotation's z column.
+"""
+
+FIT_ITERATIONS = 10
+FIT_MIN_POINTS = 4
+FIT_MIN_GAIN = 0.95 # a split must shrink the volume to below this fraction
+FIT_CHUNK = 4096 # points measured against every k-means center at once (k * 96 KB of temporaries)
+
+def principal_axes(points):
+    """ right handed 3x3 rotation whose columns are the principal axes, largest first """
+    centered = points - points.mean(axis=0)
+    evals, evecs = np.linalg.eigh(np.dot(centered.T, centered))
+    axes = evecs[:, ::-1]
+    if np.linalg.det(axes) < 0.0:
+        axes[:, 2] = -axes[:, 2]
+    return axes
+
+def fit_obb(points):
+    """ PCA oriented bounding box """
+    axes = principal_axes(points)
+    local = np.dot(points, axes)
+    lo = local.min(axis=0)
+    hi = local.max(axis=0)
+    center = np.dot(axes, (lo + hi) * 0.5)
+    return (center, hi - lo, axes)
+
+def aabb_volume(points):
+    return float(np.prod(points.max(axis=0) - points.min(axis=0)))
+
+def box_volume(box):
+    return float(np.prod(box[1]))
+
+def sphere_volume(sphere):
+    return 4.0 / 3.0 * np.pi * sphere[1] ** 3
+
+def capsule_volume(capsule):
+    center, radius, height, axes = capsule
+    return np.pi * radius ** 2 * height + sphere_volume((center, radius))
+
+def axis_frame(axis):
+    """ right handed 3x3 rotation whose z column is axis """
+    z = axis / np.sqrt(np.dot(axis, axis))
+    helper = np.array([1.0, 0.0, 0.0]) if abs(z[0]) < 0.9 else np.array([0.0, 1.0, 0.0])
+    x = np.cross(helper, z)
+    x /= np.sqrt(np.dot(x, x))
+    return np.column_stack((x, np.cross(z, x), z))
+
+def fit_capsule(points, axis=None):
+    """ tightest capsule along axis (by default the principal axis) """
+    if axis is None:
+        axes = principal_axes(points)[:, [1, 2, 0]] # cyclic, stays right handed
+    else:
+        axes = axis_frame(np.asarray(axis, dtype=np.float64))
+    local = np.dot(points, axes)
+    flat = np.column_stack((local[:, :2], np.zeros(len(local))))
+    mid, radius = bounding_sphere(flat) # minimal circle across the axis
+    d2 = ((flat - mid) ** 2).sum(axis=1)
+    # a point is inside if its height is within the segment, widened by the room left across the axis
+    room = np.sqrt(np.maximum(radius ** 2 - d2, 0.0))
+    lo = float((local[:, 2] + room).min())
+    hi = float((local[:, 2] - room).max())
+    center = np.dot(axes, [mid[0], mid[1], (lo + hi) * 0.5])
+    return (center, radius, max(hi - lo, 0.0), axes)
+
+def nearest_centers(points, centers):
+    """ index of the nearest center of every point, FIT_CHUNK points at a time so memory stays bounded """
+    labels = np.zeros(len(points), dtype=int)
+    for start in range(0, len(points), FIT_CHUNK):
+        chunk = points[start:start + FIT_CHUNK]
+        d = ((chunk[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels[start:start + len(chunk)] = d.argmin(axis=1)
+    return labels
+
+def kmeans(points, k, iterations=FIT_ITERATIONS):
+    """ deterministic k-means, seeded with farthest points; returns the cluster of each point """
+    centers = [points[np.argmax(((points - points.mean(axis=0)) ** 2).sum(axis=1))]]
+    dist = ((points - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, k):
+        centers.append(points[np.argmax(dist)])
+        dist = np.minimum(dist, ((points - centers[-1]) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    labels = np.zeros(len(points), dtype=int)
+    for it in range(iterations):
+        labels = nearest_centers(points, centers)
+        for c in range(k):
+            members = points[labels == c]
+            if len(members):
+                centers[c] = members.mean(axis=0)
+    return labels
+
+def split_points(points):
+    """ splits points in two with 2-means, seeded at both ends of the principal axis """
+    axis = principal_axes(points)[:, 0]
+    proj = np.dot(points, axis)
+    centers = np.array([points[proj.argmin()], points[proj.argmax()]])
+    labels = np.zeros(len(points), dtype=bool)
+    for it in range(FIT_ITERATIONS):
+        d0 = ((points - centers[0]) ** 2).sum(axis=1)
+        d1 = ((points - centers[1]) ** 2).sum(axis=1)
+        labels = d1 < d0
+        if labels.all() or not labels.any():
+            break
+        centers = np.array([points[~labels].mean(axis=0), points[labels].mean(axis=0)])
+    return points[~labels], points[labels]
+
+def iter_fit_split(points, budget, fit, volume):
+    """
+    up to budget primitives, splitting the largest one while that shrinks the total volume;
+    one step per split tried
+    """
+    clusters = [points]
+    prims = [fit(points)]
+    final = [False]
+    while len(prims) < budget and not all(final):
+        yield len(prims) / budget
+        i = max((j for j in range(len(prims)) if not final[j]), key=lambda j: volume(prims[j]))
+        a, b = split_points(clusters[i])
+        if len(a) < FIT_MIN_POINTS or len(b) < FIT_MIN_POINTS:
+            final[i] = True
+            continue
+        prima = fit(a)
+        primb = fit(b)
+        if volume(prima) + volume(primb) >= volume(prims[i]) * FIT_MIN_GAIN:
+            final[i] = True
+            continue
+        clusters[i:i + 1] = [a, b]
+        prims[i:i + 1] = [prima, primb]
+        final[i:i + 1] = [False, False]
+    return prims
+
+def fit_split(points, budget, fit, volume):
+    return run_steps(iter_fit_split(points, budget, fit, volume))
+
+def iter_fit_boxes(points, budget):
+    """ up to budget PCA oriented boxes """
+    return iter_fit_split(points, budget, fit_obb, box_volume)
+
+def fit_boxes(points, budget):
+    return run_steps(iter_fit_boxes(points, budget))
+
+def iter_fit_capsules(points, budget):
+    """ up to budget capsules along the principal axes of the clusters """
+    return iter_fit_split(points, budget, fit_capsule, capsule_volume)
+
+def fit_capsules(points, budget):
+    return run_steps(iter_fit_capsules(points, budget))
+
+def iter_fit_spheres(points, budget):
+    """ up to budget spheres around k-means clusters of the points, one step per sphere """
+    k = max(1, min(budget, len(points) // FIT_MIN_POINTS))
+    labels = kmeans(points, k)
+    spheres = []
+    for c in range(k):
+        yield c / k
+        members = points[labels == c]
+        if not len(members):
+            continue
+        center = members.mean(axis=0)
+        spheres.append((center, float(np.sqrt(((members - center) ** 2).sum(axis=1).max()))))
+    return spheres
+
+def fit_spheres(points, budget):
+    return run_steps(iter_fit_spheres(points, budget))
+
+def mesh_volume(points, tris):
+    """ enclosed volume of a closed triangle mesh (divergence theorem) """
+    a = points[tris[:, 0]]
+    b = points[tris[:, 1]]
+    c = points[tris[:, 2]]
+    return abs(float((a * np.cross(b, c)).sum()) / 6.0)
+
+def tightness(volume, primitive_volume):
+    """ fraction of the primitives' volume filled by the mesh, 1 is a perfect fit """
+    if primitive_volume <= 0.0:
+        return 1.0
+    return min(1.0, volume / primitive_volume)
+
+#
+# minimal bounding sphere
+#
+
+SPHERE_EPSILON = 1e-7
+SPHERE_DIRECTIONS = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]] +
+                             [[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)], dtype=np.float64)
+SPHERE_DIRECTIONS /= np.sqrt((SPHERE_DIRECTIONS ** 2).sum(axis=1))[:, None]
+
+def sphere_points(center, radius):
+    """ points on a sphere's surface along the axes and diagonals """
+    return np.asarray(center, dtype=np.float64) + SPHERE_DIRECTIONS * radius
+
+def sphere_2(a, b):
+    return ((a + b) * 0.5, float(np.sqrt(((a - b) ** 2).sum())) * 0.5)
+
+def sphere_3(a, b, c):
+    """ smallest sphere with a, b and c on its surface """
+    u = a - c
+    v = b - c
+    w = np.cross(u, v)
+    ww = np.dot(w, w)
+    if ww < 1e-20: # collinear, the two farthest apart points span the sphere
+        return max((sphere_2(a, b), sphere_2(a, c), sphere_2(b, c)), key=lambda s: s[1])
+    center = c + np.cross(np.dot(u, u) * v - np.dot(v, v) * u, w) / (2.0 * ww)
+    return (center, float(np.sqrt(((center - a) ** 2).sum())))
+
+def sphere_4(a, b, c, d):
+    """ sphere with a, b, c and d on its surface """
+    m = 2.0 * np.array([b - a, c - a, d - a])
+    if abs(np.linalg.det(m)) < 1e-20: # coplanar
+        return max((sphere_3(a, b, c), sphere_3(a, b, d), sphere_3(a, c, d), sphere_3(b, c, d)),
+                   key=lambda s: s[1])
+    rhs = np.array([np.dot(p, p) - np.dot(a, a) for p in (b, c, d)])
+    center = np.linalg.solve(m, rhs)
+    return (center, float(np.sqrt(((center - a) ** 2).sum())))
+
+def welzl(points):
+    """ exact minimal enclosing sphere of a (small) point set, iterative Welzl """
+    def outside(p, s):
+        return np.sqrt(((p - s[0]) ** 2).sum()) > s[1] * (1.0 + SPHERE_EPSILON) + SPHERE_EPSILON
+
+    p = points
+    s = (p[0], 0.0)
+    for i in range(1, len(p)):
+        if not outside(p[i], s):
+            continue
+        s = (p[i], 0.0)
+        for j in range(i):
+            if not outside(p[j], s):
+                continue
+            s = sphere_2(p[i], p[j])
+            for k in range(j):
+                if not outside(p[k], s):
+                    continue
+                s = sphere_3(p[i], p[j], p[k])
+                for l in range(k):
+                    if outside(p[l], s):
+                        s = sphere_4(p[i], p[j], p[k], p[l])
+    return s
+
+def bounding_sphere(points):
+    """
+    exact minimal bounding sphere of an (N, 3) array, returns (center, radius).
+    Welzl runs on a small core set of extreme points, which grows by the points the
+    current sphere misses (tested on the whole array at once) until none are left.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    proj = np.dot(points, SPHERE_DIRECTIONS.T)
+    core = list(np.unique(np.concatenate((proj.argmax(axis=0), proj.argmin(axis=0)))))
+    while True:
+        subset = points[core]
+        order = np.random.RandomState(len(core)).permutation(len(subset)) # deterministic shuffle
+        center, radius = welzl(subset[order])
+        dist = np.sqrt(((points - center) ** 2).sum(axis=1))
+        missed = np.nonzero(dist > radius * (1.0 + SPHERE_EPSILON) + SPHERE_EPSILON)[0]
+        if not len(missed):
+            return (center, radius)
+        worst = missed[np.argsort(dist[missed])[::-1][:16]]
+        core.extend(int(i) for i in worst)
@@ -0,0 +1,286 @@
+import struct
+import numpy as np
+
+"""
+Convex hulls for the PHY exporter.
+
+Hulls are built with quickhull, always adding the point farthest outside the
+current hull, so stopping at a vertex budget leaves the best hull with that many
+vertices (points left outside are reported as the hull's error).
+Nearly coplanar triangles are then merged into convex polygons, which keeps the
+number of face planes (and of SAT axes) down.
+
+Indices stored in a hull's records are relative to the hull's first vertex,
+face and index, so hulls can be loaded one at a time.
+
+CONVEX:
+    4 byte: first vertex (into CVRT)
+    4 byte: first face (into CFAC)
+    4 byte: first index (into CIDX)
+    4 byte: first edge (into CEDG)
+    2 byte: number of vertices
+    2 byte: number of faces
+    2 byte: number of edges
+    2 byte: padding
+    24
+
+HULL_VERTEX:
+    12 byte: position (3 * 4 byte float)
+    12
+
+HULL_FACE:
+    12 byte: plane normal, pointing out (3 * 4 byte float)
+    4 byte: plane distance (float, dot(normal, v) <= distance for every vertex)
+    2 byte: first index of the face's polygon
+    2 byte: number of polygon indices
+    20
+
+HULL_INDEX:
+    2 byte: vertex, polygons wind counter clockwise seen from outside
+    2
+
+HULL_EDGE: (adjacency, each edge once)
+    2 byte: vertex a
+    2 byte: vertex b
+    2 byte: face on the left of a->b seen from outside (a->b is part of its polygon)
+    2 byte: face on the other side
+    8
+"""
+
+HULL_EPSILON = 1e-6 # relative to the size of the point set
+HULL_MERGE_COS = 0.9995 # triangles within about 1.8 degrees of a face's plane are merged into it
+HULL_MAX_VERTS = 0x2000 # keeps the polygon indices of a hull within 16 bits
+
+class HullFace(object):
+    def __init__(self, points, a, b, c):
+        self.verts = (a, b, c)
+        normal = np.cross(points[b] - points[a], points[c] - points[a])
+        length = np.sqrt(np.dot(normal, normal))
+        self.normal = normal / length if length > 0.0 else normal
+        self.dist = float(np.dot(self.normal, points[a]))
+        self.outside = np.zeros(0, dtype=int)
+        self.farthest = 0.0
+        self.alive = True
+
+    def edges(self):
+        a, b, c = self.verts
+        return ((a, b), (b, c), (c, a))
+
+def assign_outside(points, faces, candidates, eps):
+    """ gives every candidate point to the face it is farthest in front of """
+    if not len(candidates) or not faces:
+        return
+    normals = np.array([f.normal for f in faces])
+    dists = np.array([f.dist for f in faces])
+    height = np.dot(points[candidates], normals.T) - dists
+    best = height.argmax(axis=1)
+    outside = height[np.arange(len(candidates)), best] > eps
+    for i, face in enumerate(faces):
+        mine = outside & (best == i)
+        face.outside = candidates[mine]
+        face.farthest = float(height[mine, i].max()) if mine.any() else 0.0
+
+def initial_simplex(points, eps):
+    """ four points spanning a tetrahedron, or None if the points are flat """
+    extremes = np.concatenate((points.argmin(axis=0), points.argmax(axis=0)))
+    ext = points[extremes]
+    d = ((ext[:, None, :] - ext[None, :, :]) ** 2).sum(axis=2)
+    i, j = np.unravel_index(d.argmax(), d.shape)
+    a, b = extremes[i], extremes[j]
+    if d[i, j] <= eps * eps:
+        return None
+    line = (points[b] - points[a]) / np.sqrt(d[i, j])
+    rel = points - points[a]
+    off = rel - np.outer(np.dot(rel, line), line)
+    c = int(((off ** 2).sum(axis=1)).argmax())
+    normal = np.cross(points[b] - points[a], points[c] - points[a])
+    if np.dot(normal, normal) <= eps ** 4:
+        return None
+    height = np.dot(rel, normal / np.sqrt(np.dot(normal, normal)))
+    e = int(np.abs(height).argmax())
+    if abs(height[e]) <= eps:
+        return None
+    if height[e] > 0.0: # keep a, b, c clockwise seen from e
+        b, c = c, b
+    return int(a), int(b), int(c), e
+
+def quickhull(points, budget=HULL_MAX_VERTS):
+    """
+    convex hull of an (N, 3) array with at most budget vertices.
+    returns (vertex indices, triangles over those indices, error), or None if the points are
+    flat. error is how far the farthest point left out by the budget is outside the hull.
+    """
+    scale = float((points.max(axis=0) - points.min(axis=0)).max())
+    eps = HULL_EPSILON * max(scale, 1e-12)
+    simplex = initial_simplex(points, eps)
+    if simplex is None:
+        return None
+    a, b, c, d = simplex
+    faces = [HullFace(points, a, b, c), HullFace(points, a, d, b),
+             HullFace(points, b, d, c), HullFace(points, c, d, a)]
+    edges = dict() # directed edge -> face
+    for face in faces:
+        for e in face.edges():
+            edges[e] = face
+    assign_outside(points, faces, np.arange(len(points)), eps)
+    nverts = 4
+
+    while nverts < max(budget, 4):
+        live = [f for f in faces if f.alive and len(f.outside)]
+        if not live:
+            break
+        start = max(live, key=lambda f: f.farthest)
+        eye = int(start.outside[np.argmax(np.dot(points[start.outside], start.normal))])
+        p = points[eye]
+
+        # faces seen from the eye point, flood filled from the one it is outside of
+        visible = [start]
+        seen = set([start])
+        i = 0
+        while i < len(visible):
+            for (u, v) in visible[i].edges():
+                other = edges[(v, u)]
+                if other not in seen and np.dot(other.normal, p) - other.dist > eps:
+                    seen.add(other)
+                    visible.append(other)
+            i += 1
+        horizon = [e for f in visible for e in f.edges() if edges[(e[1], e[0])] not in seen]
+
+        orphans = np.concatenate([f.outside for f in visible])
+        for f in visible:
+            f.alive = False
+            for e in f.edges():
+                del edges[e]
+        created = []
+        for (u, v) in horizon:
+            face = HullFace(points, u, v, eye)
+            for e in face.edges():
+                edges[e] = face
+            created.append(face)
+        faces = [f for f in faces if f.alive] + created
+        assign_outside(points, created, orphans[orphans != eye], eps)
+        nverts += 1
+
+    faces = [f for f in faces if f.alive]
+    error = max([f.farthest for f in faces] + [0.0])
+    used = sorted(set(i for f in faces for i in f.verts))
+    remap = dict((v, i) for i, v in enumerate(used))
+    tris = [tuple(remap[i] for i in f.verts) for f in faces]
+    return np.array(used, dtype=int), tris, error
+
+def merge_faces(verts, tris):
+    """
+    merges nearly coplanar neighbouring triangles into convex polygons.
+    returns a list of (normal, distance, vertex loop)
+    """
+    normals = []
+    for a, b, c in tris:
+        n = np.cross(verts[b] - verts[a], verts[c] - verts[a])
+        length = np.sqrt(np.dot(n, n))
+        normals.append(n / length if length > 0.0 else n)
+    owner = dict()
+    for i, t in enumerate(tris):
+        for k in range(3):
+            owner[(t[k], t[(k + 1) % 3])] = i
+
+    region = [-1] * len(tris)
+    polys = []
+    for seed in range(len(tris)):
+        if region[seed] >= 0:
+            continue
+        region[seed] = seed
+        members = [seed]
+        i = 0
+        while i < len(members):
+            t = tris[members[i]]
+            for k in range(3):
+                other = owner.get((t[(k + 1) % 3], t[k]))
+                if other is not None and region[other] < 0 and np.dot(normals[other], normals[seed]) >= HULL_MERGE_COS:
+                    region[other] = seed
+                    members.append(other)
+            i += 1
+
+        # boundary of the region, chained into one loop
+        nexts = dict()
+        for m in members:
+            t = tris[m]
+            for k in range(3):
+                u, v = t[k], t[(k + 1) % 3]
+                if region[owner[(v, u)]] != seed:
+                    nexts[u] = v
+        start = next(iter(nexts))
+        loop = [start]
+        while nexts[loop[-1]] != start:
+            loop.append(nexts[loop[-1]])
+
+        # Newell's normal of the loop, and the plane pushed out to the farthest hull vertex:
+        # tilted off the merged triangles' planes, it can pass inside vertices away from the loop
+        pts = verts[loop]
+        nxt = np.roll(pts, -1, axis=0)
+        normal = np.cross(pts, nxt).sum(axis=0)
+        normal /= np.sqrt(np.dot(normal, normal))
+        polys.append((normal, float(np.dot(verts, normal).max()), loop))
+    return polys
+
+def hull_edges(polys):
+    """ every edge once, as (a, b, face with a->b, face with b->a) """
+    left = dict()
+    for fi, (normal, dist, loop) in enumerate(polys):
+        for k in range(len(loop)):
+            left[(loop[k], loop[(k + 1) % len(loop)])] = fi
+    return [(a, b, f, left[(b, a)]) for (a, b), f in sorted(left.items()) if a < b]
+
+def build_hull(points, budget=HULL_MAX_VERTS):
+    """
+    simplified convex hull of an (N, 3) array, as a dict with 'verts' ((M, 3) array),
+    'faces' (normal, distance, loop), 'edges' and 'error'; None if the points are flat
+    """
+    budget = min(budget, HULL_MAX_VERTS)
+    hull = quickhull(np.asarray(points, dtype=np.float64), budget)
+    if hull is None:
+        return None
+    used, tris, error = hull
+    verts = np.asarray(points, dtype=np.float64)[used]
+    polys = merge_faces(verts, tris)
+    # vertices inside a merged polygon are on no face loop anymore
+    kept = sorted(set(i for normal, dist, loop in polys for i in loop))
+    remap = dict((v, i) for i, v in enumerate(kept))
+    polys = [(normal, dist, [remap[i] for i in loop]) for normal, dist, loop in polys]
+    return {'verts': verts[kept], 'faces': polys, 'edges': hull_edges(polys), 'error': error}
+
+def hull_volume(hull):
+    """ enclosed volume, from a fan of tetrahedra over every face polygon """
+    verts = hull['verts']
+    origin = verts.mean(axis=0)
+    volume = 0.0
+    for normal, dist, loop in hull['faces']:
+        pts = verts[loop] - origin
+        for k in range(1, len(loop) - 1):
+            volume += float(np.dot(pts[0], np.cross(pts[k], pts[k + 1])))
+    return abs(volume) / 6.0
+
+def serialize_hulls(hulls, transform):
+    """
+    returns the CONVEX, HULL_VERTEX, HULL_FACE, HULL_INDEX and HULL_EDGE section data;
+    transform maps a 3 sequence to the file's coordinates (a pure rotation)
+    """
+    conv, vert, face, index, edge = [], [], [], [], []
+    firsts = [0, 0, 0, 0]
+    for hull in hulls:
+        conv.append(struct.pack("IIIIHHHxx", firsts[0], firsts[1], firsts[2], firsts[3],
+                                len(hull['verts']), len(hull['faces']), len(hull['edges'])))
+        for v in hull['verts']:
+            vert.append(struct.pack("3f", *transform(v)))
+        first = 0
+        for normal, dist, loop in hull['faces']:
+            face.append(struct.pack("3ffHH", *(tuple(transform(normal)) + (dist, first, len(loop)))))
+            for i in loop:
+                index.append(struct.pack("H", i))
+            first += len(loop)
+        for e in hull['edges']:
+            edge.append(struct.pack("HHHH", *e))
+        firsts[0] += len(hull['verts'])
+        firsts[1] += len(hull['faces'])
+        firsts[2] += first
+        firsts[3] += len(hull['edges'])
+    return [b''.join(conv), b''.join(vert), b''.join(face), b''.join(index), b''.join(edge)]
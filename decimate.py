@@ -0,0 +1,244 @@
+import heapq
+import struct
+from math import sqrt
+
+try:
+    from .steps import EXPORT_CHUNK, run_steps
+except ImportError: # imported on its own, e.g. by the tests
+    from steps import EXPORT_CHUNK, run_steps
+
+"""
+Quadric error metric (QEM) decimation used to build LOD chains for the MDL and MSH exporters.
+
+Vertices are only ever collapsed onto one of their neighbours (half edge collapse),
+so every LOD is a new index list over the original vertex buffer.
+Locked vertices (uv seams, open borders) never move, and vertices only collapse
+onto vertices in the same group (e.g. with the same skinning bones), which keeps
+uv seams and skin weight boundaries intact.
+
+Written by the MDL and MSH exporters as two sections:
+
+LODS:
+    LOD * number of lods
+
+LOD:
+    4 byte: first face (index into LODF)
+    4 byte: number of faces
+    4 byte: error (float, model units)
+    2 byte: first submesh (index into LODM)
+    2 byte: number of submeshes
+    16
+
+LODF:
+    LOD_FACE * total number of LOD faces
+
+LOD_FACE:
+    6 byte: vertex indices (into the same vertex buffer as FACE)
+    2 byte: padding
+    8
+
+LODM:
+    SUBMESH * number of submeshes of all LODs (see blender_sharelib.py), face ranges over LODF
+
+Triangles keep the order of the faces they were decimated from, so the faces of
+every LOD stay sorted by material, and each LOD has its own range per material.
+"""
+
+def plane_quadric(p0, p1, p2):
+    """ quadric of the plane through a triangle, as its 10 unique coefficients """
+    ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+    vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+    nx, ny, nz = uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx
+    length = sqrt(nx * nx + ny * ny + nz * nz)
+    if length == 0.0:
+        return [0.0] * 10
+    a, b, c = nx / length, ny / length, nz / length
+    d = -(a * p0[0] + b * p0[1] + c * p0[2])
+    return [a * a, a * b, a * c, a * d,
+            b * b, b * c, b * d,
+            c * c, c * d,
+            d * d]
+
+def quadric_add(q, r):
+    return [a + b for a, b in zip(q, r)]
+
+def quadric_error(q, p):
+    x, y, z = p
+    return (q[0] * x * x + 2 * q[1] * x * y + 2 * q[2] * x * z + 2 * q[3] * x
+            + q[4] * y * y + 2 * q[5] * y * z + 2 * q[6] * y
+            + q[7] * z * z + 2 * q[8] * z
+            + q[9])
+
+def face_normal(p0, p1, p2):
+    ux, uy, uz = p1[0] - p0[0], p1[1] - p0[1], p1[2] - p0[2]
+    vx, vy, vz = p2[0] - p0[0], p2[1] - p0[1], p2[2] - p0[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+class Decimator(object):
+    """ iter_setup must have run before decimating """
+    def __init__(self, positions, tris, locked=(), groups=None):
+        self.positions = positions
+        self.tris = [list(t) for t in tris]
+        self.alive = [True] * len(self.tris)
+        self.nalive = len(self.tris)
+        self.locked = set(locked)
+        self.groups = groups
+        self.error = 0.0
+
+        self.vfaces = [set() for p in positions] # vertex -> incident triangles
+        self.quadrics = [[0.0] * 10 for p in positions]
+        self.stamp = [0] * len(positions)
+        self.heap = []
+
+    def iter_setup(self):
+        """ accumulates the quadrics and queues the first collapses, EXPORT_CHUNK elements per step """
+        total = max(len(self.tris) + len(self.positions), 1)
+        for fi, t in enumerate(self.tris):
+            if fi % EXPORT_CHUNK == 0:
+                yield fi / total
+            q = plane_quadric(*[self.positions[i] for i in t])
+            for i in t:
+                self.vfaces[i].add(fi)
+                self.quadrics[i] = quadric_add(self.quadrics[i], q)
+
+        self.locked.update(self.border_verts())
+        for u in range(len(self.positions)):
+            if u % EXPORT_CHUNK == 0:
+                yield (len(self.tris) + u) / total
+            self.push_collapses(u)
+
+    def border_verts(self):
+        edges = dict()
+        for t in self.tris:
+            for i in range(3):
+                e = (min(t[i], t[i - 1]), max(t[i], t[i - 1]))
+                edges[e] = edges.get(e, 0) + 1
+        return set(i for e, n in edges.items() if n == 1 for i in e)
+
+    def neighbours(self, u):
+        return set(i for fi in self.vfaces[u] for i in self.tris[fi] if i != u)
+
+    def can_collapse(self, u, v):
+        if u in self.locked:
+            return False
+        if self.groups is not None and self.groups[u] != self.groups[v]:
+            return False
+        # reject collapses that flip a remaining triangle
+        for fi in self.vfaces[u]:
+            t = self.tris[fi]
+            if v in t:
+                continue
+            before = face_normal(*[self.positions[i] for i in t])
+            after = face_normal(*[self.positions[v if i == u else i] for i in t])
+            if sum(a * b for a, b in zip(before, after)) <= 0.0:
+                return False
+        return True
+
+    def push_collapses(self, u):
+        """ queues the cheapest collapse of u onto a neighbour """
+        self.stamp[u] += 1
+        if u in self.locked or not self.vfaces[u]:
+            return
+        best = None
+        for v in self.neighbours(u):
+            if self.groups is not None and self.groups[u] != self.groups[v]:
+                continue
+            cost = quadric_error(quadric_add(self.quadrics[u], self.quadrics[v]), self.positions[v])
+            if best is None or cost < best[0]:
+                best = (cost, v)
+        if best is not None:
+            heapq.heappush(self.heap, (max(best[0], 0.0), self.stamp[u], u, best[1]))
+
+    def collapse(self, u, v):
+        for fi in list(self.vfaces[u]):
+            t = self.tris[fi]
+            if v in t: # triangle degenerates
+                self.alive[fi] = False
+                self.nalive -= 1
+                for i in t:
+                    self.vfaces[i].discard(fi)
+            else:
+                t[t.index(u)] = v
+                self.vfaces[v].add(fi)
+        self.vfaces[u] = set()
+        self.quadrics[v] = quadric_add(self.quadrics[u], self.quadrics[v])
+
+    def iter_decimate(self, target):
+        """
+        collapses edges until at most target triangles remain, or nothing can collapse,
+        EXPORT_CHUNK candidate collapses per step
+        """
+        start = self.nalive
+        popped = 0
+        while self.nalive > target and self.heap:
+            popped += 1
+            if popped % EXPORT_CHUNK == 0:
+                yield (start - self.nalive) / max(start - target, 1)
+            cost, stamp, u, v = heapq.heappop(self.heap)
+            if stamp != self.stamp[u] or not self.vfaces[u] or not self.vfaces[v]:
+                continue
+            if not self.can_collapse(u, v):
+                self.stamp[u] += 1 # drop u until a neighbour changes
+                continue
+            touched = self.neighbours(u) | self.neighbours(v)
+            self.collapse(u, v)
+            self.error = max(self.error, sqrt(cost))
+            self.stamp[u] += 1
+            for i in touched:
+                self.push_collapses(i)
+
+    def decimate(self, target):
+        run_steps(self.iter_decimate(target))
+
+    def triangles(self):
+        return [tuple(t) for t, alive in zip(self.tris, self.alive) if alive]
+
+    def faces(self):
+        """ index of the face each remaining triangle was decimated from """
+        return [fi for fi, alive in enumerate(self.alive) if alive]
+
+def iter_build_lods(positions, tris, ratios, locked=(), groups=None):
+    """
+    builds one LOD per ratio (fraction of the original triangle count, decreasing).
+    returns a list of (triangles, error, faces), faces holding the index in tris each
+    triangle was decimated from. error is in model units, the root of the summed
+    squared plane distances of the worst collapse so far, which bounds how far the
+    surface moved; the runtime projects it to screen space.
+    """
+    dec = Decimator(positions, tris, locked, groups)
+    for progress in dec.iter_setup():
+        yield 0.2 * progress
+    lods = []
+    for i, ratio in enumerate(ratios):
+        for progress in dec.iter_decimate(int(len(tris) * ratio)):
+            yield 0.2 + 0.8 * (i + progress) / len(ratios)
+        lods.append((dec.triangles(), dec.error, dec.faces()))
+    return lods
+
+def build_lods(positions, tris, ratios, locked=(), groups=None):
+    return run_steps(iter_build_lods(positions, tris, ratios, locked, groups))
+
+def seam_verts(keys):
+    """ indices of the vertices that share a key (source vertex) with another vertex """
+    count = dict()
+    for k in keys:
+        count[k] = count.get(k, 0) + 1
+    return [i for i, k in enumerate(keys) if count[k] > 1]
+
+def serialize_lod_table(lods, nsubmeshes):
+    """ nsubmeshes holds the number of LODM submeshes of each LOD """
+    buf = []
+    first = 0
+    firstsub = 0
+    for (tris, error, faces), count in zip(lods, nsubmeshes):
+        buf.append(struct.pack("IIfHH", first, len(tris), error, firstsub, count))
+        first += len(tris)
+        firstsub += count
+    return b''.join(buf)
+
+def serialize_lod_faces(lods):
+    buf = []
+    for tris, error, faces in lods:
+        for t in tris:
+            buf.append(struct.pack("HHHxx", t[0], t[1], t[2]))
+    return b''.join(buf)
@@ -1,25 +1,19 @@
-bl_info = {
-    "name":         "MDL File Format",
-    "author":       "Brandon Surmanski",
-    "blender":      (2,7,3),
-    "version":      (0,0,1),
-    "location":     "File > Import-Export",
-    "description":  "Export custom MDL format",
-    "category":     "Import-Export"
-}
-
-import bpy
-from bpy_extras.io_utils import ExportHelper
-from mathutils import *
-from math import *
 import struct
+import numpy as np
+
+from .blender_sharelib import (y_up_matrix, floats_to_ubyte, vec2s_to_uhvec2,
+                               vec3s_to_hvec3, is_trimesh, serialize_submeshes, serialize_lod_submeshes,
+                               SectionWriter, BUFFER_ALIGN,
+                               EXPORT_CHUNK, run_steps, scale_steps)
+from .decimate import iter_build_lods, seam_verts, serialize_lod_table, serialize_lod_faces
+from .mesh_codec import ENCODING_NONE, ENCODING_INDEX, ENCODING_VERTEX, encode_section
 
 """
 MDL file format export
 
 HEADER:
     3 byte: magic number (MDL)
-    1 byte: version number (5)
+    1 byte: version number (7)
     4 byte: number of verts
     4 byte: number of faces
     4 byte: number of edges
@@ -54,70 +48,19 @@ EDGE:
 
 MDL:
     HEADER,
-    VERTS,
-    FACES
+    SECTION_DIRECTORY (see blender_sharelib.py),
+    'VERT' section: VERT * number of verts (64 byte aligned),
+    'FACE' section: FACE * number of faces (64 byte aligned), sorted by material,
+    'SUBM' section: SUBMESH * number of materials used (see blender_sharelib.py),
+    'LODS', 'LODF', 'LODM' sections (optional): LOD chain as specified in decimate.py,
+                                                index ranges over VERT
 """
 
-slicesUvs = True
-
-#
-# SHARELIB
-#
-def normalizeAll():
-    for m in bpy.data.meshes:
-        for v in m.vertices:
-            sum = 0.0
-            for i in range(0, 3):
-                sum += v.co[i] * v.co[i]
-            sum = sqrt(sum)
-            for i in range(0, 3):
-                v.co[i] = v.co[i] / sum
-
-#sperically project onto plane z=1, produces x/y coords: {-1 <= x <= 1}
-def planet_co_to_uv():
-    sqrt2 = sqrt(2)
-    sqrt3inv = 1/sqrt(3)
-    for m in bpy.data.meshes:
-        for v in m.vertices:
-            ratio = 1 / v.co[2]
-            for i in range(0, 3):
-                v.co[i] = v.co[i] * (ratio)
-
-def float_to_ushort(val):
-    if val >= 1.0:
-        return 2**16-1
-    if val <= 0.0:
-        return 0
-    return int(floor(val * (2**16-1)))
-
-def float_to_short(val):
-    if val >= 1.0:
-        return 2**15-1
-    if val <= -1.0:
-        return -(2**15)+1
-    return int(round(val * (2**15-1)))
-
-def float_to_ubyte(val):
-    if val >= 1.0:
-        return 2**8-1
-    if val <= 0.0:
-        return 0
-    return int(round(val * (2**8-1)))
-
-def vec2_to_uhvec2(val):
-    return tuple((float_to_ushort(val[0]), float_to_ushort(val[1])))
-
-def vec3_to_hvec3(val):
-    return tuple((float_to_short(val[0]), float_to_short(val[1]), float_to_short(val[2])))
-
-def is_trimesh(mesh):
-    for face in mesh.tessfaces:
-        if len(face.vertices) > 3:
-            return False
-    return True
-
-#
 #
+# Exporting is split in two passes. extract_mdl_mesh reads everything needed from
+# blender into plain python data; encode_mdl_mesh turns that into the file without
+# touching bpy, so it can run in a worker process.
+# Both have an iter_ version, which works in steps (see steps.py).
 #
 
 def uv_entry_tuple(mesh, facei, uvi, sliceUvs):
@@ -126,50 +69,85 @@ def uv_entry_tuple(mesh, facei, uvi, sliceUvs):
     if mesh.tessface_uv_textures.active and sliceUvs:
         uvface = mesh.tessface_uv_textures.active.data[facei]
         uv_raw = (uvface.uv_raw[uvi * 2], uvface.uv_raw[uvi * 2 + 1])
-    uv = vec2_to_uhvec2(uv_raw)
-    entry = (face.vertices[uvi], uv[0], uv[1])
+    entry = (face.vertices[uvi], uv_raw[0], uv_raw[1])
     return entry
 
-def vert_list_entry_id(mesh, vert_list, entry):
-    if(entry not in vert_list):
-        vert_list.append(entry)
-    return vert_list.index(entry)
+def get_raw_face_list(mesh, sliceUvs, start=0, end=None):
+    lst = list()
+    for i in range(start, min(end or len(mesh.tessfaces), len(mesh.tessfaces))):
+        lst.append([uv_entry_tuple(mesh, i, j, sliceUvs) for j in range(3)])
+    return lst
+
+def get_face_materials(mesh):
+    return [face.material_index for face in mesh.tessfaces]
 
-def get_face_list(mesh, vert_list, sliceUvs):
+def sort_faces_by_material(raw_faces, materials):
+    """ faces and their materials, stably sorted by material """
+    order = sorted(range(len(raw_faces)), key=lambda i: materials[i])
+    return [raw_faces[i] for i in order], [materials[i] for i in order]
+
+def iter_face_list(raw_faces, materials, vert_list):
+    """
+    welds face corners with the same vertex, quantized uv and material into vert_list
+    entries, so the vertices of every material are contiguous; EXPORT_CHUNK faces per step
+    """
+    index = dict()
     lst = list()
-    for i in range(len(mesh.tessfaces)):
+    uvs = vec2s_to_uhvec2([(u, v) for face in raw_faces for vertid, u, v in face]).tolist()
+    corner = 0
+    for i, (face, material) in enumerate(zip(raw_faces, materials)):
+        if i % EXPORT_CHUNK == 0:
+            yield i / len(raw_faces)
         faceverts = list()
-        for j in range(3):
-            entry = uv_entry_tuple(mesh, i, j, sliceUvs)
-            faceverts.append(vert_list_entry_id(mesh, vert_list, entry))
+        for vertid, u, v in face:
+            uv = uvs[corner]
+            corner += 1
+            entry = (vertid, uv[0], uv[1], material)
+            if entry not in index:
+                index[entry] = len(vert_list)
+                vert_list.append(entry)
+            faceverts.append(index[entry])
         lst.append(faceverts)
     return lst
 
-def bone_weight_normalize(bones):
-    BONEW1 = 2; BONEW2 = 3
-    b_sum = bones[BONEW1] + bones[BONEW2]
-    if b_sum > 0:
-        bones[BONEW1] = float_to_ubyte(bones[BONEW1] / b_sum)
-        bones[BONEW2] = float_to_ubyte(bones[BONEW2] / b_sum)
-    else:
-        bones[BONEW1] = 0
-        bones[BONEW2] = 0
-    return bones
-
-def bone_id_of_group(obj, groupid, blist):
+def get_face_list(raw_faces, materials, vert_list):
+    return run_steps(iter_face_list(raw_faces, materials, vert_list))
+
+def get_mdl_vertex_order(obj, settings):
+    """ blender vertex index of every MDL vertex, in the order write_mdl_mesh stores them """
+    mesh = obj.data
+    mesh.update(calc_tessface=True)
+    if not is_trimesh(mesh):
+        raise Exception ("Mesh is not triangulated")
+    faces, materials = sort_faces_by_material(get_raw_face_list(mesh, settings['sliceUvs']),
+                                              get_face_materials(mesh))
+    vlist = list()
+    get_face_list(faces, materials, vlist)
+    return [vert[0] for vert in vlist]
+
+def bone_weight_normalize(weights):
+    """ (N, 2) bone weights to ubytes, scaled to sum to one """
+    weights = np.asarray(weights, dtype=np.float64).reshape(-1, 2)
+    w_sum = weights[:, 0] + weights[:, 1]
+    scaled = weights / np.where(w_sum > 0, w_sum, 1.0)[:, None]
+    return np.where((w_sum > 0)[:, None], floats_to_ubyte(scaled), 0).astype(np.uint8)
+
+def get_group_bone_ids(obj, blist):
+    """ maps vertex group index to bone id, for groups named after a bone """
     BONE = 3
-    nm = obj.vertex_groups[groupid].name
-    for i in range(0, len(blist)):
-        if(nm == blist[i][BONE].name):
-            print(nm + " is group " + str(i));
-            return i
-    return None
-
-def vert_get_bones(obj, vert, blist):
+    boneids = dict((blist[i][BONE].name, i) for i in range(len(blist)))
+    groups = dict()
+    for group in obj.vertex_groups:
+        if group.name in boneids:
+            groups[group.index] = boneids[group.name]
+    return groups
+
+def vert_get_bones(vert, group_bones):
+    """ the two most heavily weighted bones of a vertex, (id1, id2, weight1, weight2) """
     boneid = [255, 255]
     bonew = [0.0, 0.0]
     for group in vert.groups:
-        g_boneid = bone_id_of_group(obj, group.group, blist)
+        g_boneid = group_bones.get(group.group)
         if g_boneid != None:
             if group.weight > bonew[0]:
                 bonew[1] = bonew[0]
@@ -179,7 +157,7 @@ def vert_get_bones(obj, vert, blist):
             elif group.weight > bonew[1]:
                 bonew[1] = group.weight
                 boneid[1] = g_boneid
-    return bone_weight_normalize([boneid[0], boneid[1], bonew[0], bonew[1]])
+    return (boneid[0], boneid[1], bonew[0], bonew[1])
 
 def find_bone_parentid(arm, bone):
     if(bone.parent):
@@ -198,142 +176,154 @@ def get_bone_list(obj):
             blist.append([bone.name, i, pid, bone])
     return blist
 
-def write_mdl_header(buf, obj, vlist, flist, blist):
+def get_vert_list(obj, blist, start=0, end=None):
+    """ y up position, normal and bone weights of every vertex of the mesh (or of start to end) """
+    tmat = y_up_matrix() #turns verts right side up (+y)
+    group_bones = get_group_bone_ids(obj, blist)
+    verts = []
+    vertices = obj.data.vertices
+    for i in range(start, min(end or len(vertices), len(vertices))):
+        vert = vertices[i]
+        co = tmat * vert.co
+        norm = tmat * vert.normal
+        verts.append(((co[0], co[1], co[2]),
+                      (norm[0], norm[1], norm[2]),
+                      vert_get_bones(vert, group_bones)))
+    return verts
+
+def write_mdl_header(buf, mdl, vlist, flist):
     hfmt = "3sBIIIB15s"
 
-    header = struct.pack(hfmt, b"MDL", 5,
+    header = struct.pack(hfmt, b"MDL", 7,
                 len(vlist),
                 len(flist),
                 0, # number of edges (unimpl)
-                len(blist),#number of bones
-                bytes(obj.data.name, "UTF-8"))
+                mdl['nbones'],#number of bones
+                bytes(mdl['name'], "UTF-8"))
     assert(len(header) == 32)
     buf.append(header)
 
-def write_mdl_verts(buf, obj, vlist, blist):
-    rows = [[1, 0, 0, 0],
-            [0, 0, 1, 0],
-            [0,-1, 0, 0],
-            [0, 0, 0, 1]]
-    tmat = Matrix(rows)#Matrix.Rotation(-pi/2.0, 3, Vector((1,0,0))) #turns verts right side up (+y)
-    VERTID = 0; UV1 = 1; UV2 = 2
+MDL_VERT_FORMAT = "fffhhhHHHBBBBHxx"
+MDL_VERT_DTYPE = np.dtype([('co', '<f4', 3), ('normal', '<i2', 3), ('uv', '<u2', 2),
+                           ('material', '<u2'), ('boneid', 'u1', 2), ('bonew', 'u1', 2),
+                           ('edge', '<u2'), ('pad', 'V2')]) # same layout as MDL_VERT_FORMAT
+MDL_FACE_INDICES = (0, 1, 2) # index columns of FACE and LODF, for the index stream transform
+
+def write_mdl_verts(buf, mdl, vlist):
+    """ packs every vertex at once, quantizing with the array kernels of blender_sharelib """
+    VERTID = 0; UV1 = 1; UV2 = 2; MATERIAL = 3
+    CO = 0; NORMAL = 1; BONES = 2
     BONEID1 = 0; BONEID2 = 1; BONEW1 = 2; BONEW2 = 3
-    vfmt = "fffhhhHHHBBBBHxx"
-    for vert in vlist:
-        co = tmat * obj.data.vertices[vert[VERTID]].co
-        norm = vec3_to_hvec3(tmat * obj.data.vertices[vert[VERTID]].normal)
-        uv = tuple((vert[UV1], vert[UV2]))
-        bones = vert_get_bones(obj, obj.data.vertices[vert[VERTID]], blist)
-
-        vbits = struct.pack(vfmt, co[0], co[1], co[2],
-                            norm[0], norm[1], norm[2],
-                            uv[0], uv[1],
-                            0, #material ID (unimpl)
-                            bones[BONEID1], bones[BONEID2], #bone IDs
-                            bones[BONEW1], bones[BONEW2], #bone weights
-                            0) # incident edge (unimpl)
-        buf.append(vbits)
-
-def write_mdl_faces(buf, mesh, flist):
-        ffmt = 'HHHH'
-        for face in flist:
-            fbits = struct.pack(ffmt, face[0], face[1], face[2], 0) # last is incident edge (unimpl)
-            buf.append(fbits)
+    assert(MDL_VERT_DTYPE.itemsize == struct.calcsize(MDL_VERT_FORMAT))
+    if not vlist:
+        return
+    verts = [mdl['verts'][vert[VERTID]] for vert in vlist]
+    bones = np.array([v[BONES] for v in verts], dtype=np.float64)
+
+    vbits = np.zeros(len(vlist), dtype=MDL_VERT_DTYPE)
+    vbits['co'] = [v[CO] for v in verts]
+    vbits['normal'] = vec3s_to_hvec3([v[NORMAL] for v in verts])
+    vbits['uv'] = [(vert[UV1], vert[UV2]) for vert in vlist]
+    vbits['material'] = [vert[MATERIAL] for vert in vlist]
+    vbits['boneid'] = bones[:, BONEID1:BONEID2 + 1]
+    vbits['bonew'] = bone_weight_normalize(bones[:, BONEW1:BONEW2 + 1])
+    # incident edge (unimpl) stays 0
+    buf.append(vbits.tobytes())
+
+def write_mdl_faces(buf, flist):
+    """ packs every face at once, the last index is the incident edge (unimpl) """
+    fbits = np.zeros((len(flist), 4), dtype=np.uint16)
+    if flist:
+        fbits[:, :3] = flist
+    buf.append(fbits.tobytes())
 
 def write_mdl_edges(buf, mesh, elist):
     pass
 
-def write_mdl_mesh(obj, settings):
-    buf = []
+def iter_mdl_lods(mdl, vlist, flist):
+    """ decimated LOD chain over vlist, seams and skinning boundaries are kept """
+    VERTID = 0; CO = 0; BONES = 2
+    BONEID1 = 0; BONEID2 = 1
+    positions = [mdl['verts'][vert[VERTID]][CO] for vert in vlist]
+    locked = seam_verts([vert[VERTID] for vert in vlist])
+    groups = None
+    if mdl['nbones']:
+        groups = [mdl['verts'][vert[VERTID]][BONES][BONEID1:BONEID2 + 1] for vert in vlist]
+    return (yield from iter_build_lods(positions, flist, mdl['lodRatios'], locked, groups))
+
+def iter_extract_mdl_mesh(obj, settings):
+    """ reads the mesh of obj into plain python data, the only part that needs bpy """
     mesh = obj.data
     mesh.update(calc_tessface=True)
     if not is_trimesh(mesh):
         raise Exception ("Mesh is not triangulated")
 
-    vlist = list()
-    flist = get_face_list(mesh, vlist, settings['sliceUvs']) #modifies vlist (i know... bad)
     blist = get_bone_list(obj)
+    total = max(len(mesh.vertices) + len(mesh.tessfaces), 1)
+    verts = []
+    for start in range(0, len(mesh.vertices), EXPORT_CHUNK):
+        verts.extend(get_vert_list(obj, blist, start, start + EXPORT_CHUNK))
+        yield len(verts) / total
+    faces = []
+    for start in range(0, len(mesh.tessfaces), EXPORT_CHUNK):
+        faces.extend(get_raw_face_list(mesh, settings['sliceUvs'], start, start + EXPORT_CHUNK))
+        yield (len(verts) + len(faces)) / total
+
+    return {'name': mesh.name,
+            'nbones': len(blist),
+            'verts': verts,
+            'faces': faces,
+            'materials': get_face_materials(mesh),
+            'lodRatios': settings.get('lodRatios', []),
+            'compression': settings.get('compression', 'NONE'),
+            'meshCodec': settings.get('meshCodec', False)}
+
+def extract_mdl_mesh(obj, settings):
+    return run_steps(iter_extract_mdl_mesh(obj, settings))
+
+def iter_encode_mdl_mesh(mdl):
+    """ welds, quantizes and packs extracted mesh data into a MDL file """
+    VERTID = 0; CO = 0
+    vlist = list()
+    faces, materials = sort_faces_by_material(mdl['faces'], mdl['materials'])
+    flist = yield from scale_steps(iter_face_list(faces, materials, vlist), 0.0, 0.3) #modifies vlist
+    lods = []
+    if mdl['lodRatios']:
+        lods = yield from scale_steps(iter_mdl_lods(mdl, vlist, flist), 0.3, 0.6)
 
-    write_mdl_header(buf, obj, vlist, flist, blist)
-    write_mdl_verts(buf, obj, vlist, blist)
-    write_mdl_faces(buf, mesh, flist)
-    return b''.join(buf)
-
-
-# ExportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
-
-class MdlExport(Operator, ExportHelper):
-    """This appears in the tooltip of the operator and in the generated docs"""
-    bl_idname = "export.mdl"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Export Custom Model"
-
-    # ExportHelper mixin class uses this
-    filename_ext = ".mdl"
-
-    filter_glob = StringProperty(
-            default="*.mdl",
-            options={'HIDDEN'},
-            )
-
-    sliceUvs = BoolProperty(
-            name="Slice UV mapping",
-            description="If true, vertices will be split so there "
-                        "is one vertex entry per unique UV", 
-            default=True,)
-
-    # List of operator properties, the attributes will be assigned
-    # to the class instance from the operator settings before calling.
-    """
-    use_setting = BoolProperty(
-           name="Example Boolean",
-            description="Example Tooltip",
-            default=True,
-            )
-
-    type = EnumProperty(
-            name="Example Enum",
-            description="Choose between two items",
-            items=(('OPT_A', "First Option", "Description one"),
-                   ('OPT_B', "Second Option", "Description two")),
-            default='OPT_A',
-            )
-    """
-
-    def execute(self, context):
-        if not context.object.type == "MESH":
-            raise Exception("Mesh must be selected, " + context.object.type + " was given")
-
-        obj = context.object
-
-        f = open(self.filepath, 'wb')
-        obuf = write_mdl_mesh(obj, {'sliceUvs': self.sliceUvs})
-        f.write(obuf)
-        f.close()
-        return {'FINISHED'}
-
-
-# Only needed if you want to add into a dynamic menu
-def menu_func_export(self, context):
-    self.layout.operator(MdlExport.bl_idname, text="Custom Model (.mdl)")
-
-
-def register():
-    #bpy.utils.register_class(MdlExport)
-    bpy.utils.register_module(__name__)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
+    venc = ENCODING_VERTEX if mdl['meshCodec'] else ENCODING_NONE
+    fenc = ENCODING_INDEX if mdl['meshCodec'] else ENCODING_NONE
 
+    out = SectionWriter(6 if lods else 3, mdl['compression'])
+    buf = []
+    write_mdl_verts(buf, mdl, vlist)
+    out.section(b"VERT", encode_section(venc, b''.join(buf), 32, MDL_VERT_FORMAT),
+                32, len(vlist), BUFFER_ALIGN, True, venc)
+    yield 0.8
+    buf = []
+    write_mdl_faces(buf, flist)
+    out.section(b"FACE", encode_section(fenc, b''.join(buf), 8, MDL_FACE_INDICES),
+                8, len(flist), BUFFER_ALIGN, True, fenc)
+    positions = [mdl['verts'][vert[VERTID]][CO] for vert in vlist]
+    submeshes = serialize_submeshes(materials, flist, positions)
+    out.section(b"SUBM", submeshes, 48, len(submeshes) // 48)
+    if lods:
+        lodsubmeshes, counts = serialize_lod_submeshes(lods, materials, positions)
+        out.section(b"LODS", serialize_lod_table(lods, counts), 16, len(lods))
+        out.section(b"LODF", encode_section(fenc, serialize_lod_faces(lods), 8, MDL_FACE_INDICES), 8,
+                    sum(len(lod[0]) for lod in lods), BUFFER_ALIGN, True, fenc)
+        out.section(b"LODM", lodsubmeshes, 48, len(lodsubmeshes) // 48)
 
-def unregister():
-    bpy.utils.unregister_class(MdlExport)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
+    buf = []
+    write_mdl_header(buf, mdl, vlist, flist)
+    return out.finish(buf[0])
 
+def encode_mdl_mesh(mdl):
+    return run_steps(iter_encode_mdl_mesh(mdl))
 
-if __name__ == "__main__":
-    register()
+def iter_mdl_mesh(obj, settings):
+    mdl = yield from scale_steps(iter_extract_mdl_mesh(obj, settings), 0.0, 0.6)
+    return (yield from scale_steps(iter_encode_mdl_mesh(mdl), 0.6, 1.0))
 
-    # test call
-    #bpy.ops.export.mdl('INVOKE_DEFAULT')
+def write_mdl_mesh(obj, settings):
+    return run_steps(iter_mdl_mesh(obj, settings))
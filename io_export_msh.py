@@ -1,26 +1,13 @@
-bl_info = {
-    "name":         "MSH File Format",
-    "author":       "Brandon Surmanski",
-    "blender":      (2,7,3),
-    "version":      (0,0,2),
-    "location":     "File > Import-Export",
-    "description":  "Export custom MSH format",
-    "category":     "Import-Export"
-}
-
 import bpy
 import bmesh
-
-# ExportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
-from bpy_extras.io_utils import ExportHelper
-from mathutils import *
-from math import *
 import struct
-import bisect
+import numpy as np
+
+from .blender_sharelib import (y_up_matrix, float_to_short, float_to_ushort, vec3s_to_octvec2,
+                               serialize_submeshes, serialize_lod_submeshes, SectionWriter, BUFFER_ALIGN,
+                               EXPORT_CHUNK, run_steps, scale_steps)
+from .decimate import iter_build_lods, seam_verts, serialize_lod_table, serialize_lod_faces
+from .mesh_codec import ENCODING_NONE, ENCODING_INDEX, ENCODING_VERTEX, encode_section
 
 
 """
@@ -28,7 +15,7 @@ MSH file format export
 
 HEADER:
     3 byte: magic number (MDL)
-    1 byte: version number (6)
+    1 byte: version number (8)
     2 byte: number of verts
     2 byte: number of uvs
     2 byte: number of faces
@@ -57,11 +44,34 @@ UV:
     2 byte: padding
     8
 
+TANGENT:
+    4 byte: tangent, octahedral encoded (2 * signed short) (normalized from -32767 to 32767)
+    1 byte: bitangent sign (signed byte, 1 or -1), bitangent = sign * cross(normal, tangent)
+    3 byte: padding
+    8
+
+MikkTSpace tangents, as blender computes them for baking, so normal maps
+decode the way they were baked. Corners sharing a vertex and a uv but not
+a tangent frame get separate UV entries.
+
 FACE:
     6 byte: uv indices
     2 byte: edgeid
     8
 
+ADJACENCY: (triangle with adjacency, for geometry shaders)
+    2 byte: uvid of the face's first corner
+    2 byte: uvid of the vertex across the edge from the first to the second corner
+    2 byte: uvid of the second corner
+    2 byte: uvid of the vertex across the edge from the second to the third corner
+    2 byte: uvid of the third corner
+    2 byte: uvid of the vertex across the edge from the third to the first corner
+    12
+
+The vertex across an edge is the one of the neighbouring face not on the
+edge, as that face indexes it. Boundary edges (and edges shared by more than
+two faces) have 0xFFFF instead.
+
 EDGE:
     4 byte: vertid * 2
     4 byte: faceid * 2 (left, then right of vert[0])
@@ -73,43 +83,25 @@ EDGE:
 
 MSH:
     HEADER
-    'VERT'
-    VERTS
-    'UVUV'
-    UV
-    'FACE'
-    FACES
-    'EDGE'
-    EDGES
-    'BONE'
-    BONES
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'VERT' section: VERTS (64 byte aligned)
+    'UVUV' section: UVS (64 byte aligned)
+    'TANG' section (optional): TANGENT * number of uvs (64 byte aligned), one per uv entry
+    'FACE' section: FACES (64 byte aligned), sorted by material
+    'ADJC' section (optional): ADJACENCY * number of faces (64 byte aligned), in face order
+    'SUBM' section: SUBMESH * number of materials used (see blender_sharelib.py),
+                    vertex ranges over UVS
+    'EDGE' section: EDGES
+    'BONE' section: BONES
+    'LODS', 'LODF', 'LODM' sections (optional): LOD chain as specified in decimate.py,
+                                                index ranges over UVS
 """
 
-#
-# SHARELIB
-#
-
-def float_to_ushort(val):
-    if val >= 1.0:
-        return 2**16-1
-    if val <= 0.0:
-        return 0
-    return int(floor(val * (2**16-1)))
-
-def float_to_short(val):
-    if val >= 1.0:
-        return 2**15-1
-    if val <= -1.0:
-        return -(2**15)+1
-    return int(round(val * (2**15-1)))
-
-def float_to_ubyte(val):
-    if val >= 1.0:
-        return 2**8-1
-    if val <= 0.0:
-        return 0
-    return int(round(val * (2**8-1)))
-
+MSH_VERT_FORMAT = "fffhhhHHBBBBBBBBH"
+MSH_UV_INDICES = (2,) # index columns, for the index stream transform
+MSH_FACE_INDICES = (0, 1, 2)
+MSH_ADJACENCY_INDICES = (0, 1, 2, 3, 4, 5)
+MSH_ADJACENCY_NONE = 0xFFFF
 
 class Vert(object):
     def __init__(self, bmv):
@@ -119,14 +111,10 @@ class Vert(object):
         return getattr(self.bmv, name)
 
     def serialize(self):
-        rows = [[1, 0, 0, 0],
-                [0, 0, 1, 0],
-                [0,-1, 0, 0],
-                [0, 0, 0, 1]]
-        tmat = Matrix(rows)
+        tmat = y_up_matrix()
         co = tmat * self.bmv.co
         normal = tmat * self.bmv.normal
-        vpack = struct.pack("fffhhhHHBBBBBBBBH",
+        vpack = struct.pack(MSH_VERT_FORMAT,
                         co.x,
                         co.y,
                         co.z,
@@ -205,18 +193,20 @@ class Edge(object):
 
     
 class Uv(object):
-    def __init__(self, uvx, uvy, vindex, color, material=0):
+    def __init__(self, uvx, uvy, vindex, color, material=0, tangent=None):
         self.uvx = float_to_ushort(uvx)
         self.uvy = float_to_ushort(uvy)
         self.vindex = vindex
         self.color = color
         self.material = material
+        self.tangent = tangent # quantized (octahedral x, octahedral y, sign), if exported
 
     def __eq__(self, other):
-        return self.uvx == other.uvx and self.uvy == other.uvy and self.vindex == other.vindex
+        return (self.uvx == other.uvx and self.uvy == other.uvy and self.vindex == other.vindex and
+                self.tangent == other.tangent)
 
     def __hash__(self):
-        return self.vindex << 32 | self.uvx << 16 | self.uvy
+        return (self.vindex << 32 | self.uvx << 16 | self.uvy) ^ hash(self.tangent)
 
     def __repr__(self):
         return "(Uv " + str(self.uvx) + ", " + str(self.uvy) + ", " + str(self.vindex) + ", " + str(self.color) + ")"
@@ -228,6 +218,20 @@ class Uv(object):
         assert(len(pack) == 8)
         return pack
 
+    def serialize_tangent(self):
+        pack = struct.pack("hhb3x", *self.tangent)
+        assert(len(pack) == 8)
+        return pack
+
+
+def iter_pack(items, pack):
+    """ pack(item) of every item, joined; EXPORT_CHUNK items per step """
+    buf = []
+    for i, item in enumerate(items):
+        if i % EXPORT_CHUNK == 0:
+            yield i / len(items)
+        buf.append(pack(item))
+    return b''.join(buf)
 
 class Mesh(object):
     def __init__(self, mesh, settings):
@@ -250,16 +254,35 @@ class Mesh(object):
 
         for bmv in self.bm.verts:
             self.verts.append(Vert(bmv))
+        for bme in self.bm.edges:
+            self.edges.append(Edge(bme))
 
-        for bmf in self.bm.faces:
+    def __getattr__(self, name):
+        return getattr(self.bm, name)
+
+    def iter_build(self):
+        """ reads the faces and uvs, EXPORT_CHUNK faces per step """
+        tangents = None
+        if self.settings.get('tangents'):
+            tangents = self.calc_tangents()
+
+        # faces are sorted by material, uvs are then created in material order too.
+        # bmesh face indices follow the new order, as the edges refer to faces by index
+        # (tangents stay indexed by the order triangulate left the faces in)
+        order = sorted(enumerate(self.bm.faces), key=lambda item: item[1].material_index)
+        for i, (tri, bmf) in enumerate(order):
+            if i % EXPORT_CHUNK == 0:
+                yield i / len(order)
+            bmf.index = i
             f = Face(bmf)
 
             # make set of uvs for each face
-            for l in f.loops:
+            for k, l in enumerate(f.loops):
                 uvx = l[self.uv_layer].uv.x
                 uvy = l[self.uv_layer].uv.y
                 color = l[self.color_layer]
-                iuv = Uv(uvx, uvy, l.vert.index, color, f.material_index)
+                tangent = tangents[tri * 3 + k] if tangents else None
+                iuv = Uv(uvx, uvy, l.vert.index, color, f.material_index, tangent)
                 if iuv not in self.uvs:
                     iuv.index = len(self.uvs)
                     self.uvs[iuv] = iuv
@@ -267,45 +290,115 @@ class Mesh(object):
 
             self.faces.append(f)
 
-        for bme in self.bm.edges:
-            self.edges.append(Edge(bme))
-
-    def __getattr__(self, name):
-        return getattr(self.bm, name)
+    def calc_tangents(self):
+        """
+        quantized tangent frame of every face corner, 3 per triangle in face order.
+        The triangulated bmesh is copied to a temporary mesh to run blender's own MikkTSpace on it
+        """
+        tmp = bpy.data.meshes.new(self.mesh.name + ".tangents")
+        try:
+            self.bm.to_mesh(tmp)
+            tmp.calc_tangents(uvmap=self.uv_layer.name)
+            tangent = np.zeros(len(tmp.loops) * 3, dtype=np.float32)
+            sign = np.zeros(len(tmp.loops), dtype=np.float32)
+            tmp.loops.foreach_get("tangent", tangent)
+            tmp.loops.foreach_get("bitangent_sign", sign)
+        finally:
+            bpy.data.meshes.remove(tmp)
+        t = tangent.reshape(-1, 3).astype(np.float64)
+        octs = vec3s_to_octvec2(np.column_stack((t[:, 0], t[:, 2], -t[:, 1]))) # y up
+        signs = np.where(sign < 0.0, -1, 1)
+        return [(int(o[0]), int(o[1]), int(s)) for o, s in zip(octs, signs)]
 
     def serialize(self):
+        return run_steps(self.iter_serialize())
+
+    def iter_serialize(self):
+        lods = []
+        if self.settings.get('lodRatios'):
+            lods = yield from scale_steps(self.iter_build_lods(), 0.0, 0.4)
+
+        venc = ENCODING_VERTEX if self.settings.get('meshCodec') else ENCODING_NONE
+        ienc = ENCODING_INDEX if self.settings.get('meshCodec') else ENCODING_NONE
+
+        tangents = self.settings.get('tangents')
+        adjacency = self.settings.get('adjacency')
+        nsections = 6 + (3 if lods else 0) + (1 if tangents else 0) + (1 if adjacency else 0)
+        out = SectionWriter(nsections, self.settings.get('compression', 'NONE'))
+        uvs = self.uv_list()
+        data = yield from scale_steps(iter_pack(self.verts, Vert.serialize), 0.4, 0.5)
+        out.section(b"VERT", encode_section(venc, data, 32, MSH_VERT_FORMAT),
+                    32, len(self.verts), BUFFER_ALIGN, True, venc)
+        data = yield from scale_steps(iter_pack(uvs, Uv.serialize), 0.5, 0.6)
+        out.section(b"UVUV", encode_section(ienc, data, 8, MSH_UV_INDICES),
+                    8, len(self.uvs), BUFFER_ALIGN, True, ienc)
+        if tangents:
+            data = yield from scale_steps(iter_pack(uvs, Uv.serialize_tangent), 0.6, 0.65)
+            out.section(b"TANG", data, 8, len(self.uvs), BUFFER_ALIGN, True)
+        data = yield from scale_steps(iter_pack(self.faces, Face.serialize), 0.65, 0.75)
+        out.section(b"FACE", encode_section(ienc, data, 8, MSH_FACE_INDICES),
+                    8, len(self.faces), BUFFER_ALIGN, True, ienc)
+        if adjacency:
+            data = yield from scale_steps(iter_pack(self.faces, self.serialize_adjacency), 0.75, 0.85)
+            out.section(b"ADJC", encode_section(ienc, data, 12, MSH_ADJACENCY_INDICES),
+                        12, len(self.faces), BUFFER_ALIGN, True, ienc)
+        materials = [f.material_index for f in self.faces]
+        positions = self.submesh_positions()
+        submeshes = serialize_submeshes(materials, [f.uvs for f in self.faces], positions)
+        out.section(b"SUBM", submeshes, 48, len(submeshes) // 48)
+        data = yield from scale_steps(iter_pack(self.edges, Edge.serialize), 0.85, 1.0)
+        out.section(b"EDGE", data, 16, len(self.edges), compress=True)
+        out.section(b"BONE", b'', 0, len(self.bones)) # TODO bones
+        if lods:
+            lodsubmeshes, counts = serialize_lod_submeshes(lods, materials, positions)
+            out.section(b"LODS", serialize_lod_table(lods, counts), 16, len(lods))
+            out.section(b"LODF", encode_section(ienc, serialize_lod_faces(lods), 8, MSH_FACE_INDICES), 8,
+                        sum(len(lod[0]) for lod in lods), BUFFER_ALIGN, True, ienc)
+            out.section(b"LODM", lodsubmeshes, 48, len(lodsubmeshes) // 48)
+
+        return out.finish(self.serialize_header())
+
+    def submesh_positions(self):
+        """ y up position of every uv entry, for the submesh bounds """
+        positions = []
+        for uv in self.uv_list():
+            co = self.verts[uv.vindex].co
+            positions.append((co.x, co.z, -co.y)) # y up
+        return positions
+
+    def serialize_adjacency(self, f):
+        """ ADJACENCY record of face f """
         buf = []
-        buf.append(self.serialize_header())
-
-        buf.append(self.serialize_label("VERT"))
-        for v in self.verts:
-            buf.append(v.serialize())
-
-        buf.append(self.serialize_label("UVUV"))
-        for uv in self.uvs.values():
-            buf.append(uv.serialize())
-
-        buf.append(self.serialize_label("FACE"))
-        for f in self.faces:
-            buf.append(f.serialize())
-
-        buf.append(self.serialize_label("EDGE"))
-        for e in self.edges:
-            buf.append(e.serialize())
-
-        buf.append(self.serialize_label("BONE"))
-        # TODO bones
-
-        return b''.join(buf)
-
-    def serialize_label(self, label):
-        fmt = "4s"
-        pack = struct.pack(fmt, bytes(label, 'utf-8'))
+        for k, l in enumerate(f.loops):
+            buf.append(struct.pack("HH", f.uvs[k], self.opposite_uv(f, Edge(l.edge))))
+        pack = b''.join(buf)
+        assert(len(pack) == 12)
         return pack
 
+    def opposite_uv(self, f, edge):
+        """ uvid of the vertex across edge from face f, in the neighbouring face """
+        if len(edge.link_faces) != 2:
+            return MSH_ADJACENCY_NONE
+        other = self.faces[edge.get_faceid(1 if edge.get_faceid(0) == f.index else 0)]
+        ends = (edge.get_vertid(0), edge.get_vertid(1))
+        for k, l in enumerate(other.loops):
+            if l.vert.index not in ends:
+                return other.uvs[k]
+        return MSH_ADJACENCY_NONE
+
+    def uv_list(self):
+        """ uv entries in index order """
+        return sorted(self.uvs.values(), key=lambda uv: uv.index)
+
+    def iter_build_lods(self):
+        uvs = self.uv_list()
+        positions = [tuple(self.verts[uv.vindex].co) for uv in uvs]
+        locked = seam_verts([uv.vindex for uv in uvs])
+        return (yield from iter_build_lods(positions, [f.uvs for f in self.faces], self.settings['lodRatios'], locked))
+
     def serialize_header(self):
         hfmt = "3sBHHHHHxx15sB"
-        hpack = struct.pack(hfmt, b"MDL", 6,
+        hpack = struct.pack(hfmt, b"MDL", 8,
                     len(self.verts),
                     len(self.uvs),
                     len(self.faces),
@@ -315,57 +408,12 @@ class Mesh(object):
         assert(len(hpack) == 32)
         return hpack
 
-def serialize_mesh(obj, settings):
-    buf = []
+def iter_serialize_mesh(obj, settings):
     bpy.ops.object.mode_set(mode='OBJECT')
     print('serialize mesh...')
     mesh = Mesh(obj.data, settings)
-    return mesh.serialize()
-
-
-class MdlExport(Operator, ExportHelper):
-    """This appears in the tooltip of the operator and in the generated docs"""
-    bl_idname = "export.mdl"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Export Custom Model"
-
-    # ExportHelper mixin class uses this
-    filename_ext = ".msh"
+    yield from scale_steps(mesh.iter_build(), 0.0, 0.5)
+    return (yield from scale_steps(mesh.iter_serialize(), 0.5, 1.0))
 
-    filter_glob = StringProperty(
-            default="*.msh",
-            options={'HIDDEN'})
-
-    def execute(self, context):
-        if not context.object.type == "MESH":
-            raise Exception("Mesh must be selected, " + context.object.type + " was given")
-
-        obj = context.object
-
-        f = open(self.filepath, 'wb')
-        obuf = serialize_mesh(obj, {})
-        f.write(obuf)
-        f.close()
-        return {'FINISHED'}
-
-
-# Only needed if you want to add into a dynamic menu
-def menu_func_export(self, context):
-    self.layout.operator(MdlExport.bl_idname, text="Custom Model (.msh)")
-
-
-def register():
-    #bpy.utils.register_class(MdlExport)
-    bpy.utils.register_module(__name__)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
-
-
-def unregister():
-    bpy.utils.unregister_class(MdlExport)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
-
-
-if __name__ == "__main__":
-    register()
-
-    # test call
-    #bpy.ops.export.mdl('INVOKE_DEFAULT')
+def serialize_mesh(obj, settings):
+    return run_steps(iter_serialize_mesh(obj, settings))
@@ -1,112 +1,164 @@
-bl_info = {
-        "name": "PHY Physics Format",
-        "author": "Brandon Surmanski",
-        "blender": (2, 7, 3),
-        "version": (0, 0, 1),
-        "location": "File > Import-Export",
-        "description": "Export custom physics format",
-        "category": "Import-Export"
-}
-
 """
 PHY file format
 
 All transformations are relative to base object
 
+If the object has no collision children, primitives are generated: either the
+object's bounding box, or (for meshes) a set of PCA oriented boxes, k-means
+spheres or principal axis capsules fitted to the vertices, up to a primitive
+budget (see collision_fit.py). Skinned meshes can instead get one capsule per
+bone, along the bone, around the vertices mostly weighted to it (or the capsule
+fit, if no bone has weighted vertices), and any mesh can get its convex hull,
+up to a vertex budget (see convex_hull.py).
+
+Mesh children named hull or convex become convex hulls of their vertices.
+
+Objects with many primitives (e.g. building shells made of boxes) also get a BVH
+over the primitives' y up bounds, so queries against them are logarithmic.
+
+Capsule children are sized from their dimensions: the radius is half the larger
+of the x and y widths and the capsule runs along the child's local z axis.
+
+Bounds are computed over the primitives' extents and the mesh vertices: the header
+radius is the exact farthest distance from the object's origin, and the BSPH section
+holds the exact minimal bounding sphere (Welzl), whose center may be off the origin.
+
 HEADER:
     3 byte: magic number (PHY)
-    1 byte: version (1)
+    1 byte: version (4)
     2 byte: number of collision spheres
     2 byte: number of collision capsule
     2 byte: number of collision boxes
-    2 byte: padding
+    2 byte: number of convex hulls
     4 byte: float, bounding sphere radius (implicitly centered relative to base object location)
     16 byte: name
     32
 
 SPHERE:
-    12 byte: position (3 * 4 byte float)
+    12 byte: position (3 * 4 byte float) (y up like every other primitive, since version 4)
     4 byte: radius (float)
     16
 
 CAPSULE:
     12 byte: position (3 * 4 byte float)
     4 byte: radius (float)
-    4 byte: height (float)
-    12 byte: rotation (3 * float, quaternion x,y,z; implicit w)
+    4 byte: height (float, distance between the cap centers along the rotated y axis)
+    12 byte: rotation (3 * float, quaternion x,y,z; implicit positive w)
     32
 
 BOX:
     12 byte: position (3 * 4 byte float)
     12 byte: (3 * 4 byte float; dimensions, x y z)
-    12 byte: rotation (3 * float, quaternion x,y,z; implicit w)
+    12 byte: rotation (3 * float, quaternion x,y,z; implicit positive w)
     36
+
+BOUNDING_SPHERE:
+    12 byte: center (3 * 4 byte float)
+    4 byte: radius (float)
+    16
+
+PHY:
+    HEADER
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'BSPH' section: BOUNDING_SPHERE
+    'SPHR' section: SPHERE * number of collision spheres
+    'CAPS' section: CAPSULE * number of collision capsules
+    'BOXS' section: BOX * number of collision boxes
+    'CONV' section: CONVEX * number of convex hulls (see convex_hull.py)
+    'CVRT' section: HULL_VERTEX * total number of hull vertices
+    'CFAC' section: HULL_FACE * total number of hull faces
+    'CIDX' section: HULL_INDEX * total number of hull polygon indices
+    'CEDG' section: HULL_EDGE * total number of hull edges
+    'BVHN' section: BVH_NODE * number of nodes (see bvh.py), empty below the primitive threshold
+    'BVHR' section: PRIMITIVE_REF * number of references
+
+PRIMITIVE_REF:
+    2 byte: primitive type (0=sphere, 1=capsule, 2=box, 3=convex hull)
+    2 byte: index into that type's section
+    4
 """
 
-import bpy
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
-from mathutils import *
-from math import *
+from mathutils import Vector, Quaternion, Matrix
 import struct
+import numpy as np
+
+from .blender_sharelib import SectionWriter, run_steps, scale_steps, mesh_vertex_array, mesh_triangle_array
+from . import collision_fit
+from . import convex_hull
+from .bvh import build_bvh, BVH_NODE_SIZE
+
+PHY_SPHERE = 0
+PHY_CAPSULE = 1
+PHY_BOX = 2
+PHY_HULL = 3
 
-if "bpy" in locals():
-    import imp
-    if "export_phy" in locals():
-        imp.reload(export_phy)
+PHY_BVH_THRESHOLD = 16
+PHY_BVH_LEAF_SIZE = 2
 
+PHY_CHILD_NAMES = ('sphere', 'ball', 'capsule', 'pill', 'box', 'hull', 'convex')
 
+def is_collision_child(obj):
+    """ whether obj is read as a primitive of its parent's PHY """
+    return obj.name.split('.')[0] in PHY_CHILD_NAMES
 
-class PhyExport(Operator, ExportHelper):
-    bl_idname="export.phy"
-    bl_label="Export Physics Info"
-    filename_ext=".phy"
-    filter_glob=StringProperty(
-            default="*.phy",
-            options={'HIDDEN'},
-            )
 
-    boundingRadius = 0
-    spheres = []
-    capsules = []
-    boxes = []
+class Phy(object):
+    def __init__(self, obj, settings):
+        self.obj = obj
+        self.settings = settings
+        self.boundingRadius = 0
+        self.boundingSphere = (Vector(), 0.0)
+        self.spheres = []
+        self.capsules = []
+        self.boxes = []
+        self.hulls = []
 
-    def write_phy_header(self, f, obj):
-        hfmt = "3sBHHHxxf16s"
-        pak = struct.pack(hfmt, b"PHY", 1,
-                    len(self.spheres), len(self.capsules), len(self.boxes), self.boundingRadius,
+    def write_phy_header(self, buf, obj):
+        hfmt = "3sBHHHHf16s"
+        pak = struct.pack(hfmt, b"PHY", 4,
+                    len(self.spheres), len(self.capsules), len(self.boxes), len(self.hulls),
+                    self.boundingRadius,
                     obj.name.encode('UTF-8'))
-        f.write(pak)
+        buf.append(pak)
 
-    def write_phy_spheres(self, f, obj):
-        buf = []
+    def write_phy_bounds(self, buf, obj):
+        center, radius = self.boundingSphere
+        buf.append(struct.pack("3ff", center[0], center[2], -center[1], radius))
+
+    def write_phy_spheres(self, buf, obj):
         fmt = "3ff"
         for sphere in self.spheres:
             loc, radius = sphere # unpack tuple
-            pak = struct.pack(fmt, loc[0], -loc[2], loc[1], radius)
-            f.write(pak)
+            pak = struct.pack(fmt, loc[0], loc[2], -loc[1], radius)
+            buf.append(pak)
 
-    def write_phy_capsules(self, f, obj):
-        buf = []
+    def write_phy_capsules(self, buf, obj):
         fmt = "3fff3f"
         for capsule in self.capsules:
-            pass
-            #TODO
+            loc, radius, height, rot = capsule # unpack capsule tuple
+            if rot.w < 0.0: # same rotation, keeps the implicit w positive
+                rot = -rot
+            pak = struct.pack(fmt, loc[0], loc[2], -loc[1],
+                    radius, height,
+                    rot.x, rot.z, -rot.y)
+            buf.append(pak)
 
-    def write_phy_boxes(self, f, obj):
-        buf = []
+    def write_phy_boxes(self, buf, obj):
         fmt = "3f3f3f"
         for box in self.boxes:
             loc, dim, rot = box # unpack box tuple
+            if rot.w < 0.0: # same rotation, keeps the implicit w positive
+                rot = -rot
             pak = struct.pack(fmt, loc[0], loc[2], -loc[1],
                     dim[0], dim[2], dim[1],
                     rot.x, rot.z, -rot.y)
-            f.write(pak)
+            buf.append(pak)
 
-    def build_phy_lists(self, f, obj):
+    def iter_build_phy_lists(self, obj):
+        """ one step per collision child, or per fitted primitive """
         parentLocation = obj.location
-        for child in obj.children:
+        for i, child in enumerate(obj.children):
+            yield 0.5 * i / len(obj.children)
             relativeLocation = child.location - parentLocation
             childName = child.name.split('.')[0]
             if childName == 'sphere' or childName == 'ball':
@@ -114,50 +166,242 @@ class PhyExport(Operator, ExportHelper):
                 self.spheres.append([relativeLocation, radius])
                 self.boundingRadius = max(relativeLocation.length + radius, self.boundingRadius)
             elif childName == 'capsule' or childName == 'pill':
-                raise Exception("Capsule physics type not yet implemented")
-                pass
+                radius = max(child.dimensions[0], child.dimensions[1]) / 2.0
+                height = max(child.dimensions[2] - 2.0 * radius, 0.0)
+                self.capsules.append([relativeLocation, radius, height, child.rotation_euler.to_quaternion()])
+                self.boundingRadius = max(relativeLocation.length + radius + height / 2.0, self.boundingRadius)
             elif childName == 'box':
                 self.boxes.append([relativeLocation, child.dimensions, child.rotation_euler.to_quaternion()])
                 self.boundingRadius = max(relativeLocation.length + child.dimensions.length, self.boundingRadius)
-        if len(self.spheres) == 0 and len(self.capsules) == 0 and len(self.boxes) == 0:
-            loc = Vector()
-            dim = Vector()
-            # get location and dimension of bounding box
-            for v in obj.bound_box:
-                vert = Vector(v)
-                loc += vert
-                dim.x = max(dim.x, vert.x)
-                dim.y = max(dim.y, vert.y)
-                dim.z = max(dim.z, vert.z)
-            loc /= 8.0
-            dim -= loc
-            dim *= 2
-
-            self.boundingRadius = max(loc.length + dim.length, self.boundingRadius)
-            self.boxes.append([loc, dim, Quaternion([0,0,0,1])])
-
-    def execute(self, context):
-        #if not context.object.type == 'MESH':
-        #    raise Exception("Physics export only works for Mesh (for now). " + context.object.type + " was selected")
-        f = open(self.filepath, 'wb')
-        self.build_phy_lists(f, context.object)
-        self.write_phy_header(f, context.object)
-        self.write_phy_spheres(f, context.object)
-        self.write_phy_capsules(f, context.object)
-        self.write_phy_boxes(f, context.object)
-        f.close()
-        return {'FINISHED'}
-
-def menu_func_export(self, context):
-    self.layout.operator(PhyExport.bl_idname, text="Custom Physics Object (.phy)")
-
-def register():
-    bpy.utils.register_module(__name__)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
-
-def unregister():
-    bpy.utils.register_module(__name__)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
-
-if __name__ == "__main__":
-    register()
+            elif (childName == 'hull' or childName == 'convex') and child.type == 'MESH':
+                shape = np.array(child.matrix_local)[:3, :3] # rotation and scale
+                points = np.dot(mesh_vertex_array(child.data), shape.T) + np.array(relativeLocation)
+                self.append_hull(child, points)
+        if not (self.spheres or self.capsules or self.boxes or self.hulls):
+            if obj.type == 'MESH' and self.settings.get('fitShape', 'BOUNDS') != 'BOUNDS':
+                yield from scale_steps(self.iter_fit_phy_lists(obj), 0.5, 1.0)
+            else:
+                self.bound_box_phy_lists(obj)
+
+    def bound_box_phy_lists(self, obj):
+        loc = Vector()
+        dim = Vector()
+        # get location and dimension of bounding box
+        for v in obj.bound_box:
+            vert = Vector(v)
+            loc += vert
+            dim.x = max(dim.x, vert.x)
+            dim.y = max(dim.y, vert.y)
+            dim.z = max(dim.z, vert.z)
+        loc /= 8.0
+        dim -= loc
+        dim *= 2
+
+        self.boundingRadius = max(loc.length + dim.length, self.boundingRadius)
+        self.boxes.append([loc, dim, Quaternion([0,0,0,1])])
+
+    def iter_fit_phy_lists(self, obj):
+        """ fits primitives to the mesh vertices, reporting how tightly they enclose it """
+        points = mesh_vertex_array(obj.data)
+        if len(points) < collision_fit.FIT_MIN_POINTS:
+            self.bound_box_phy_lists(obj)
+            return
+
+        budget = self.settings.get('fitBudget', 1)
+        fitShape = self.settings['fitShape']
+        if fitShape == 'BONES' and obj.find_armature() is None:
+            fitShape = 'CAPSULE'
+        if fitShape == 'HULL':
+            hull = self.append_hull(obj, points)
+            if hull is None:
+                self.bound_box_phy_lists(obj)
+                return
+            fitted = [hull]
+            volume = convex_hull.hull_volume(hull)
+        elif fitShape == 'BONES':
+            fitted = yield from self.iter_fit_bone_capsules(obj, points)
+            if not fitted: # no vertex weights, or none of the groups is a bone
+                print("%s: no bone has weighted vertices, fitting capsules to the mesh" % obj.name)
+                fitted = yield from collision_fit.iter_fit_capsules(points, budget)
+                self.append_fitted_capsules(fitted)
+            volume = sum(collision_fit.capsule_volume(c) for c in fitted)
+        elif fitShape == 'CAPSULE':
+            fitted = yield from collision_fit.iter_fit_capsules(points, budget)
+            volume = sum(collision_fit.capsule_volume(c) for c in fitted)
+            self.append_fitted_capsules(fitted)
+        elif fitShape == 'SPHERE':
+            fitted = yield from collision_fit.iter_fit_spheres(points, budget)
+            volume = sum(collision_fit.sphere_volume(s) for s in fitted)
+            for center, radius in fitted:
+                loc = Vector(center)
+                self.spheres.append([loc, radius])
+                self.boundingRadius = max(loc.length + radius, self.boundingRadius)
+        else:
+            fitted = yield from collision_fit.iter_fit_boxes(points, budget)
+            volume = sum(collision_fit.box_volume(b) for b in fitted)
+            for center, dims, axes in fitted:
+                loc = Vector(center)
+                dim = Vector(dims)
+                rot = Matrix(axes.tolist()).to_quaternion()
+                self.boxes.append([loc, dim, rot])
+                self.boundingRadius = max(loc.length + dim.length, self.boundingRadius)
+
+        meshvol = collision_fit.mesh_volume(points, mesh_triangle_array(obj.data))
+        boundvol = collision_fit.aabb_volume(points)
+        print("%s: %d fitted primitives, tightness %.3f (bounding box %.3f)" %
+              (obj.name, len(fitted),
+               collision_fit.tightness(meshvol, volume),
+               collision_fit.tightness(meshvol, boundvol)))
+
+    def append_hull(self, obj, points):
+        """ adds the convex hull of points, returns it (None for flat point sets, which are skipped) """
+        hull = convex_hull.build_hull(points, self.settings.get('hullBudget', convex_hull.HULL_MAX_VERTS))
+        if hull is None:
+            print("%s: vertices are flat, no convex hull" % obj.name)
+            return None
+        print("%s: convex hull with %d vertices, %d faces, %.4f from the farthest left out vertex" %
+              (obj.name, len(hull['verts']), len(hull['faces']), hull['error']))
+        self.hulls.append(hull)
+        self.boundingRadius = max(float(np.sqrt((hull['verts'] ** 2).sum(axis=1)).max()), self.boundingRadius)
+        return hull
+
+    def append_fitted_capsules(self, fitted):
+        for center, radius, height, axes in fitted:
+            loc = Vector(center)
+            self.capsules.append([loc, radius, height, Matrix(axes.tolist()).to_quaternion()])
+            self.boundingRadius = max(loc.length + radius + height / 2.0, self.boundingRadius)
+
+    def iter_fit_bone_capsules(self, obj, points):
+        """ one capsule per bone along the bone, around the vertices weighted most to that bone, one step per bone """
+        arm = obj.find_armature()
+        bones = dict((bone.name, bone) for bone in arm.data.bones)
+        groupBones = dict((group.index, bones[group.name]) for group in obj.vertex_groups if group.name in bones)
+        members = dict()
+        for vert in obj.data.vertices:
+            best = max((g for g in vert.groups if g.group in groupBones), key=lambda g: g.weight, default=None)
+            if best is not None and best.weight > 0.0:
+                members.setdefault(best.group, []).append(vert.index)
+        if not members:
+            return []
+
+        toLocal = obj.matrix_world.inverted() * arm.matrix_world
+        fitted = []
+        for i, (group, verts) in enumerate(sorted(members.items())):
+            yield i / len(members)
+            if len(verts) < collision_fit.FIT_MIN_POINTS:
+                continue
+            bone = groupBones[group]
+            axis = toLocal * bone.tail_local - toLocal * bone.head_local
+            if axis.length == 0.0:
+                fitted.append(collision_fit.fit_capsule(points[verts]))
+            else:
+                fitted.append(collision_fit.fit_capsule(points[verts], tuple(axis)))
+        self.append_fitted_capsules(fitted)
+        return fitted
+
+    def primitive_shapes(self):
+        """
+        (type, index, points, radius) of every primitive, the primitive being the points
+        swept by a sphere of radius: sphere centers, capsule cap centers, box corners, hull vertices
+        """
+        shapes = []
+        for i, (loc, radius) in enumerate(self.spheres):
+            shapes.append((PHY_SPHERE, i, np.array([loc], dtype=np.float64), radius))
+        for i, (loc, radius, height, rot) in enumerate(self.capsules):
+            offset = np.dot(np.array(rot.to_matrix()), [0.0, 0.0, height / 2.0])
+            shapes.append((PHY_CAPSULE, i, np.array([np.array(loc) + offset, np.array(loc) - offset]), radius))
+        for i, (loc, dim, rot) in enumerate(self.boxes):
+            half = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)]) * np.array(dim) * 0.5
+            shapes.append((PHY_BOX, i, np.array(loc) + np.dot(half, np.array(rot.to_matrix()).T), 0.0))
+        for i, hull in enumerate(self.hulls):
+            shapes.append((PHY_HULL, i, hull['verts'], 0.0))
+        return shapes
+
+    def bvh_phy_lists(self):
+        """ BVH over the y up bounds of the primitives, if there are enough of them """
+        shapes = self.primitive_shapes()
+        threshold = self.settings.get('bvhThreshold', PHY_BVH_THRESHOLD)
+        if not threshold or len(shapes) < threshold:
+            return [], []
+        bounds = []
+        for kind, index, pts, radius in shapes:
+            pts = np.column_stack((pts[:, 0], pts[:, 2], -pts[:, 1])) # y up
+            bounds.append((tuple(pts.min(axis=0) - radius), tuple(pts.max(axis=0) + radius)))
+        nodes, refs = build_bvh(bounds, PHY_BVH_LEAF_SIZE)
+        print("%s: BVH with %d nodes over %d primitives" % (self.obj.name, len(nodes), len(shapes)))
+        return nodes, [shapes[r][:2] for r in refs]
+
+    def bound_phy_lists(self, obj):
+        """
+        replaces the bounding radius estimated while building the primitive lists by the
+        exact one, over box corners, sphere and capsule cap extents, hull and mesh vertices
+        """
+        balls = []
+        points = []
+        for kind, index, pts, radius in self.primitive_shapes():
+            if radius > 0.0:
+                balls.extend((p, radius) for p in pts)
+                points.extend(collision_fit.sphere_points(p, radius) for p in pts)
+            else:
+                points.append(pts)
+        if obj.type == 'MESH' and len(obj.data.vertices):
+            points.append(mesh_vertex_array(obj.data))
+        if not points:
+            return
+        points = np.concatenate(points)
+
+        center, radius = collision_fit.bounding_sphere(points)
+        originRadius = float(np.sqrt((points ** 2).sum(axis=1)).max())
+        # spheres and capsule caps are sampled, make sure they are fully inside
+        for loc, r in balls:
+            originRadius = max(originRadius, float(np.sqrt((loc ** 2).sum())) + r)
+            radius = max(radius, float(np.sqrt(((loc - center) ** 2).sum())) + r)
+
+        estimate = self.boundingRadius
+        print("%s: bounding radius %.3f (estimate %.3f, %.1f%% smaller), minimal sphere radius %.3f" %
+              (obj.name, originRadius, estimate,
+               100.0 * (1.0 - originRadius / estimate) if estimate > 0.0 else 0.0, radius))
+        self.boundingRadius = originRadius
+        self.boundingSphere = (Vector(center), radius)
+
+    def serialize(self):
+        return run_steps(self.iter_serialize())
+
+    def iter_serialize(self):
+        """ serialize, yielding progress after each of the fitting and writing stages """
+        yield from scale_steps(self.iter_build_phy_lists(self.obj), 0.0, 0.6)
+        self.bound_phy_lists(self.obj)
+        yield 0.8
+        out = SectionWriter(11, self.settings.get('compression', 'NONE'))
+        buf = []
+        self.write_phy_bounds(buf, self.obj)
+        out.section(b"BSPH", b''.join(buf), 16, 1)
+        buf = []
+        self.write_phy_spheres(buf, self.obj)
+        out.section(b"SPHR", b''.join(buf), 16, len(self.spheres))
+        buf = []
+        self.write_phy_capsules(buf, self.obj)
+        out.section(b"CAPS", b''.join(buf), 32, len(self.capsules))
+        buf = []
+        self.write_phy_boxes(buf, self.obj)
+        out.section(b"BOXS", b''.join(buf), 36, len(self.boxes))
+        conv, vert, face, index, edge = convex_hull.serialize_hulls(self.hulls, lambda v: (v[0], v[2], -v[1]))
+        out.section(b"CONV", conv, 24, len(self.hulls))
+        out.section(b"CVRT", vert, 12, len(vert) // 12, compress=True)
+        out.section(b"CFAC", face, 20, len(face) // 20, compress=True)
+        out.section(b"CIDX", index, 2, len(index) // 2, compress=True)
+        out.section(b"CEDG", edge, 8, len(edge) // 8, compress=True)
+        yield 0.9
+        nodes, refs = self.bvh_phy_lists()
+        out.section(b"BVHN", b''.join(node.serialize() for node in nodes), BVH_NODE_SIZE, len(nodes))
+        out.section(b"BVHR", b''.join(struct.pack("HH", kind, index) for kind, index in refs), 4, len(refs))
+
+        buf = []
+        self.write_phy_header(buf, self.obj)
+        return out.finish(buf[0])
+
+def iter_phy_object(obj, settings):
+    return Phy(obj, settings).iter_serialize()
+
+def write_phy_object(obj, settings):
+    return Phy(obj, settings).serialize()
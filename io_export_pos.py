@@ -1,15 +1,15 @@
-import bpy
-from bpy_extras.io_utils import ExportHelper
-from mathutils import *
-from math import *
+from mathutils import Matrix, Vector, Quaternion
+from math import pi
 import struct
 
+from .blender_sharelib import SectionWriter, run_steps, scale_steps
+
 """
 mesh pose library export
 
 HEADER:
     3 byte: magic number 'POS'
-    1 byte: version number (1)
+    1 byte: version number (2)
     1 byte: number of bones
     1 byte: number of poses/frames
     16 byte: pose name (including NULL byte)
@@ -33,8 +33,9 @@ BONE_HEADER:
 
 POS:
     HEADER
-    BONEs
-    BONE_POSEs (in order by ID, packed all of a bone's frames sequentially)
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'BONE' section: BONEs
+    'POSE' section: BONE_POSEs (in order by ID, packed all of a bone's frames sequentially)
 
 """
 
@@ -62,21 +63,21 @@ def get_bone_list(obj):
 """
 HEADER:
     3 byte: magic number 'POS'
-    1 byte: version number (1)
+    1 byte: version number (2)
     1 byte: number of bones
     1 byte: number of poses/frames
     16 byte: pose name
     10 byte: padding            TODO: pose name?
     32                          TODO: pose indexing (for multi-libraries)
 """
-def write_pos_header(f, obj, blist):
+def write_pos_header(buf, obj, blist):
     hfmt = "3sBBB15s" + 'x' * 11
     framerange = obj.find_armature().pose_library.frame_range
-    header = struct.pack(hfmt, b"POS", 1,
+    header = struct.pack(hfmt, b"POS", 2,
                 len(blist), #number of bones
                 int(framerange[1] - framerange[0] + 1), #number of poses
                 bytes(obj.find_armature().pose_library.name, "UTF-8"))
-    f.write(header)
+    buf.append(header)
 
 """
 BONE:
@@ -88,7 +89,7 @@ BONE:
     5  byte padding
     32
 """
-def write_pos_bones(file, obj, blist):
+def write_pos_bones(buf, obj, blist):
   tmat = Matrix.Rotation(-pi/2.0, 3, Vector((1,0,0))).to_4x4() #turns verts right side up (+y)
   bfmt = "ffffffBBBxxxxx"
   if(blist and len(blist) > 0):
@@ -107,7 +108,7 @@ def write_pos_bones(file, obj, blist):
                     b[BONEID], #ID
                     b[BONEPID], # parent ID
                     len(bone.children)) # nchildren
-      file.write(bbits)
+      buf.append(bbits)
 
 
 def set_channel(framen, channel, pos, rot, scale):
@@ -142,108 +143,49 @@ BONE_POSE:
     4 byte: scale factor (4 byte float)
     32
 """
-def write_pos_poses(f, obj, blist, settings):
+def iter_pos_poses(buf, obj, blist, settings):
+    """ write_pos_poses, yielding progress after each bone's frames """
     pfmt = "ffffffff"
     POS=0;ROT=1;SCL=2
     POSE_N = 2; POSE_IN_TUPLE = 1
     framerange = obj.find_armature().pose_library.frame_range
     
-    for bone in blist:
+    for n, bone in enumerate(blist):
         for i in range(int(framerange[0]), int(framerange[1])+1):        
             pose = get_bone_pose(bone, i)
             print(pose[ROT])
             pbits = struct.pack(pfmt,
             pose[ROT].x, -pose[ROT].z, pose[ROT].y, pose[ROT].w,    #convert WXYZ -> XZYW
             pose[POS].x, pose[POS].z, pose[POS].w, pose[SCL].length / 2.0) #sorry, linear scale only :(
-            f.write(pbits)
+            buf.append(pbits)
+        yield (n + 1) / len(blist)
 
-def write_pos_pose(context, filepath, settings):
-    if not context.object.type == "MESH":
-            raise Exception("Mesh must be selected, " + context.object.type + " was given")
+def write_pos_poses(buf, obj, blist, settings):
+    run_steps(iter_pos_poses(buf, obj, blist, settings))
 
-    obj = context.object
-    mesh = obj.data
+def iter_pos_pose(obj, settings):
+    if not obj.type == "MESH":
+        raise Exception("Mesh must be selected, " + obj.type + " was given")
 
-    if not obj.find_armature().type == "ARMATURE":
-        raise Exception("Mesh must have a parent Armature applied to it");
     arm = obj.find_armature()
+    if not arm or not arm.type == "ARMATURE":
+        raise Exception("Mesh must have a parent Armature applied to it")
+    if not arm.pose_library:
+        raise Exception("Armature must have a pose_library set in the sidepane")
 
     blist = get_bone_list(obj)
 
-    f = open(filepath, 'wb')
-    write_pos_header(f, obj, blist)
-    write_pos_bones(f, obj, blist)
-    write_pos_poses(f, obj, blist, settings)
-    f.close()
-    return {'FINISHED'}
-
-# ExportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
-
-class PosExport(Operator, ExportHelper):
-    """This appears in the tooltip of the operator and in the generated docs"""
-    bl_idname = "export.pos"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Export Custom Pose"
-
-    # ExportHelper mixin class uses this
-    filename_ext = ".pos"
-
-    filter_glob = StringProperty(
-            default="*.pos",
-            options={'HIDDEN'},
-            )
-
-    # List of operator properties, the attributes will be assigned
-    # to the class instance from the operator settings before calling.
-    poses = []
-    obj = bpy.context.object
-    if obj.type == "MESH":
-        arm = obj.find_armature()
-        if arm and arm.type == "ARMATURE":
-            assert(arm.pose_library and "please set pose_library in sidepane");
-            for pos in arm.pose_library.pose_markers:
-                poses.append((pos.name, pos.name, "_"))
-
-    use_setting = BoolProperty(
-           name="Append Pose Name",
-            description="Append the name of the pose to the filename",
-            default=True,
-            )
-
-    #type = EnumProperty (
-    #        name="Pose",
-    #        description="Choose Pose to Export",
-    #        items=tuple(poses),
-    #        default=poses[0][0],
-    #        )
-
-
-    def execute(self, context):
-        #TODO: use setting
-        return write_pos_pose(context, self.filepath, type)
-
-
-# Only needed if you want to add into a dynamic menu
-def menu_func_export(self, context):
-    #raise Exception(use_setting)
-    self.layout.operator(PosExport.bl_idname, text="Custom Pose (.pos)")
-
-
-def register():
-    bpy.utils.register_class(PosExport)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
-
-
-def unregister():
-    bpy.utils.unregister_class(PosExport)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
-
+    out = SectionWriter(2, settings.get('compression', 'NONE'))
+    buf = []
+    write_pos_bones(buf, obj, blist)
+    out.section(b"BONE", b''.join(buf), 32, len(blist))
+    buf = []
+    yield from scale_steps(iter_pos_poses(buf, obj, blist, settings), 0.0, 0.9)
+    out.section(b"POSE", b''.join(buf), 32, len(buf), compress=True)
 
-if __name__ == "__main__":
-    register()
+    buf = []
+    write_pos_header(buf, obj, blist)
+    return out.finish(buf[0])
 
-    # test call
-    bpy.ops.export.pos('INVOKE_DEFAULT')
\ No newline at end of file
+def write_pos_pose(obj, settings):
+    return run_steps(iter_pos_pose(obj, settings))
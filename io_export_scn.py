@@ -1,18 +1,19 @@
-bl_info = {
-    "name":         "SCN File Format",
-    "author":       "Brandon Surmanski",
-    "blender":      (2,7,3),
-    "version":      (0,0,2),
-    "location":     "File > Import-Export",
-    "description":  "Export custom SCN format",
-    "category":     "Import-Export"
-}
-
 import bpy
-from bpy_extras.io_utils import ExportHelper
-from mathutils import *
-from math import *
 import struct
+import hashlib
+import mmap
+import multiprocessing
+import sys
+from mathutils import Vector
+from math import floor
+
+from .blender_sharelib import (y_up_matrix, align_up, buf_align, SectionWriter, run_steps, scale_steps,
+                               read_section_directory)
+from .bvh import build_bvh, bounds_union
+from . import io_export_mdl
+from . import io_export_msh
+from . import io_export_phy
+from . import io_export_pos
 
 """
 SCN file format export
@@ -22,119 +23,541 @@ Requirements:
 
 HEADER:
     3 byte: magic number (SCN)
-    1 byte: version number (2)
-    2 byte: # entities
-    10 byte: padding
+    1 byte: version number (7)
+    2 byte: # entities (if top bit is '1', the streaming layout is used)
+    2 byte: # packed blobs
+    4 byte: offset of PACK table (from start of file, 0 if no packed data)
+    4 byte: offset of BVHN section (from start of file, 0 if no BVH)
     16 byte: name
     32
 
 ENT:
     2 byte: parent id (zero indexed, if top bit is '1', no parent)
-    6 byte: padding
+            (entities are ordered so a parent always precedes its children)
+    2 byte: model pack index (0xFFFF if none)
+    2 byte: physics pack index (0xFFFF if none)
+    2 byte: pose pack index (0xFFFF if none)
     12 byte: position
     12 byte: scale
     16 byte: quaternion rotation
     16 byte: name (trimmed blender object name)
     64
 
+ENT_ID:
+    4 byte: stable object id
+    4 byte: offset of the entity's ENT record (from start of file)
+    8
+
+Object ids are kept by the objects (as an 'scn_id' custom property) across
+exports, so tools can find an object's record in any SCN file, e.g. to
+rewrite its transform in place (see update_scn_transforms). A duplicated
+object copies its original's id; the original is told apart by the name the
+id was exported with ('scn_id_name'), and the copy gets a new id.
+
+CELL:
+    12 byte: bounds minimum (3 * 4 byte float, world space y up)
+    12 byte: bounds maximum (3 * 4 byte float)
+    2 byte: grid x (signed)
+    2 byte: grid z (signed)
+    2 byte: first entity
+    2 byte: # entities
+    4 byte: offset of cell chunk (from start of file, 16 byte aligned)
+    4 byte: size of cell chunk
+    8 byte: padding
+    48
+
+CELL_DIRECTORY:
+    4 byte: # cells
+    4 byte: cell size (float)
+    8 byte: padding
+    CELL * # cells
+
+CELL_CHUNK:
+    ENT * # entities of the cell
+    blobs only referenced by this cell (if packed per cell), each 16 byte aligned
+
+In the streaming layout entities are partitioned into a uniform grid over the
+x/z plane by the world position of their root object, so a hierarchy never
+spans cells. Cells are stored in order, so the entity table is still one
+contiguous, topologically ordered array when no blobs are packed per cell.
+Blobs shared between cells remain in the BLOB section.
+
+BVH:
+    'BVHN' section: BVH_NODE * # nodes (as specified in bvh.py, 32 bytes each)
+    'BVHR' section: 2 byte entity index * # entity references
+    SAH tree over the world space (y up) bounds of every entity
+
+PACK_ENTRY:
+    4 byte: type ('MDL', 'MSH', 'PHY' or 'POS', NULL padded)
+    4 byte: offset of blob (from start of file, 16 byte aligned)
+    4 byte: size of blob
+    4 byte: padding
+    16 byte: content hash (truncated sha1 of the blob, name field excluded)
+    32
+
+PACK:
+    'PACK' section: PACK_ENTRY * # packed blobs
+    'BLOB' section: blobs not stored in cell chunks, each padded to 16 bytes,
+                    in the format given by their type
+
+Blobs are content addressed; entities that share a mesh datablock, or
+hold identical geometry, reference the same blob.
+
+When exported with compression, the large sections inside packed blobs are
+compressed (see section_codec.py). Sections addressed by file offsets (ENTS,
+CELL, CHNK, BVHN, PACK, BLOB) are always stored as is.
 
 SCN:
     HEADER,
-    ENT
+    SECTION_DIRECTORY (see blender_sharelib.py),
+    'ENTS' section: ENT * # entities, or (streaming layout)
+    'CELL' section: CELL_DIRECTORY and 'CHNK' section: CELL_CHUNKs,
+    'EIDS' section: ENT_ID * # entities, in entity order,
+    BVH (optional),
+    PACK (optional)
 """
 
-def write_scn_header(buf, scene):
-    hfmt = "3sBH10x16s"
+SCN_NO_PARENT = 0x8000
+SCN_NO_PACK = 0xFFFF
+SCN_PACK_ALIGN = 16
+SCN_BVH_LEAF_SIZE = 4
+SCN_CELL_FLAG = 0x8000
+SCN_ID_PROPERTY = "scn_id"
+SCN_ID_NAME_PROPERTY = "scn_id_name" # name of the object the id was last exported with
+SCN_ENT_TRANSFORM = (8, 48) # byte range of position, scale and rotation in an ENT record
+SCN_ENT_NAME = (48, 64) # byte range of the name in an ENT record
+
+# byte range of the name field in each packed format's header.
+# excluded from the content hash so identical data under different names is shared
+SCN_PACK_NAME_FIELD = {
+    b"MDL": (17, 32),
+    b"MSH": (16, 31),
+    b"PHY": (16, 32),
+    b"POS": (6, 21),
+}
+
+class ScnPack(object):
+    def __init__(self):
+        self.entries = [] # (type, blob, hash)
+        self.hashes = dict() # content hash -> index
+        self.datablocks = dict() # (type, datablock key) -> index
+
+    def add(self, kind, blob):
+        start, end = SCN_PACK_NAME_FIELD[kind]
+        digest = hashlib.sha1(kind + blob[:start] + blob[end:]).digest()[:16]
+        if digest not in self.hashes:
+            if len(self.entries) >= SCN_NO_PACK:
+                raise Exception("Too many packed blobs in scene")
+            self.hashes[digest] = len(self.entries)
+            self.entries.append((kind, blob, digest))
+        return self.hashes[digest]
+
+    def add_datablock(self, kind, key, encode):
+        """ packs encode() once per datablock key, then dedups by content """
+        if (kind, key) not in self.datablocks:
+            self.datablocks[(kind, key)] = self.add(kind, encode())
+        return self.datablocks[(kind, key)]
+
+    def __len__(self):
+        return len(self.entries)
+
+def mesh_datablock_key(obj, settings):
+    # the encoded mesh also depends on the skinning setup of the object using it
+    arm = obj.find_armature()
+    return (obj.data.name,
+            arm.name if arm else None,
+            tuple(g.name for g in obj.vertex_groups),
+            settings['sliceUvs'])
+
+def iter_scn_ent_jobs(obj, settings, meshes, meshkeys):
+    """
+    first pass over an entity, reads everything that needs blender, in steps.
+    returns its (model, physics, pose) slots: each None, an encoded (type, blob),
+    or (type, index) of an extracted mesh in meshes still to be encoded.
+    """
+    model = physics = pose = None
+    if not settings or not settings.get('packData'):
+        return (model, physics, pose)
+
+    if obj.type == "MESH":
+        key = mesh_datablock_key(obj, settings)
+        if key not in meshkeys:
+            if settings['meshFormat'] == "MSH":
+                blob = yield from scale_steps(io_export_msh.iter_serialize_mesh(obj, settings), 0.0, 0.6)
+                meshkeys[key] = (b"MSH", blob)
+            else:
+                mesh = yield from scale_steps(io_export_mdl.iter_extract_mdl_mesh(obj, settings), 0.0, 0.6)
+                meshkeys[key] = (b"MDL", len(meshes))
+                meshes.append(mesh)
+        model = meshkeys[key]
+
+        if settings.get('packPoses'):
+            arm = obj.find_armature()
+            if arm and arm.pose_library:
+                pose = (b"POS", (yield from scale_steps(io_export_pos.iter_pos_pose(obj, settings), 0.6, 0.8)))
+
+    if settings.get('packPhysics'):
+        physics = (b"PHY", (yield from scale_steps(io_export_phy.iter_phy_object(obj, settings), 0.8, 1.0)))
+
+    return (model, physics, pose)
+
+def iter_encode_scn_meshes(meshes, workers):
+    """ encodes extracted MDL meshes, in a pool of worker processes if workers > 1 """
+    if workers > 1 and len(meshes) > 1 and sys.platform.startswith("linux"):
+        # forked workers only run encode_mdl_mesh, which never touches bpy. forking blender
+        # is only safe on linux, on macos its threads (cocoa, the gpu driver) can deadlock the child
+        pool = multiprocessing.get_context("fork").Pool(min(workers, len(meshes)))
+        try:
+            result = pool.map_async(io_export_mdl.encode_mdl_mesh, meshes, chunksize=1)
+            while not result.ready():
+                yield 0.5
+                result.wait(0.05)
+            return result.get()
+        except GeneratorExit: # cancelled
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+    blobs = []
+    for mesh in meshes:
+        blobs.append((yield from scale_steps(io_export_mdl.iter_encode_mdl_mesh(mesh),
+                                             len(blobs) / len(meshes), (len(blobs) + 1) / len(meshes))))
+    return blobs
+
+def encode_scn_meshes(meshes, workers):
+    return run_steps(iter_encode_scn_meshes(meshes, workers))
+
+def iter_pack_scn_ents(ents, settings):
+    """
+    returns the PACK contents and the (model, physics, pose) pack indices of each entity.
+    blobs are added in entity order after encoding, so the output does not depend on
+    the number of workers. steps are those of each entity's exporters, then of each mesh encoded
+    """
+    meshes = []
+    meshkeys = dict()
+    jobs = []
+    for obj in ents:
+        jobs.append((yield from scale_steps(iter_scn_ent_jobs(obj, settings, meshes, meshkeys),
+                                            0.5 * len(jobs) / len(ents), 0.5 * (len(jobs) + 1) / len(ents))))
+    blobs = yield from scale_steps(iter_encode_scn_meshes(meshes, settings.get('workers', 1) if settings else 1),
+                                   0.5, 1.0)
+
+    pack = ScnPack()
+    packids = []
+    for slots in jobs:
+        ids = []
+        for slot in slots:
+            if slot is None:
+                ids.append(SCN_NO_PACK)
+            elif slot[0] == b"MDL":
+                mesh = slot[1]
+                ids.append(pack.add_datablock(b"MDL", mesh, lambda: blobs[mesh]))
+            else:
+                ids.append(pack.add(slot[0], slot[1]))
+        packids.append(tuple(ids))
+    return pack, packids
+
+def pack_scn_ents(ents, settings):
+    return run_steps(iter_pack_scn_ents(ents, settings))
+
+def write_scn_header(buf, scene, ents, cells, pack, packofs, bvhofs):
+    """ fills in the header, buf[0] is reserved for it until section offsets are known """
+    hfmt = "3sBHHII16s"
     header = struct.pack(hfmt,
                          b"SCN",
-                         1,
-                         len(scene.objects), # count objects in scene
+                         7,
+                         len(ents) | (SCN_CELL_FLAG if cells else 0),
+                         len(pack),
+                         packofs,
+                         bvhofs,
                          bytes(scene.name, "UTF-8"))
-    buf.append(header)
-
-def write_scn_ent(buf, obj):
-    fmt = "H6x3f3f4f16s"
-    tmat = Matrix([[ 1, 0, 0, 0],
-                   [ 0, 0, 1, 0],
-                   [ 0,-1, 0, 0],
-                   [ 0, 0, 0, 1]])
+    buf[0] = header
+
+def get_scn_ent_list(scene):
+    """ all objects in the scene, in topological order (parents before children) """
+    children = dict()
+    roots = []
+    for obj in scene.objects:
+        children[obj.name] = []
+    for obj in scene.objects:
+        if obj.parent and obj.parent.name in children:
+            children[obj.parent.name].append(obj)
+        else:
+            roots.append(obj)
+
+    ents = roots
+    i = 0
+    while i < len(ents): # breadth first, ents grows as children are appended
+        ents.extend(children[ents[i].name])
+        i += 1
+
+    if len(ents) >= SCN_NO_PARENT:
+        raise Exception("Too many objects in scene (" + str(len(ents)) + ")")
+    return ents
+
+def get_scn_ent_index(ents):
+    return dict((obj.name, i) for i, obj in enumerate(ents))
+
+def get_scn_id_owner(objs):
+    """
+    the object keeping an id shared by objs (an original and its duplicates): the one
+    still named as when the id was exported, else (e.g. after renaming) the first by name
+    """
+    for obj in objs:
+        if obj.get(SCN_ID_NAME_PROPERTY) == obj.name:
+            return obj
+    return min(objs, key=lambda obj: obj.name)
+
+def assign_scn_ent_ids(ents):
+    """
+    stable id of every entity, stored on the object the first time it is exported.
+    duplicated objects copy their original's id, all but its owner get a new one
+    """
+    holders = dict()
+    fresh = []
+    for obj in sorted(bpy.data.objects, key=lambda obj: obj.name):
+        entid = obj.get(SCN_ID_PROPERTY)
+        if entid is None:
+            fresh.append(obj)
+        else:
+            holders.setdefault(entid, []).append(obj)
+    for entid, objs in holders.items():
+        owner = get_scn_id_owner(objs)
+        fresh.extend(obj for obj in objs if obj is not owner)
+    nextid = max(list(holders) + [0]) + 1
+    names = set(obj.name for obj in ents)
+    for obj in sorted(fresh, key=lambda obj: obj.name):
+        if obj.name in names:
+            obj[SCN_ID_PROPERTY] = nextid
+            nextid += 1
+    for obj in ents:
+        if obj.get(SCN_ID_NAME_PROPERTY) != obj.name:
+            obj[SCN_ID_NAME_PROPERTY] = obj.name
+    return [obj[SCN_ID_PROPERTY] for obj in ents]
+
+def pack_scn_ent_transform(obj):
+    """ position, scale and rotation of an ENT record """
+    tmat = y_up_matrix()
     pos = tmat * obj.location
     rot = obj.rotation_euler.to_quaternion() #needs to be rotated; done below
-    eheader = struct.pack(fmt,
-                          0,
-                          pos.x, pos.y, pos.z,
-                          obj.scale[1], obj.scale[2], obj.scale[0],
-                          rot.x, rot.z, -rot.y, rot.w,
-                          bytes(obj.name.split('.')[0], "UTF-8")) # splitting name to remove .001 qualifier
-    buf.append(eheader)
+    return struct.pack("3f3f4f",
+                       pos.x, pos.y, pos.z,
+                       obj.scale[1], obj.scale[2], obj.scale[0],
+                       rot.x, rot.z, -rot.y, rot.w)
 
-def write_scn_ents(buf, scene):
-    objs = []
-    for obj in scene.objects: # build list of roots
-        if not obj.parent:
-            objs.append(obj)
+def pack_scn_ent_name(obj):
+    """ name of an ENT record, without the .001 qualifier """
+    return struct.pack("16s", bytes(obj.name.split('.')[0], "UTF-8"))
 
-    cnt = 0
-    for obj in objs:
-        cnt = write_scn_ent(buf, obj)
+def write_scn_ent(buf, obj, parentid, packids):
+    eheader = (struct.pack("HHHH", parentid, packids[0], packids[1], packids[2]) +
+               pack_scn_ent_transform(obj) +
+               pack_scn_ent_name(obj))
+    assert(len(eheader) == 64)
+    buf.append(eheader)
 
+def update_scn_transforms(path, objs):
+    """
+    rewrites the position, scale and rotation of objs in an existing SCN file in place,
+    through a memory map, finding their records by stable id. returns the objects not in
+    the file, which includes objects sharing their id with a duplicate (until the SCN is
+    rewritten, the record is either's) and objects whose name does not match the record.
+    the bounds of the BVH and cells are left as they were
+    """
+    start, end = SCN_ENT_TRANSFORM
+    namestart, nameend = SCN_ENT_NAME
+    holders = dict()
+    for obj in bpy.data.objects:
+        entid = obj.get(SCN_ID_PROPERTY)
+        holders[entid] = holders.get(entid, 0) + 1
+    missing = []
+    with open(path, 'r+b') as f:
+        sections = read_section_directory(f)
+        if b"EIDS" not in sections:
+            return list(objs)
+        offset, size, stride, count, codec, transform = sections[b"EIDS"]
+        mm = mmap.mmap(f.fileno(), 0)
+        try:
+            ids = struct.unpack_from("%dI" % (2 * count), mm, offset)
+            records = dict(zip(ids[0::2], ids[1::2]))
+            for obj in objs:
+                entid = obj.get(SCN_ID_PROPERTY)
+                record = records.get(entid)
+                if (record is None or holders.get(entid) != 1 or
+                        mm[record + namestart:record + nameend] != pack_scn_ent_name(obj)):
+                    missing.append(obj)
+                else:
+                    mm[record + start:record + end] = pack_scn_ent_transform(obj)
+            mm.flush()
+        finally:
+            mm.close()
+    if b"BVHN" in sections or b"CELL" in sections:
+        print("update_scn_transforms: " + path + " BVH and cell bounds were not updated")
+    return missing
 
-def write_scn_data(buf, scene):
-    write_scn_ents(buf, scene)
+def write_scn_ents(buf, ents, packids, index):
+    for i, obj in enumerate(ents):
+        parentid = SCN_NO_PARENT
+        if obj.parent and obj.parent.name in index:
+            parentid = index[obj.parent.name]
+        write_scn_ent(buf, obj, parentid, packids[i])
 
-def write_scn_scene(context, settings):
-    buf = []
-    write_scn_header(buf, context.scene)
-    write_scn_data(buf, context.scene)
+def get_scn_ent_bounds(obj):
+    """ world space (y up) axis aligned bounds of an entity, from its bound_box """
+    mat = y_up_matrix() * obj.matrix_world
+    corners = [mat * Vector(c) for c in obj.bound_box]
+    bmin = tuple(min(c[i] for c in corners) for i in range(3))
+    bmax = tuple(max(c[i] for c in corners) for i in range(3))
+    return (bmin, bmax)
 
-    return b''.join(buf)
+def write_scn_bvh(out, ents):
+    """ writes the BVHN and BVHR sections, returns the offset of the nodes """
+    nodes, refs = build_bvh([get_scn_ent_bounds(obj) for obj in ents], SCN_BVH_LEAF_SIZE)
+    bvhofs = out.section(b"BVHN", b''.join(node.serialize() for node in nodes), 32, len(nodes))
+    out.section(b"BVHR", struct.pack("%dH" % len(refs), *refs), 2, len(refs))
+    return bvhofs
 
+def get_scn_cells(ents, cellsize):
+    """
+    partitions entities into grid cells by the world position of their root.
+    returns the list of (grid x, grid z, entities) in cell order; entities keep
+    their relative (topological) order within a cell.
+    """
+    tmat = y_up_matrix()
+    cellof = dict()
+    cells = dict()
+    for obj in ents:
+        if obj.parent and obj.parent.name in cellof:
+            key = cellof[obj.parent.name]
+        else:
+            pos = tmat * obj.matrix_world.to_translation()
+            key = (int(floor(pos.x / cellsize)), int(floor(pos.z / cellsize)))
+            if not all(-2**15 <= k < 2**15 for k in key):
+                raise Exception("Object " + obj.name + " is outside the cell grid, increase the cell size")
+        cellof[obj.name] = key
+        cells.setdefault(key, []).append(obj)
+    return [(key[0], key[1], cells[key]) for key in sorted(cells)]
 
-# ExportHelper is a helper class, defines filename and
-# invoke() function which calls the file selector.
-from bpy_extras.io_utils import ExportHelper
-from bpy.props import StringProperty, BoolProperty, EnumProperty
-from bpy.types import Operator
+def write_scn_blobs(buf, pack, ids, placed):
+    """ writes the given blobs, each aligned, recording their file offsets in placed """
+    for i in ids:
+        placed[i] = buf_align(buf, SCN_PACK_ALIGN)
+        buf.append(pack.entries[i][1])
 
-class ScnExport(Operator, ExportHelper):
-    """This appears in the tooltip of the operator and in the generated docs"""
-    bl_idname = "export.scn"  # important since its how bpy.ops.import_test.some_data is constructed
-    bl_label = "Export Custom Scene"
+def write_scn_cells(out, ents, packids, index, cells, pack, placed, entofs, settings):
+    """
+    writes the CELL directory and CHNK sections.
+    blobs private to a cell go into its chunk, their offsets are recorded in placed,
+    the offsets of the ENT records in entofs
+    """
+    users = dict() # blob -> cells using it
+    first = 0
+    for ci, (gx, gz, cellents) in enumerate(cells):
+        for ids in packids[first:first + len(cellents)]:
+            for i in ids:
+                if i != SCN_NO_PACK:
+                    users.setdefault(i, set()).add(ci)
+        first += len(cellents)
 
-    # ExportHelper mixin class uses this
-    filename_ext = ".scn"
+    buf = out.buf
+    dirofs = out.begin()
+    dirslot = len(buf)
+    buf.append(bytes(16 + 48 * len(cells))) # directory, filled in once chunks are placed
+    out.end(b"CELL", dirofs, 0, len(cells))
 
-    filter_glob = StringProperty(
-            default="*.scn",
-            options={'HIDDEN'},
-            )
+    directory = [struct.pack("If8x", len(cells), settings['cellSize'])]
+    chunksofs = out.begin()
+    first = 0
+    for ci, (gx, gz, cellents) in enumerate(cells):
+        cellids = packids[first:first + len(cellents)]
+        chunkofs = buf_align(buf, SCN_PACK_ALIGN)
+        entofs.extend(chunkofs + 64 * i for i in range(len(cellents)))
+        write_scn_ents(buf, cellents, cellids, index)
+        if settings.get('packCells'):
+            private = sorted(set(i for ids in cellids for i in ids
+                                 if i != SCN_NO_PACK and users[i] == set([ci])))
+            write_scn_blobs(buf, pack, private, placed)
+        chunksize = out.size() - chunkofs
 
-    def execute(self, context):
-        f = open(self.filepath, 'wb')
-        obuf = write_scn_scene(context, None)
-        f.write(obuf)
-        f.close()
+        bmin, bmax = bounds_union([get_scn_ent_bounds(obj) for obj in cellents])
+        directory.append(struct.pack("3f3fhhHHII8x",
+                    bmin[0], bmin[1], bmin[2],
+                    bmax[0], bmax[1], bmax[2],
+                    gx, gz, first, len(cellents),
+                    chunkofs, chunksize))
+        first += len(cellents)
+    out.end(b"CHNK", chunksofs, 0, len(cells))
+    buf[dirslot] = b''.join(directory)
 
-        return {'FINISHED'}
+def write_scn_pack(out, pack, placed):
+    """
+    writes the PACK table and the BLOB section with the blobs not already
+    placed in a cell chunk, returns the offset of the table
+    """
+    offset = out.begin()
+    blobofs = align_up(offset + 32 * len(pack), SCN_PACK_ALIGN)
+    table = []
+    for i, (kind, blob, digest) in enumerate(pack.entries):
+        if i in placed:
+            table.append(struct.pack("4sII4x16s", kind, placed[i], len(blob), digest))
+        else:
+            table.append(struct.pack("4sII4x16s", kind, blobofs, len(blob), digest))
+            blobofs = align_up(blobofs + len(blob), SCN_PACK_ALIGN)
+    out.buf.extend(table)
+    out.end(b"PACK", offset, 32, len(pack))
 
+    blobs = [i for i in range(len(pack)) if i not in placed]
+    blobsofs = out.begin(SCN_PACK_ALIGN)
+    for i in blobs:
+        blob = pack.entries[i][1]
+        out.buf.append(blob)
+        out.buf.append(bytes(align_up(len(blob), SCN_PACK_ALIGN) - len(blob)))
+    out.end(b"BLOB", blobsofs, 0, len(blobs))
+    return offset
 
-# Only needed if you want to add into a dynamic menu
-def menu_func_export(self, context):
-    self.layout.operator(ScnExport.bl_idname, text="Custom Scene (.scn)")
+def write_scn_data(out, scene, ents, cells, pack, packids, settings):
+    """ writes every section, returns (pack offset, bvh offset) """
+    index = get_scn_ent_index(ents)
+    placed = dict() # blob -> file offset, for blobs stored in cell chunks
+    entofs = []
+    if cells:
+        write_scn_cells(out, ents, packids, index, cells, pack, placed, entofs, settings)
+    else:
+        offset = out.begin()
+        write_scn_ents(out.buf, ents, packids, index)
+        out.end(b"ENTS", offset, 64, len(ents))
+        entofs = [offset + 64 * i for i in range(len(ents))]
+    eids = [struct.pack("II", entid, ofs) for entid, ofs in zip(assign_scn_ent_ids(ents), entofs)]
+    out.section(b"EIDS", b''.join(eids), 8, len(ents))
 
+    bvhofs = 0
+    if scn_has_bvh(ents, settings):
+        bvhofs = write_scn_bvh(out, ents)
 
-def register():
-    bpy.utils.register_class(ScnExport)
-    bpy.types.INFO_MT_file_export.append(menu_func_export)
+    packofs = 0
+    if len(pack):
+        packofs = write_scn_pack(out, pack, placed)
+    return packofs, bvhofs
 
+def scn_has_bvh(ents, settings):
+    return bool(settings and settings.get('buildBvh') and ents)
 
-def unregister():
-    bpy.utils.unregister_class(ScnExport)
-    bpy.types.INFO_MT_file_export.remove(menu_func_export)
+def iter_scn_scene(scene, settings):
+    ents = get_scn_ent_list(scene)
+    cells = None
+    if settings and settings.get('streamCells'):
+        cells = get_scn_cells(ents, settings['cellSize'])
+        ents = [obj for gx, gz, cellents in cells for obj in cellents]
+    pack, packids = yield from scale_steps(iter_pack_scn_ents(ents, settings), 0.0, 0.9)
 
+    nsections = (2 if cells else 1) + 1 + (2 if scn_has_bvh(ents, settings) else 0) + (2 if len(pack) else 0)
+    out = SectionWriter(nsections, settings.get('compression', 'NONE') if settings else 'NONE')
+    packofs, bvhofs = write_scn_data(out, scene, ents, cells, pack, packids, settings)
+    buf = [None]
+    write_scn_header(buf, scene, ents, cells, pack, packofs, bvhofs)
 
-if __name__ == "__main__":
-    register()
+    return out.finish(buf[0])
 
-    # test call
-    #bpy.ops.export.scn('INVOKE_DEFAULT')
+def write_scn_scene(scene, settings):
+    return run_steps(iter_scn_scene(scene, settings))
@@ -0,0 +1,110 @@
+import bpy
+import struct
+import numpy as np
+
+from .blender_sharelib import (vec3s_to_hvec3, y_up_array, mesh_vertex_array, mesh_normal_array,
+                               mesh_evaluated_arrays, SectionWriter, run_steps, scale_steps)
+from .mesh_codec import FRAME_DTYPE, encode_frame
+from . import io_export_mdl
+from . import io_export_msh
+
+"""
+SEQ file format export
+
+An animated mesh (e.g. a cloth or simulation cache) over the scene's frame
+range. Topology, uvs, faces and skinning are stored once, as a MDL or MSH file
+of the mesh; every frame then only holds the vertices whose position or normal
+changed since the frame before, delta encoded.
+
+HEADER:
+    3 byte: magic number 'SEQ'
+    1 byte: version number (1)
+    4 byte: number of vertices (of the MDL or MSH file)
+    4 byte: number of frames
+    4 byte: first frame number (signed)
+    1 byte: base format (0 = MDL, 1 = MSH)
+    3 byte: padding
+    11 byte: name
+    1 byte: NULL
+    32
+
+FRAME:
+    4 byte: offset of the frame's data (from start of the FRAM section)
+    4 byte: size of the frame's data
+    4 byte: number of changed vertices
+    4 byte: padding
+    16
+
+SEQ:
+    HEADER
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'BASE' section: MDL or MSH file of the mesh, its vertices are the frame before the first
+    'FOFS' section: FRAME * number of frames
+    'FRAM' section: FRAME_STREAM (see mesh_codec.py) of every frame, one after the other
+
+Vertices are those of the MDL or MSH file, in its order, with its y up float
+positions and quantized normals (see io_export_mdl.py, io_export_msh.py), so a
+loader patches the positions and normals of the base's vertex buffer in
+place, frame after frame. To seek, decode frames from the first.
+
+Exporting changes the scene's current frame, it is restored afterwards.
+"""
+
+SEQ_FORMATS = {'MDL': 0, 'MSH': 1}
+
+def get_seq_frame(co, normal, order):
+    """ FRAME_DTYPE array of the base's vertices, from (N, 3) y up blender vertex arrays """
+    frame = np.zeros(len(order), dtype=FRAME_DTYPE)
+    frame['co'] = co[order]
+    frame['normal'] = vec3s_to_hvec3(normal[order])
+    return frame
+
+def iter_base(obj, settings):
+    """ the base file and the blender vertex index of each of its vertices """
+    if settings.get('seqFormat', 'MDL') == 'MDL':
+        base = yield from io_export_mdl.iter_mdl_mesh(obj, settings)
+        order = np.array(io_export_mdl.get_mdl_vertex_order(obj, settings), dtype=np.int64)
+    else:
+        base = yield from io_export_msh.iter_serialize_mesh(obj, settings)
+        order = np.arange(len(obj.data.vertices)) # MSH vertices are the mesh's, in order
+    return base, order
+
+def iter_seq(obj, settings):
+    if not obj.type == "MESH":
+        raise Exception("Mesh must be selected, " + obj.type + " was given")
+    base, order = yield from scale_steps(iter_base(obj, settings), 0.0, 0.2)
+
+    scene = bpy.context.scene
+    frames = range(scene.frame_start, scene.frame_end + 1)
+    prev = get_seq_frame(y_up_array(mesh_vertex_array(obj.data)), y_up_array(mesh_normal_array(obj.data)), order)
+    table = []
+    data = []
+    size = 0
+    saved = scene.frame_current
+    try:
+        for i, frame in enumerate(frames):
+            scene.frame_set(frame)
+            cur = get_seq_frame(*(mesh_evaluated_arrays(obj, scene) + (order,)))
+            count, stream = encode_frame(prev, cur)
+            table.append(struct.pack("III4x", size, len(stream), count))
+            data.append(stream)
+            size += len(stream)
+            prev = cur
+            yield 0.2 + 0.8 * (i + 1) / len(frames)
+    finally:
+        scene.frame_set(saved)
+
+    out = SectionWriter(3, settings.get('compression', 'NONE'))
+    out.section(b"BASE", base)
+    out.section(b"FOFS", b''.join(table), 16, len(table))
+    out.section(b"FRAM", b''.join(data), 0, len(data), compress=True)
+
+    header = struct.pack("3sBIIiB3x11sB", b"SEQ", 1,
+                         len(order), len(frames), scene.frame_start,
+                         SEQ_FORMATS[settings.get('seqFormat', 'MDL')],
+                         bytes(obj.data.name, "UTF-8"), 0)
+    assert(len(header) == 32)
+    return out.finish(header)
+
+def write_seq(obj, settings):
+    return run_steps(iter_seq(obj, settings))
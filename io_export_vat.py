@@ -0,0 +1,113 @@
+import bpy
+import struct
+import numpy as np
+
+from .blender_sharelib import (floats_to_ushort, vec3s_to_octvec2, mesh_evaluated_arrays, SectionWriter,
+                               BUFFER_ALIGN, run_steps)
+from . import io_export_mdl
+
+"""
+VAT (vertex animation texture) file format export
+
+The skinned mesh is evaluated at every frame of its armature's pose library
+(the frames write_pos_poses exports), and the deformed vertices stored
+frame by frame, so a crowd can be animated without skinning: one texture row
+per frame, one texel per vertex. Vertices are in the order of the mesh's MDL
+or MSH export, so the texel of a vertex is its index.
+
+HEADER:
+    3 byte: magic number 'VAT'
+    1 byte: version number (1)
+    4 byte: number of vertices (texture width)
+    4 byte: number of frames (texture height)
+    1 byte: vertex order (0 = MDL, 1 = MSH)
+    3 byte: padding
+    15 byte: name
+    1 byte: NULL
+    32
+
+BOUNDS:
+    12 byte: minimum (3 * 4 byte float, y up)
+    12 byte: maximum (3 * 4 byte float)
+    24
+
+POSITION:
+    6 byte: position (3 * unsigned short) (normalized from bounds minimum 0 to maximum 65535)
+    2 byte: padding
+    8
+
+NORMAL:
+    4 byte: normal, octahedral encoded (2 * signed short) (normalized from -32767 to 32767)
+    4
+
+VAT:
+    HEADER
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'BNDS' section: BOUNDS of every position of every frame
+    'VPOS' section: POSITION * vertices * frames, frame major (64 byte aligned)
+    'VNRM' section: NORMAL * vertices * frames, frame major (64 byte aligned)
+
+Baking changes the scene's current frame and the armature's action, both are
+restored afterwards.
+"""
+
+VAT_ORDERS = {'MDL': 0, 'MSH': 1}
+
+def get_vat_vertex_order(obj, settings):
+    """ blender vertex index of every texel """
+    if settings.get('vatOrder', 'MDL') == 'MDL':
+        return np.array(io_export_mdl.get_mdl_vertex_order(obj, settings), dtype=np.int64)
+    return np.arange(len(obj.data.vertices)) # MSH vertices are the mesh's, in order
+
+def iter_vat(obj, settings):
+    if not obj.type == "MESH":
+        raise Exception("Mesh must be selected, " + obj.type + " was given")
+    arm = obj.find_armature()
+    if not arm or not arm.type == "ARMATURE":
+        raise Exception("Mesh must have a parent Armature applied to it")
+    if not arm.pose_library:
+        raise Exception("Armature must have a pose_library set in the sidepane")
+
+    order = get_vat_vertex_order(obj, settings)
+    framerange = arm.pose_library.frame_range
+    frames = range(int(framerange[0]), int(framerange[1]) + 1)
+    scene = bpy.context.scene
+    positions = np.zeros((len(frames), len(order), 3))
+    normals = np.zeros((len(frames), len(order), 3))
+
+    if arm.animation_data is None:
+        arm.animation_data_create()
+    saved = (scene.frame_current, arm.animation_data.action)
+    try:
+        arm.animation_data.action = arm.pose_library
+        for i, frame in enumerate(frames):
+            scene.frame_set(frame)
+            co, normal = mesh_evaluated_arrays(obj, scene)
+            positions[i] = co[order]
+            normals[i] = normal[order]
+            yield 0.9 * (i + 1) / len(frames)
+    finally:
+        arm.animation_data.action = saved[1]
+        scene.frame_set(saved[0])
+
+    bmin = positions.reshape(-1, 3).min(axis=0) if positions.size else np.zeros(3)
+    bmax = positions.reshape(-1, 3).max(axis=0) if positions.size else np.zeros(3)
+    extent = np.where(bmax > bmin, bmax - bmin, 1.0)
+    vpos = np.zeros((positions.size // 3, 4), dtype='<u2')
+    vpos[:, :3] = floats_to_ushort((positions.reshape(-1, 3) - bmin) / extent)
+    vnrm = vec3s_to_octvec2(normals.reshape(-1, 3)).astype('<i2')
+
+    out = SectionWriter(3, settings.get('compression', 'NONE'))
+    out.section(b"BNDS", struct.pack("3f3f", *(tuple(bmin) + tuple(bmax))), 24, 1)
+    out.section(b"VPOS", vpos.tobytes(), 8, len(vpos), BUFFER_ALIGN, True)
+    out.section(b"VNRM", vnrm.tobytes(), 4, len(vnrm), BUFFER_ALIGN, True)
+
+    header = struct.pack("3sBIIB3x15sB", b"VAT", 1,
+                         len(order), len(frames),
+                         VAT_ORDERS[settings.get('vatOrder', 'MDL')],
+                         bytes(obj.data.name, "UTF-8"), 0)
+    assert(len(header) == 32)
+    return out.finish(header)
+
+def write_vat(obj, settings):
+    return run_steps(iter_vat(obj, settings))
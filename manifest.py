@@ -0,0 +1,157 @@
+import os
+import struct
+import hashlib
+
+from .blender_sharelib import SectionWriter, read_section_directory, read_section
+
+"""
+Asset manifest
+
+An index of every exported file in a directory (and its subdirectories), so
+an engine can plan its loads and allocations from a single read instead of
+opening every file for its header. The manifest is rewritten from the files
+on disk after an export with Update Manifest set, after every change written
+by watch mode, or on demand.
+
+HEADER:
+    3 byte: magic number 'MAN'
+    1 byte: version number (1)
+    4 byte: number of assets
+    4 byte: number of sections (of all assets)
+    4 byte: total size of the assets' files
+    16 byte: padding
+    32
+
+ASSET:
+    4 byte: type (the file's magic number and version, e.g. 'MDL' 7)
+    4 byte: offset of the file's path (from start of the PATH section)
+    4 byte: file size
+    4 byte: first section (element of the SECT section)
+    4 byte: number of sections
+    4 byte: flags (1 = has bounds)
+    16 byte: header counts (4 * 4 byte unsigned int, see ASSET_COUNTS, unused are 0)
+    12 byte: bounds minimum (3 * 4 byte float, y up)
+    12 byte: bounds maximum (3 * 4 byte float)
+    16 byte: content hash (first 16 bytes of the file's SHA-1)
+    15 byte: name (from the file's header)
+    1 byte: NULL
+    96
+
+SECTION:
+    the file's SECTION_DIRECTORY entry as is (see blender_sharelib.py)
+    24
+
+MANIFEST:
+    HEADER
+    SECTION_DIRECTORY (see blender_sharelib.py)
+    'ASET' section: ASSET * number of assets, ordered by path
+    'SECT' section: SECTION * number of sections, in the order of each file's directory
+    'PATH' section: NULL terminated paths, relative to the manifest, '/' separated
+
+Bounds are the union of the MDL and MSH submeshes, the PHY bounding sphere's
+box and the VAT bounds. POS, SCN and SEQ assets have none (a SEQ's frames may
+leave its base mesh's bounds).
+"""
+
+MANIFEST_NAME = "assets.man"
+MANIFEST_HAS_BOUNDS = 1
+
+#
+# per file extension: header counts (struct format of the header from byte 4),
+# and the offset and size of the name in the header
+#
+ASSET_COUNTS = {'.mdl': ("IIIB", 17, 15), # verts, faces, edges, bones
+                '.msh': ("HHHH", 16, 15), # verts, uvs, faces, edges
+                '.phy': ("HHHH", 16, 16), # spheres, capsules, boxes, hulls
+                '.pos': ("BB", 6, 15), # bones, poses
+                '.scn': ("HH", 16, 16), # entities (top bit set for the streaming layout), packed blobs
+                '.vat': ("II", 16, 15), # verts, frames
+                '.seq': ("II", 20, 11)} # verts, frames
+
+def read_asset_bounds(f, ext, sections):
+    """ (min, max) of an asset, or None """
+    if ext in ('.mdl', '.msh') and b"SUBM" in sections:
+        data = read_section(f, sections[b"SUBM"])
+        boxes = [struct.unpack_from("3f3f", data, i * 48 + 20) for i in range(len(data) // 48)]
+        if not boxes:
+            return None
+        return (tuple(min(b[j] for b in boxes) for j in range(3)),
+                tuple(max(b[j + 3] for b in boxes) for j in range(3)))
+    if ext == '.phy' and b"BSPH" in sections:
+        x, y, z, r = struct.unpack_from("3ff", read_section(f, sections[b"BSPH"]))
+        return (x - r, y - r, z - r), (x + r, y + r, z + r)
+    if ext == '.vat' and b"BNDS" in sections:
+        bounds = struct.unpack_from("3f3f", read_section(f, sections[b"BNDS"]))
+        return bounds[:3], bounds[3:]
+    return None
+
+def read_asset(path):
+    """ manifest entry of an exported file """
+    ext = os.path.splitext(path)[1].lower()
+    fmt, nameofs, namesize = ASSET_COUNTS[ext]
+    with open(path, 'rb') as f:
+        header = f.read(32)
+        if len(header) < 32:
+            raise Exception("File is too small for a header")
+        sections = read_section_directory(f)
+        bounds = read_asset_bounds(f, ext, sections)
+        f.seek(0)
+        digest = hashlib.sha1(f.read()).digest()[:16]
+    counts = struct.unpack_from(fmt, header, 4)
+    return {'type': header[:4],
+            'name': header[nameofs:nameofs + namesize].split(b'\0')[0],
+            'size': os.path.getsize(path),
+            'counts': counts,
+            'sections': list(sections.items()),
+            'bounds': bounds,
+            'hash': digest}
+
+def find_assets(directory):
+    """ paths of the exported files under directory, relative to it, sorted """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            if os.path.splitext(name)[1].lower() in ASSET_COUNTS:
+                paths.append(os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/'))
+    return sorted(paths)
+
+def serialize_manifest(directory):
+    assets = []
+    sects = []
+    strings = []
+    stringofs = 0
+    total = 0
+    for path in find_assets(directory):
+        try:
+            asset = read_asset(os.path.join(directory, path))
+        except Exception as e: # files of older versions have no section directory
+            print("manifest: " + path + " skipped: " + str(e))
+            continue
+        bounds = asset['bounds'] or ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0))
+        counts = tuple(asset['counts']) + (0,) * (4 - len(asset['counts']))
+        assets.append(struct.pack("4sIIIII4I3f3f16s15sB", asset['type'], stringofs, asset['size'],
+                                  len(sects), len(asset['sections']),
+                                  MANIFEST_HAS_BOUNDS if asset['bounds'] else 0,
+                                  *(counts + bounds[0] + bounds[1] +
+                                    (asset['hash'], asset['name'], 0))))
+        for tag, entry in asset['sections']:
+            sects.append(struct.pack("4sIIIIHH", tag, *entry))
+        path = path.encode('UTF-8') + b'\0'
+        strings.append(path)
+        stringofs += len(path)
+        total += asset['size']
+
+    out = SectionWriter(3)
+    out.section(b"ASET", b''.join(assets), 96, len(assets))
+    out.section(b"SECT", b''.join(sects), 24, len(sects))
+    out.section(b"PATH", b''.join(strings), 0, len(strings))
+    header = struct.pack("3sBIII16x", b"MAN", 1, len(assets), len(sects), total)
+    assert(len(header) == 32)
+    return out.finish(header), len(assets)
+
+def write_manifest(directory):
+    """ rewrites the manifest of directory from the files in it, returns the number of assets """
+    data, nassets = serialize_manifest(directory)
+    with open(os.path.join(directory, MANIFEST_NAME), 'wb') as f:
+        f.write(data)
+    return nassets
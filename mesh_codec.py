@@ -0,0 +1,233 @@
+import struct
+import sys
+import zlib
+import numpy as np
+
+try:
+    from .section_codec import read_section_directory, read_section
+except ImportError: # run as a script
+    from section_codec import read_section_directory, read_section
+
+"""
+Lossless transforms of MDL/MSH mesh sections, applied before compression.
+
+Index and vertex data compress much better once neighbouring values are
+turned into small differences. A section's directory entry gives the
+transform applied to it (see blender_sharelib.py); its stride and count still
+describe the decoded array.
+
+INDEX_STREAM: (FACE, UVUV and LODF sections)
+    2 byte: mask of the 2 byte columns holding vertex indices
+    2 byte: padding
+    varints, one per 2 byte column of every element, in element order
+
+Index columns are predicted by the previous index in the stream (the one
+before it in the same triangle, or the last of the previous triangle); other
+columns by the same column of the previous element. Each difference is
+zigzag encoded (0, -1, 1, -2 ... become 0, 1, 2, 3 ...) and written as a
+little endian base 128 varint, the high bit of a byte meaning more bytes follow.
+
+VERTEX_STREAM: (VERT sections)
+    1 byte: number of components
+    1 byte * number of components: width of each component (1, 2 or 4)
+    padding to 4 bytes
+    byte planes
+
+Each component of an element (a float, short or byte, read as an unsigned
+integer of its width) is replaced by its difference to the same component of
+the previous element, wrapping around. The differences are then byte
+transposed: for every component, for every byte of it (low byte first), that
+byte of every element. The planes of slowly changing values are mostly zeros.
+
+FRAME_STREAM: (frames of SEQ files, see io_export_seq.py)
+    varints, one per changed vertex: its index, as the difference to the previous one
+    padding to 4 bytes
+    byte planes of the changes
+
+A frame holds the vertices whose position (3 * 4 byte float) or normal
+(3 * signed short) differ from the previous frame. Each of their components
+is replaced by its difference to the previous frame's, wrapping around, and
+byte transposed as in VERTEX_STREAM. Unchanged vertices cost nothing, and
+decoding is exact.
+
+decode_section is the reference decoder. Run as a script on exported files to
+compare zlib ratios with and without the transforms:
+
+    python mesh_codec.py model.mdl mesh.msh ...
+"""
+
+FRAME_DTYPE = np.dtype([('co', '<f4', 3), ('normal', '<i2', 3)])
+FRAME_FORMAT = "3f3h" # same layout as FRAME_DTYPE
+
+ENCODING_NONE = 0
+ENCODING_INDEX = 1
+ENCODING_VERTEX = 2
+
+FORMAT_WIDTHS = {'f': 4, 'I': 4, 'i': 4, 'h': 2, 'H': 2, 'b': 1, 'B': 1, 'x': 1}
+WIDTH_TYPES = {1: np.uint8, 2: np.dtype('<u2'), 4: np.dtype('<u4')}
+
+def format_widths(fmt):
+    """ component widths of a struct format, e.g. "3fHxx" is [4, 4, 4, 2, 1, 1] """
+    widths = []
+    repeat = ''
+    for c in fmt:
+        if c.isdigit():
+            repeat += c
+            continue
+        widths.extend([FORMAT_WIDTHS[c]] * int(repeat or 1))
+        repeat = ''
+    return widths
+
+def zigzag(values):
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+def unzigzag(values):
+    values = values.astype(np.int64)
+    return (values >> 1) ^ -(values & 1)
+
+def varint_encode(values):
+    values = values.astype(np.uint64)
+    nbytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        nbytes += values >= (1 << (7 * k))
+    start = np.cumsum(nbytes) - nbytes
+    out = np.zeros(int(nbytes.sum()), dtype=np.uint8)
+    for k in range(int(nbytes.max()) if len(values) else 0):
+        mask = nbytes > k
+        more = np.where(nbytes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[start[mask] + k] = ((values[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)) | more
+    return out.tobytes()
+
+def varint_decode(data):
+    b = np.frombuffer(data, dtype=np.uint8)
+    ends = np.nonzero(b < 0x80)[0]
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shift = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    bits = (b & 0x7F).astype(np.uint64) << (7 * shift).astype(np.uint64)
+    return np.add.reduceat(bits, starts)
+
+def encode_indices(data, stride, columns):
+    """ INDEX_STREAM of an array of 2 byte columns, columns being the ones holding indices """
+    ncolumns = stride // 2
+    mask = sum(1 << c for c in columns)
+    values = np.frombuffer(data, dtype='<u2').astype(np.int64).reshape(-1, ncolumns)
+    deltas = np.zeros_like(values)
+    other = [c for c in range(ncolumns) if c not in columns]
+    if len(values):
+        indices = values[:, columns].ravel()
+        deltas[:, columns] = np.diff(np.concatenate(([0], indices))).reshape(-1, len(columns))
+        deltas[0, other] = values[0, other]
+        deltas[1:, other] = values[1:, other] - values[:-1, other]
+    return struct.pack("H2x", mask) + varint_encode(zigzag(deltas.ravel()))
+
+def decode_indices(data, stride, count):
+    ncolumns = stride // 2
+    mask, = struct.unpack_from("H", data, 0)
+    columns = [c for c in range(ncolumns) if mask & (1 << c)]
+    other = [c for c in range(ncolumns) if not mask & (1 << c)]
+    deltas = unzigzag(varint_decode(data[4:])).reshape(count, ncolumns)
+    values = np.zeros_like(deltas)
+    values[:, columns] = np.cumsum(deltas[:, columns].ravel()).reshape(count, len(columns))
+    values[:, other] = np.cumsum(deltas[:, other], axis=0)
+    return values.astype('<u2').tobytes()
+
+def encode_vertices(data, fmt):
+    """ VERTEX_STREAM of an array of elements laid out as the struct format fmt """
+    widths = format_widths(fmt)
+    stride = sum(widths)
+    header = struct.pack("B%dB" % len(widths), len(widths), *widths)
+    header += bytes(-len(header) % 4)
+    rows = np.frombuffer(data, dtype=np.uint8).reshape(-1, stride)
+    planes = []
+    offset = 0
+    for w in widths:
+        values = rows[:, offset:offset + w].copy().view(WIDTH_TYPES[w]).ravel()
+        deltas = values.copy()
+        deltas[1:] = values[1:] - values[:-1] # wraps around
+        planes.append(deltas.view(np.uint8).reshape(-1, w).T.tobytes())
+        offset += w
+    return header + b''.join(planes)
+
+def decode_vertices(data, stride, count):
+    ncomponents = data[0]
+    widths = list(data[1:1 + ncomponents])
+    pos = 1 + ncomponents
+    pos += -pos % 4
+    rows = np.zeros((count, stride), dtype=np.uint8)
+    offset = 0
+    for w in widths:
+        planes = np.frombuffer(data, dtype=np.uint8, count=w * count, offset=pos).reshape(w, count)
+        deltas = planes.T.copy().view(WIDTH_TYPES[w]).ravel()
+        values = np.cumsum(deltas, dtype=WIDTH_TYPES[w]) # wraps around, undoing the differences
+        rows[:, offset:offset + w] = values.view(np.uint8).reshape(count, w)
+        pos += w * count
+        offset += w
+    return rows.tobytes()
+
+def encode_frame(prev, cur):
+    """ (number of changed vertices, FRAME_STREAM) of cur against prev, FRAME_DTYPE arrays """
+    a = prev.view(np.uint8).reshape(len(prev), -1)
+    b = cur.view(np.uint8).reshape(len(cur), -1)
+    changed = np.nonzero((a != b).any(axis=1))[0]
+    out = varint_encode(zigzag(np.diff(np.concatenate(([0], changed)))))
+    out += bytes(-len(out) % 4)
+    planes = []
+    offset = 0
+    for w in format_widths(FRAME_FORMAT):
+        before = a[changed, offset:offset + w].copy().view(WIDTH_TYPES[w]).ravel()
+        after = b[changed, offset:offset + w].copy().view(WIDTH_TYPES[w]).ravel()
+        planes.append((after - before).view(np.uint8).reshape(-1, w).T.tobytes()) # wraps around
+        offset += w
+    return len(changed), out + b''.join(planes)
+
+def decode_frame(data, prev, count):
+    """ reference decoder, returns the FRAME_DTYPE array following prev """
+    b = np.frombuffer(data, dtype=np.uint8)
+    end = int(np.nonzero(b < 0x80)[0][count - 1]) + 1 if count else 0
+    changed = np.cumsum(unzigzag(varint_decode(data[:end])))
+    pos = end + (-end % 4)
+    rows = prev.view(np.uint8).reshape(len(prev), -1).copy()
+    offset = 0
+    for w in format_widths(FRAME_FORMAT):
+        planes = np.frombuffer(data, dtype=np.uint8, count=w * count, offset=pos).reshape(w, count)
+        deltas = planes.T.copy().view(WIDTH_TYPES[w]).ravel()
+        values = rows[changed, offset:offset + w].copy().view(WIDTH_TYPES[w]).ravel() + deltas
+        rows[changed, offset:offset + w] = values.view(np.uint8).reshape(count, w)
+        pos += w * count
+        offset += w
+    return rows.view(FRAME_DTYPE).ravel()
+
+def encode_section(encoding, data, stride, layout):
+    """ layout is the index columns for ENCODING_INDEX, the struct format for ENCODING_VERTEX """
+    if encoding == ENCODING_INDEX:
+        return encode_indices(data, stride, layout)
+    if encoding == ENCODING_VERTEX:
+        return encode_vertices(data, layout)
+    return data
+
+def decode_section(encoding, data, stride, count):
+    """ reference decoder, returns the plain array of count elements of stride bytes """
+    if encoding == ENCODING_INDEX:
+        return decode_indices(data, stride, count)
+    if encoding == ENCODING_VERTEX:
+        return decode_vertices(data, stride, count)
+    return data
+
+def compare(paths):
+    """ prints the zlib size of every transformed section, with and without the transform """
+    for path in paths:
+        with open(path, 'rb') as f:
+            for tag, entry in sorted(read_section_directory(f).items()):
+                offset, size, stride, count, codec, encoding = entry
+                if encoding == ENCODING_NONE:
+                    continue
+                stored = read_section(f, entry)
+                plain = decode_section(encoding, stored, stride, count)
+                print("%s %s: %d bytes, transformed %d, zlib %d, transformed and zlib %d" %
+                      (path, tag.decode(), len(plain), len(stored),
+                       len(zlib.compress(plain, 9)), len(zlib.compress(stored, 9))))
+
+if __name__ == "__main__":
+    compare(sys.argv[1:])
@@ -0,0 +1,155 @@
+import struct
+import sys
+import time
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Optional compression of large sections, shared by every format.
+
+A compressed section is split into fixed size blocks that are compressed
+independently, so a loader can decompress them in parallel, or stream them
+one block at a time. The section's directory entry gives the codec
+(see blender_sharelib.py); its stride and count still describe the
+decompressed data.
+
+COMPRESSED_SECTION:
+    4 byte: decompressed size
+    4 byte: block size (decompressed bytes per block, the last block may be shorter)
+    4 byte: number of blocks
+    4 byte: padding
+    BLOCK * number of blocks
+    compressed blocks
+
+BLOCK:
+    4 byte: offset of the block's data (from start of the section)
+    4 byte: stored size (equal to the decompressed size if the block is stored as is)
+    4 byte: decompressed size
+    12
+
+Blocks that do not shrink are stored as is. Sections that would not shrink
+at all are written uncompressed (codec none).
+
+Run as a script on exported files to compare compression ratio against
+decode throughput for every codec:
+
+    python section_codec.py model.mdl scene.scn ...
+"""
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+
+CODECS = {'NONE': CODEC_NONE, 'ZLIB': CODEC_ZLIB, 'LZMA': CODEC_LZMA}
+
+COMPRESS_BLOCK_SIZE = 0x10000
+COMPRESS_MIN_SIZE = 0x1000 # smaller sections are never compressed
+
+def compress_block(codec, raw):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(raw, 9)
+    if codec == CODEC_LZMA:
+        return lzma.compress(raw, format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2, 'preset': 6}])
+    return raw
+
+def decompress_block(codec, data, size):
+    if len(data) == size: # stored
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(data, format=lzma.FORMAT_RAW, filters=[{'id': lzma.FILTER_LZMA2}])
+    return data
+
+def compress_section(codec, data, blocksize=COMPRESS_BLOCK_SIZE):
+    """ returns (codec, stored bytes); codec is CODEC_NONE if compressing did not pay off """
+    if codec == CODEC_NONE or len(data) < COMPRESS_MIN_SIZE:
+        return CODEC_NONE, data
+    raws = [data[i:i + blocksize] for i in range(0, len(data), blocksize)]
+    blocks = []
+    for raw in raws:
+        packed = compress_block(codec, raw)
+        blocks.append(packed if len(packed) < len(raw) else raw)
+
+    table = [struct.pack("III4x", len(data), blocksize, len(blocks))]
+    offset = 16 + 12 * len(blocks)
+    for raw, block in zip(raws, blocks):
+        table.append(struct.pack("III", offset, len(block), len(raw)))
+        offset += len(block)
+    if offset >= len(data):
+        return CODEC_NONE, data
+    return codec, b''.join(table + blocks)
+
+def section_blocks(data):
+    """ (offset, stored size, decompressed size) of every block of a compressed section """
+    size, blocksize, nblocks = struct.unpack_from("III", data, 0)
+    return [struct.unpack_from("III", data, 16 + 12 * i) for i in range(nblocks)]
+
+def decompress_section(codec, data, workers=1):
+    """ reference decoder, blocks are decoded on workers threads (zlib and lzma release the GIL) """
+    if codec == CODEC_NONE:
+        return data
+    def decode(block):
+        offset, stored, size = block
+        return decompress_block(codec, data[offset:offset + stored], size)
+    blocks = section_blocks(data)
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            return b''.join(pool.map(decode, blocks))
+    return b''.join(decode(b) for b in blocks)
+
+def read_section_directory(f):
+    """ {tag: (offset, size, stride, count, codec, transform)} from an open file laid out with a section directory """
+    f.seek(32)
+    tag, nsections = struct.unpack("4sI8x", f.read(16))
+    if tag != b"SDIR":
+        raise Exception("No section directory")
+    sections = dict()
+    for i in range(nsections):
+        entry = struct.unpack("4sIIIIHH", f.read(24))
+        sections[entry[0]] = entry[1:]
+    return sections
+
+def read_section(f, entry, decode=None):
+    """
+    decompressed data of the section with directory entry; decode(transform, data, stride, count),
+    e.g. mesh_codec.decode_section, also undoes its transform
+    """
+    offset, size, stride, count, codec, transform = entry
+    f.seek(offset)
+    data = decompress_section(codec, f.read(size))
+    if decode:
+        return decode(transform, data, stride, count)
+    return data
+
+def read_sections(f, decode=None):
+    """ {tag: data} of every section of an open file, as read_section returns it """
+    return dict((tag, read_section(f, entry, decode)) for tag, entry in read_section_directory(f).items())
+
+def benchmark(paths, workers=4, repeat=3):
+    """ prints size, ratio and decode throughput of every codec over the sections of the files """
+    raw = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            raw.extend(read_sections(f).values())
+    total = sum(len(r) for r in raw)
+    print("%d sections, %d bytes" % (len(raw), total))
+    for name in ('ZLIB', 'LZMA'):
+        codec = CODECS[name]
+        start = time.perf_counter()
+        packed = [compress_section(codec, r) for r in raw]
+        encode = time.perf_counter() - start
+        stored = sum(len(p[1]) for p in packed)
+        for threads in sorted(set((1, workers))):
+            start = time.perf_counter()
+            for it in range(repeat):
+                for (c, p), r in zip(packed, raw):
+                    assert decompress_section(c, p, threads) == r
+            decode = (time.perf_counter() - start) / repeat
+            print("%s: %d bytes, ratio %.3f, encode %.1f MB/s, decode %.1f MB/s on %d threads" %
+                  (name, stored, stored / max(total, 1), total / max(encode, 1e-9) / 1e6,
+                   total / max(decode, 1e-9) / 1e6, threads))
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1:])
@@ -0,0 +1,30 @@
+"""
+Steppable exports, shared by every exporter.
+
+Exporters are generators (the iter_* functions): they yield their progress,
+from 0 to 1, between small steps of work, and return the file data. The
+operators advance them from a timer so the interface stays responsive, and
+close them to cancel.
+
+Kept apart from blender_sharelib.py (which re-exports it) so the modules that
+do not touch bpy, like decimate.py and collision_fit.py, can be steppable too.
+"""
+
+EXPORT_CHUNK = 1024 # vertices, faces or edge collapses between two steps of an export generator
+
+# runs an export generator to the end, returns the data it produced
+def run_steps(steps):
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+# runs an export generator as part of a larger one, its progress mapped to lo..hi
+def scale_steps(steps, lo, hi):
+    while True:
+        try:
+            progress = next(steps)
+        except StopIteration as stop:
+            return stop.value
+        yield lo + (hi - lo) * progress
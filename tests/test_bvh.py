@@ -0,0 +1,64 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bvh
+
+
+def random_bounds(rng, count):
+    lo = rng.uniform(-50.0, 50.0, (count, 3))
+    hi = lo + rng.uniform(0.0, 5.0, (count, 3))
+    return [(tuple(a), tuple(b)) for a, b in zip(lo.tolist(), hi.tolist())]
+
+
+def contains(outer, inner):
+    return all(outer[0][i] <= inner[0][i] and inner[1][i] <= outer[1][i] for i in range(3))
+
+
+def leaves(nodes):
+    """ (node, bounds of every ancestor) of every leaf, walking the depth first layout """
+    found = []
+    stack = [(0, [])]
+    while stack:
+        index, ancestors = stack.pop()
+        node = nodes[index]
+        box = (node.bmin, node.bmax)
+        for outer in ancestors:
+            assert contains(outer, box)
+        if node.count:
+            found.append(node)
+        else:
+            stack.append((node.offset, ancestors + [box]))
+            stack.append((index + 1, ancestors + [box]))
+    return found
+
+
+def test_leaves_cover_every_primitive_once():
+    rng = np.random.RandomState(4)
+    for count, leafsize in ((1, 4), (5, 4), (200, 4), (333, 1)):
+        bounds = random_bounds(rng, count)
+        nodes, refs = bvh.build_bvh(bounds, leafsize)
+        assert sorted(refs) == list(range(count))
+        seen = []
+        for node in leaves(nodes):
+            assert node.count <= leafsize
+            for r in refs[node.offset:node.offset + node.count]:
+                assert contains((node.bmin, node.bmax), bounds[r])
+                seen.append(r)
+        assert sorted(seen) == list(range(count))
+
+
+def test_identical_bounds_make_one_leaf():
+    bounds = [((0.0, 0.0, 0.0), (1.0, 1.0, 1.0))] * 10
+    nodes, refs = bvh.build_bvh(bounds, 4)
+    assert len(nodes) == 1 and nodes[0].count == 10
+
+
+def test_empty():
+    assert bvh.build_bvh([]) == ([], [])
+
+
+def test_node_size():
+    nodes, refs = bvh.build_bvh(random_bounds(np.random.RandomState(5), 20), 2)
+    assert all(len(node.serialize()) == bvh.BVH_NODE_SIZE for node in nodes)
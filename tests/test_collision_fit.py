@@ -0,0 +1,82 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import collision_fit
+
+EPSILON = 1e-9
+
+
+def two_blobs(rng):
+    """ an L shape of two elongated clusters, which one box or sphere fits badly """
+    return np.vstack([rng.normal(size=(400, 3)) * [4.0, 0.5, 0.5],
+                      rng.normal(size=(400, 3)) * [0.5, 0.5, 4.0] + [6.0, 0.0, 4.0]])
+
+
+def inside_box(points, box):
+    center, dims, axes = box
+    local = np.dot(points - center, axes)
+    return (np.abs(local) <= dims * 0.5 + EPSILON).all(axis=1)
+
+
+def test_boxes_cover_every_point():
+    rng = np.random.RandomState(11)
+    points = two_blobs(rng)
+    for budget in (1, 2, 6):
+        boxes = collision_fit.fit_boxes(points, budget)
+        assert 1 <= len(boxes) <= budget
+        covered = np.zeros(len(points), dtype=bool)
+        for box in boxes:
+            axes = box[2]
+            assert np.abs(np.dot(axes.T, axes) - np.eye(3)).max() < 1e-9
+            assert np.linalg.det(axes) > 0.0
+            covered |= inside_box(points, box)
+        assert covered.all()
+    assert len(collision_fit.fit_boxes(points, 2)) == 2 # the split pays off
+
+
+def test_spheres_cover_every_point():
+    rng = np.random.RandomState(12)
+    points = two_blobs(rng)
+    spheres = collision_fit.fit_spheres(points, 5)
+    assert 1 <= len(spheres) <= 5
+    covered = np.zeros(len(points), dtype=bool)
+    for center, radius in spheres:
+        covered |= np.sqrt(((points - center) ** 2).sum(axis=1)) <= radius + EPSILON
+    assert covered.all()
+
+
+def test_nearest_centers_across_chunks():
+    rng = np.random.RandomState(13)
+    points = rng.uniform(-10.0, 10.0, (collision_fit.FIT_CHUNK * 2 + 17, 3))
+    centers = rng.uniform(-10.0, 10.0, (7, 3))
+    d = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    assert (collision_fit.nearest_centers(points, centers) == d.argmin(axis=1)).all()
+
+
+def test_bounding_sphere_contains_every_point():
+    rng = np.random.RandomState(14)
+    for points in (two_blobs(rng),
+                   rng.uniform(-1.0, 1.0, (5000, 3)),
+                   rng.normal(size=(3, 3)), # fewer points than a sphere needs
+                   np.array([[1.0, 2.0, 3.0]] * 4)):
+        center, radius = collision_fit.bounding_sphere(points)
+        dist = np.sqrt(((points - center) ** 2).sum(axis=1))
+        assert (dist <= radius * (1.0 + 1e-6) + 1e-6).all()
+        # minimal: the farthest point is on the surface, and no smaller than half the diameter
+        assert abs(dist.max() - radius) <= 1e-6 * max(radius, 1.0)
+        span = np.sqrt(((points[:, None, :] - points[None, :200, :]) ** 2).sum(axis=2)).max()
+        assert radius >= span * 0.5 - 1e-9
+
+
+def test_bounding_sphere_of_known_shapes():
+    cube = np.array([[x, y, z] for x in (-1.0, 1.0) for y in (-1.0, 1.0) for z in (-1.0, 1.0)]) + [5.0, 0.0, 0.0]
+    center, radius = collision_fit.bounding_sphere(cube)
+    assert np.abs(center - [5.0, 0.0, 0.0]).max() < 1e-9
+    assert abs(radius - np.sqrt(3.0)) < 1e-9
+
+    # a point inside the sphere of the others does not change it
+    ring = np.array([[np.cos(a), np.sin(a), 0.0] for a in np.linspace(0.0, 2.0 * np.pi, 7, endpoint=False)])
+    center, radius = collision_fit.bounding_sphere(np.vstack((ring, [[0.2, 0.1, 0.3]])))
+    assert np.abs(center).max() < 1e-9 and abs(radius - 1.0) < 1e-9
@@ -0,0 +1,61 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import convex_hull
+
+EPSILON = 1e-9
+
+
+def euler_characteristic(hull):
+    return len(hull['verts']) - len(hull['edges']) + len(hull['faces'])
+
+
+def assert_contains(hull, points, tolerance=EPSILON):
+    for normal, dist, loop in hull['faces']:
+        assert (np.dot(points, normal) <= dist + tolerance).all()
+
+
+def test_hull_contains_every_point():
+    rng = np.random.RandomState(21)
+    for points in (rng.normal(size=(2000, 3)),
+                   rng.uniform(-1.0, 1.0, (500, 3)) * [10.0, 1.0, 0.1],
+                   np.vstack([rng.normal(size=(300, 3)), rng.normal(size=(300, 3)) + 6.0])):
+        hull = convex_hull.build_hull(points)
+        assert hull is not None and hull['error'] == 0.0
+        assert_contains(hull, points)
+        assert euler_characteristic(hull) == 2
+        # every hull vertex is one of the input points
+        assert all((np.abs(points - v).max(axis=1) == 0.0).any() for v in hull['verts'])
+
+
+def test_cube_hull_is_exact():
+    corners = np.array([[x, y, z] for x in (-1.0, 1.0) for y in (-2.0, 2.0) for z in (-3.0, 3.0)])
+    rng = np.random.RandomState(22)
+    points = np.vstack((corners, rng.uniform(-1.0, 1.0, (400, 3)) * [1.0, 2.0, 3.0]))
+    hull = convex_hull.build_hull(points)
+    assert len(hull['verts']) == 8
+    assert len(hull['faces']) == 6
+    assert len(hull['edges']) == 12
+    assert all(len(loop) == 4 for normal, dist, loop in hull['faces'])
+    assert sorted(map(tuple, hull['verts'].tolist())) == sorted(map(tuple, corners.tolist()))
+    assert abs(convex_hull.hull_volume(hull) - 48.0) < 1e-9
+    assert_contains(hull, points)
+
+
+def test_budget_limits_vertices():
+    rng = np.random.RandomState(23)
+    points = rng.normal(size=(3000, 3))
+    points /= np.sqrt((points ** 2).sum(axis=1))[:, None] # every point is on the hull
+    hull = convex_hull.build_hull(points, 32)
+    assert len(hull['verts']) <= 32
+    assert euler_characteristic(hull) == 2
+    assert hull['error'] > 0.0
+    assert_contains(hull, points, hull['error'] + EPSILON)
+
+
+def test_flat_points_have_no_hull():
+    rng = np.random.RandomState(24)
+    points = np.column_stack((rng.normal(size=(100, 2)), np.zeros(100)))
+    assert convex_hull.build_hull(points) is None
@@ -0,0 +1,68 @@
+import os
+import sys
+from math import cos, sin, pi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import decimate
+
+
+def torus(rings, sides):
+    """ a closed mesh, so no vertex is locked as a border """
+    positions = []
+    for i in range(rings):
+        u = 2.0 * pi * i / rings
+        for j in range(sides):
+            v = 2.0 * pi * j / sides
+            r = 3.0 + cos(v)
+            positions.append((r * cos(u), r * sin(u), sin(v)))
+    tris = []
+    for i in range(rings):
+        for j in range(sides):
+            a = i * sides + j
+            b = ((i + 1) % rings) * sides + j
+            c = ((i + 1) % rings) * sides + (j + 1) % sides
+            d = i * sides + (j + 1) % sides
+            tris.append((a, b, c))
+            tris.append((a, c, d))
+    return positions, tris
+
+
+def test_lods_keep_the_triangle_budget():
+    positions, tris = torus(32, 16)
+    ratios = [0.5, 0.25, 0.1]
+    lods = decimate.build_lods(positions, tris, ratios)
+    assert len(lods) == len(ratios)
+    previous = 0.0
+    for (lod, error, faces), ratio in zip(lods, ratios):
+        assert 0 < len(lod) <= int(len(tris) * ratio)
+        assert error >= previous
+        previous = error
+        for t in lod:
+            assert len(set(t)) == 3 and all(0 <= i < len(positions) for i in t)
+        # triangles keep the order of the faces they came from
+        assert faces == sorted(faces) and len(faces) == len(lod)
+
+
+def test_locked_vertices_are_kept():
+    positions, tris = torus(16, 8)
+    locked = list(range(0, len(positions), 3))
+    lods = decimate.build_lods(positions, tris, [0.3], locked)
+    used = set(i for t in lods[0][0] for i in t)
+    assert used.issuperset(locked)
+
+
+def test_groups_only_collapse_within():
+    positions, tris = torus(16, 8)
+    groups = [i // 8 < 8 for i in range(len(positions))] # two halves of the rings
+    lods = decimate.build_lods(positions, tris, [0.3], (), groups)
+    for t, f in zip(lods[0][0], lods[0][2]):
+        for i, j in zip(t, tris[f]):
+            assert groups[i] == groups[j]
+
+
+def test_lod_sections():
+    positions, tris = torus(8, 6)
+    lods = decimate.build_lods(positions, tris, [0.5, 0.25])
+    table = decimate.serialize_lod_table(lods, [1, 2])
+    assert len(table) == 16 * len(lods)
+    assert len(decimate.serialize_lod_faces(lods)) == 8 * sum(len(lod[0]) for lod in lods)
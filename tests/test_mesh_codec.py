@@ -0,0 +1,86 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mesh_codec
+
+
+def old_numpy_diff(monkeypatch):
+    """ np.diff as in the NumPy bundled with Blender 2.7x, which has no prepend or append """
+    diff = np.diff
+    def strict(a, n=1, axis=-1):
+        return diff(a, n, axis)
+    monkeypatch.setattr(np, "diff", strict)
+
+
+def random_frame(rng, count):
+    frame = np.zeros(count, dtype=mesh_codec.FRAME_DTYPE)
+    frame['co'] = rng.uniform(-10.0, 10.0, (count, 3))
+    frame['normal'] = rng.randint(-32767, 32768, (count, 3))
+    return frame
+
+
+def test_frame_round_trip(monkeypatch):
+    old_numpy_diff(monkeypatch)
+    rng = np.random.RandomState(7)
+    prev = random_frame(rng, 500)
+    cur = prev.copy()
+    moved = rng.choice(500, 120, replace=False)
+    cur['co'][moved] += rng.uniform(-0.5, 0.5, (120, 3))
+    cur['normal'][moved[:40]] = -cur['normal'][moved[:40]]
+
+    count, stream = mesh_codec.encode_frame(prev, cur)
+    assert count == 120
+    assert mesh_codec.decode_frame(stream, prev, count).tobytes() == cur.tobytes()
+
+
+def test_frame_first_vertex_and_unchanged(monkeypatch):
+    old_numpy_diff(monkeypatch)
+    rng = np.random.RandomState(8)
+    prev = random_frame(rng, 16)
+    cur = prev.copy()
+    cur['co'][0] += 1.0
+
+    count, stream = mesh_codec.encode_frame(prev, cur)
+    assert count == 1
+    assert mesh_codec.decode_frame(stream, prev, count).tobytes() == cur.tobytes()
+
+    count, stream = mesh_codec.encode_frame(cur, cur)
+    assert count == 0
+    assert mesh_codec.decode_frame(stream, cur, count).tobytes() == cur.tobytes()
+
+
+def test_indices_round_trip(monkeypatch):
+    old_numpy_diff(monkeypatch)
+    rng = np.random.RandomState(9)
+    faces = np.zeros((300, 4), dtype='<u2')
+    faces[:, :3] = rng.randint(0, 65535, (300, 3))
+    faces[:, 3] = np.sort(rng.randint(0, 8, 300)) # material, not an index
+    data = faces.tobytes()
+
+    stream = mesh_codec.encode_indices(data, 8, (0, 1, 2))
+    assert mesh_codec.decode_indices(stream, 8, len(faces)) == data
+    stream = mesh_codec.encode_indices(data, 8, (0, 1, 2, 3))
+    assert mesh_codec.decode_indices(stream, 8, len(faces)) == data
+
+
+def test_vertices_round_trip():
+    rng = np.random.RandomState(10)
+    # MDL_VERT_FORMAT and MSH_VERT_FORMAT, 32 byte vertices
+    for fmt in ("fffhhhHHHBBBBHxx", "fffhhhHHBBBBBBBBH"):
+        assert sum(mesh_codec.format_widths(fmt)) == 32
+        for count in (0, 1, 777):
+            data = rng.randint(0, 256, count * 32).astype(np.uint8).tobytes() # any bit pattern, NaNs too
+            stream = mesh_codec.encode_section(mesh_codec.ENCODING_VERTEX, data, 32, fmt)
+            assert mesh_codec.decode_section(mesh_codec.ENCODING_VERTEX, stream, 32, count) == data
+
+
+def test_vertices_wrap_around():
+    rows = np.zeros(4, dtype=[('a', '<u4'), ('b', '<u2'), ('c', 'u1'), ('d', 'u1')])
+    rows['a'] = [0xFFFFFFFF, 0, 0xFFFFFFFF, 1]
+    rows['b'] = [0, 0xFFFF, 1, 0]
+    rows['c'] = [255, 0, 255, 0]
+    data = rows.tobytes()
+    stream = mesh_codec.encode_vertices(data, "IHBB")
+    assert mesh_codec.decode_vertices(stream, 8, 4) == data
@@ -0,0 +1,106 @@
+import importlib
+import io
+import os
+import struct
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip("bpy") # the exporters only run inside Blender
+from mathutils import Vector, Quaternion
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+io_export_phy = importlib.import_module(os.path.basename(ROOT) + ".io_export_phy")
+section_codec = importlib.import_module(os.path.basename(ROOT) + ".section_codec")
+
+EPSILON = 1e-4
+
+
+class Shell(object):
+    """ an object without collision children, so the primitives set on the Phy are kept """
+    name = "shell"
+    type = 'EMPTY'
+    children = []
+    location = Vector((0.0, 0.0, 0.0))
+
+
+def random_rotation(rng):
+    q = rng.normal(size=4)
+    q /= np.sqrt((q * q).sum())
+    return Quaternion(q.tolist()) # half with a negative w, which the writer flips
+
+
+def quaternion_matrix(x, y, z):
+    w = np.sqrt(max(0.0, 1.0 - x * x - y * y - z * z))
+    return np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                     [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                     [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+
+
+def stored_extents(sections):
+    """ (min, max) of every stored primitive, by (type, index), from the file's records """
+    extents = dict()
+    data = sections[b"SPHR"]
+    for i in range(len(data) // 16):
+        x, y, z, r = struct.unpack_from("3ff", data, 16 * i)
+        extents[(io_export_phy.PHY_SPHERE, i)] = (np.array([x, y, z]) - r, np.array([x, y, z]) + r)
+    data = sections[b"CAPS"]
+    for i in range(len(data) // 32):
+        x, y, z, r, height, qx, qy, qz = struct.unpack_from("3fff3f", data, 32 * i)
+        offset = np.dot(quaternion_matrix(qx, qy, qz), [0.0, height / 2.0, 0.0])
+        caps = np.array([[x, y, z] + offset, [x, y, z] - offset])
+        extents[(io_export_phy.PHY_CAPSULE, i)] = (caps.min(axis=0) - r, caps.max(axis=0) + r)
+    data = sections[b"BOXS"]
+    for i in range(len(data) // 36):
+        x, y, z, dx, dy, dz, qx, qy, qz = struct.unpack_from("3f3f3f", data, 36 * i)
+        half = np.array([[sx, sy, sz] for sx in (-1, 1) for sy in (-1, 1) for sz in (-1, 1)]) * [dx, dy, dz] * 0.5
+        corners = np.array([x, y, z]) + np.dot(half, quaternion_matrix(qx, qy, qz).T)
+        extents[(io_export_phy.PHY_BOX, i)] = (corners.min(axis=0), corners.max(axis=0))
+    return extents
+
+
+def test_bvh_leaves_contain_stored_primitives():
+    rng = np.random.RandomState(3)
+    phy = io_export_phy.Phy(Shell(), {'bvhThreshold': 4})
+    for i in range(12):
+        phy.spheres.append([Vector(rng.uniform(-20.0, 20.0, 3).tolist()), float(rng.uniform(0.2, 2.0))])
+        phy.capsules.append([Vector(rng.uniform(-20.0, 20.0, 3).tolist()), float(rng.uniform(0.2, 1.0)),
+                             float(rng.uniform(0.0, 3.0)), random_rotation(rng)])
+        phy.boxes.append([Vector(rng.uniform(-20.0, 20.0, 3).tolist()), Vector(rng.uniform(0.5, 4.0, 3).tolist()),
+                          random_rotation(rng)])
+
+    sections = section_codec.read_sections(io.BytesIO(phy.serialize()))
+    extents = stored_extents(sections)
+    nodes = sections[b"BVHN"]
+    refs = sections[b"BVHR"]
+    assert len(nodes) and len(refs)
+
+    seen = set()
+    for n in range(len(nodes) // 32):
+        node = struct.unpack_from("3f3fIHH", nodes, 32 * n)
+        bmin, bmax, first, count = np.array(node[:3]), np.array(node[3:6]), node[6], node[7]
+        for r in range(first, first + count):
+            primitive = struct.unpack_from("HH", refs, 4 * r)
+            pmin, pmax = extents[primitive]
+            assert (pmin >= bmin - EPSILON).all() and (pmax <= bmax + EPSILON).all(), primitive
+            seen.add(primitive)
+    assert seen == set(extents)
+
+
+def test_negative_w_rotations_are_stored_positive():
+    y_up = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, -1.0, 0.0]]) # (x, y, z) -> (x, z, -y)
+    rotation = Quaternion((-0.6, 0.48, -0.64, 0.0)) # as Matrix.to_quaternion can return for PCA axes
+    records = []
+    for rot in (rotation, -rotation):
+        phy = io_export_phy.Phy(Shell(), {})
+        phy.boxes.append([Vector((1.0, 2.0, 3.0)), Vector((1.0, 2.0, 4.0)), rot])
+        phy.capsules.append([Vector((1.0, 2.0, 3.0)), 0.5, 2.0, rot])
+        sections = section_codec.read_sections(io.BytesIO(phy.serialize()))
+        records.append((sections[b"BOXS"], sections[b"CAPS"]))
+    assert records[0] == records[1]
+
+    expected = np.dot(np.dot(y_up, np.array(rotation.to_matrix())), y_up.T)
+    boxes, capsules = records[0]
+    for quaternion in (struct.unpack_from("3f", boxes, 24), struct.unpack_from("3f", capsules, 20)):
+        assert np.abs(quaternion_matrix(*quaternion) - expected).max() < EPSILON
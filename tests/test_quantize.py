@@ -0,0 +1,41 @@
+import importlib
+import os
+import sys
+import numpy as np
+import pytest
+
+pytest.importorskip("bpy") # blender_sharelib needs Blender's modules
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+blender_sharelib = importlib.import_module(os.path.basename(ROOT) + ".blender_sharelib")
+
+
+def edge_values(rng, scale):
+    """ random values, the clamping edges, and values exactly halfway between two steps """
+    halves = (np.arange(-40, 40) + 0.5) / scale
+    return np.concatenate((rng.uniform(-1.5, 1.5, 5000), halves,
+                           [-2.0, -1.0, -1.0 + 1e-12, -0.0, 0.0, 1e-12, 1.0 - 1e-12, 1.0, 2.0]))
+
+
+def test_kernels_match_scalar_conversions():
+    rng = np.random.RandomState(41)
+    for kernel, scalar, scale in ((blender_sharelib.floats_to_ushort, blender_sharelib.float_to_ushort, 2**16-1),
+                                  (blender_sharelib.floats_to_short, blender_sharelib.float_to_short, 2**15-1),
+                                  (blender_sharelib.floats_to_ubyte, blender_sharelib.float_to_ubyte, 2**8-1)):
+        vals = edge_values(rng, scale)
+        expected = [scalar(float(v)) for v in vals]
+        assert kernel(vals).tolist() == expected
+        # float32 input, as read from blender with foreach_get
+        vals32 = vals.astype(np.float32)
+        assert kernel(vals32).tolist() == [scalar(float(v)) for v in vals32]
+
+
+def test_vector_kernels_match_scalar_conversions():
+    rng = np.random.RandomState(42)
+    uvs = rng.uniform(-0.2, 1.2, (500, 2))
+    normals = rng.uniform(-1.2, 1.2, (500, 3))
+    assert [tuple(v) for v in blender_sharelib.vec2s_to_uhvec2(uvs).tolist()] == \
+           [blender_sharelib.vec2_to_uhvec2(v) for v in uvs.tolist()]
+    assert [tuple(v) for v in blender_sharelib.vec3s_to_hvec3(normals).tolist()] == \
+           [blender_sharelib.vec3_to_hvec3(v) for v in normals.tolist()]
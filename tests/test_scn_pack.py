@@ -0,0 +1,89 @@
+import importlib
+import os
+import struct
+import sys
+import pytest
+
+pytest.importorskip("bpy") # the exporters only run inside Blender
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(ROOT))
+io_export_scn = importlib.import_module(os.path.basename(ROOT) + ".io_export_scn")
+
+
+def msh_blob(name):
+    """ a MSH header (as io_export_msh writes it) followed by the same geometry """
+    header = struct.pack("3sBHHHHHxx15sB", b"MDL", 8, 3, 3, 1, 3, 0, bytes(name, "UTF-8"), 0)
+    return header + bytes(range(64))
+
+
+def mdl_blob(name):
+    header = struct.pack("3sBIIIB15s", b"MDL", 7, 3, 1, 3, 0, bytes(name, "UTF-8"))
+    return header + bytes(range(64))
+
+
+def test_name_field_matches_header():
+    for name in ("Tree", "Rock.001"):
+        start, end = io_export_scn.SCN_PACK_NAME_FIELD[b"MSH"]
+        assert msh_blob(name).index(bytes(name, "UTF-8")) == start
+        start, end = io_export_scn.SCN_PACK_NAME_FIELD[b"MDL"]
+        assert mdl_blob(name).index(bytes(name, "UTF-8")) == start
+
+
+def test_identical_msh_under_different_names_is_shared():
+    pack = io_export_scn.ScnPack()
+    assert pack.add(b"MSH", msh_blob("Tree")) == pack.add(b"MSH", msh_blob("Shrub"))
+    assert len(pack) == 1
+
+
+def test_different_msh_is_not_shared():
+    pack = io_export_scn.ScnPack()
+    other = bytearray(msh_blob("Tree"))
+    other[40] ^= 1
+    pack.add(b"MSH", msh_blob("Tree"))
+    pack.add(b"MSH", bytes(other))
+    assert len(pack) == 2
+
+
+def test_identical_mdl_under_different_names_is_shared():
+    pack = io_export_scn.ScnPack()
+    assert pack.add(b"MDL", mdl_blob("Tree")) == pack.add(b"MDL", mdl_blob("Shrub"))
+    assert len(pack) == 1
+
+
+class MeshObject(object):
+    """ the parts of a mesh object the SCN packing reads, its mesh comes from extracted() """
+    type = "MESH"
+    vertex_groups = []
+
+    def __init__(self, name, mesh):
+        self.name = name
+        self.data = type("Mesh", (), {'name': mesh})()
+
+    def find_armature(self):
+        return None
+
+
+def extracted(obj, settings):
+    """ stands in for io_export_mdl.iter_extract_mdl_mesh, the part that needs bpy """
+    n = 6 + int(obj.data.name[1:])
+    verts = [((float(i % n), float(i // n), float(i % 3)), (0.0, 0.0, 1.0), (0, 255, 1.0, 0.0))
+             for i in range(n * n)]
+    faces = [((y * n + x, 0.0, 0.5), (y * n + x + 1, 1.0, 0.5), (y * n + x + n, 0.5, 1.0))
+             for y in range(n - 1) for x in range(n - 1)]
+    yield 0.5
+    return {'name': obj.data.name, 'nbones': 0, 'verts': verts, 'faces': faces,
+            'materials': [0] * len(faces), 'lodRatios': [0.5], 'compression': 'NONE', 'meshCodec': True}
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="meshes are only encoded in parallel on linux")
+def test_pooled_encoding_matches_serial(monkeypatch):
+    monkeypatch.setattr(io_export_scn.io_export_mdl, "iter_extract_mdl_mesh", extracted)
+    ents = [MeshObject("o%d" % i, "m%d" % (i % 4)) for i in range(7)]
+    packs = []
+    for workers in (1, 3):
+        settings = {'packData': True, 'meshFormat': 'MDL', 'sliceUvs': True, 'workers': workers}
+        pack, packids = io_export_scn.pack_scn_ents(ents, settings)
+        packs.append((pack.entries, packids))
+    assert packs[0] == packs[1]
+    assert len(packs[0][0]) == 4
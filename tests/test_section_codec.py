@@ -0,0 +1,71 @@
+import io
+import os
+import struct
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import section_codec
+
+
+def compressible(rng, size):
+    """ small numbers with runs, like quantized mesh data """
+    return np.repeat(rng.randint(0, 16, size // 4 + 1), 4)[:size].astype(np.uint8).tobytes()
+
+
+def test_round_trip_every_codec():
+    rng = np.random.RandomState(31)
+    for name, codec in sorted(section_codec.CODECS.items()):
+        for size in (0, 100, section_codec.COMPRESS_MIN_SIZE, section_codec.COMPRESS_BLOCK_SIZE * 3 + 5):
+            data = compressible(rng, size)
+            stored_codec, stored = section_codec.compress_section(codec, data)
+            if codec == section_codec.CODEC_NONE or size < section_codec.COMPRESS_MIN_SIZE:
+                assert (stored_codec, stored) == (section_codec.CODEC_NONE, data)
+            else:
+                assert stored_codec == codec and len(stored) < len(data)
+            for workers in (1, 3):
+                assert section_codec.decompress_section(stored_codec, stored, workers) == data
+
+
+def test_blocks_are_independent():
+    rng = np.random.RandomState(32)
+    data = compressible(rng, section_codec.COMPRESS_BLOCK_SIZE * 2 + 1000)
+    codec, stored = section_codec.compress_section(section_codec.CODEC_ZLIB, data)
+    blocks = section_codec.section_blocks(stored)
+    assert [size for offset, size_stored, size in blocks] == [section_codec.COMPRESS_BLOCK_SIZE] * 2 + [1000]
+    start = 0
+    for offset, size_stored, size in blocks:
+        block = section_codec.decompress_block(codec, stored[offset:offset + size_stored], size)
+        assert block == data[start:start + size]
+        start += size
+
+
+def test_incompressible_is_stored():
+    data = np.random.RandomState(33).randint(0, 256, 0x8000).astype(np.uint8).tobytes()
+    for codec in (section_codec.CODEC_ZLIB, section_codec.CODEC_LZMA):
+        assert section_codec.compress_section(codec, data) == (section_codec.CODEC_NONE, data)
+
+
+def test_read_sections():
+    """ a file laid out with a section directory, as blender_sharelib.SectionWriter writes it """
+    rng = np.random.RandomState(34)
+    plain = {b"AAAA": compressible(rng, 0x3000), b"BBBB": b"short", b"CCCC": compressible(rng, 0x5000)}
+    stored = {b"AAAA": section_codec.compress_section(section_codec.CODEC_ZLIB, plain[b"AAAA"]),
+              b"BBBB": section_codec.compress_section(section_codec.CODEC_LZMA, plain[b"BBBB"]),
+              b"CCCC": section_codec.compress_section(section_codec.CODEC_LZMA, plain[b"CCCC"])}
+    offset = 48 + 24 * len(stored)
+    entries, blobs = [], []
+    for tag in sorted(stored):
+        codec, data = stored[tag]
+        entries.append(struct.pack("4sIIIIHH", tag, offset, len(data), 1, len(plain[tag]), codec, 7))
+        blobs.append(data)
+        offset += len(data)
+    data = bytes(32) + struct.pack("4sI8x", b"SDIR", len(stored)) + b''.join(entries) + b''.join(blobs)
+
+    f = io.BytesIO(data)
+    directory = section_codec.read_section_directory(f)
+    assert sorted(directory) == sorted(plain)
+    assert directory[b"BBBB"][4:] == (section_codec.CODEC_NONE, 7)
+    assert section_codec.read_sections(f) == plain
+    decoded = section_codec.read_sections(f, lambda transform, data, stride, count: (transform, count, data))
+    assert decoded == dict((tag, (7, len(plain[tag]), plain[tag])) for tag in plain)
@@ -0,0 +1,182 @@
+import bpy
+import os
+import time
+
+from . import io_export_mdl
+from . import io_export_phy
+from . import io_export_pos
+from . import io_export_scn
+from . import manifest
+
+"""
+Live watch mode
+
+Exports the scene to a directory (scene.scn, plus name.mdl, name.phy and
+name.pos for every object they apply to), then keeps those files up to date
+while the scene is edited:
+
+    objects whose geometry changed get their MDL, PHY and POS files re-exported
+    collision children that changed or moved get their parent's PHY re-exported
+      (once per parent, and only the PHY)
+    objects that only moved get their SCN entity transforms rewritten in place
+    anything else (objects added, removed, renamed or reparented) rewrites the SCN
+
+Changes are collected from the objects' update tags by a scene_update_post
+handler, and flushed once no edit has come in for WATCH_DEBOUNCE seconds.
+Files are only written when their contents changed. With updateManifest set,
+the directory's asset manifest (see manifest.py) is rewritten after every
+flush that wrote or patched a file.
+
+The SCN is written without packed data, BVH or cells, so it only holds
+entities and nothing else goes stale when they move.
+"""
+
+WATCH_DEBOUNCE = 0.25 # seconds without edits before changes are exported
+WATCH_TICK = 0.1 # seconds between checks for changes to flush
+
+WATCH_SCN_SETTINGS = {'packData': False,
+                      'buildBvh': False,
+                      'streamCells': False,
+                      'compression': 'NONE'}
+
+class Watch(object):
+    def __init__(self, scene, directory, settings):
+        self.scene = scene
+        self.directory = directory
+        self.settings = settings
+        self.geometry = set() # names of objects whose data changed
+        self.transform = set() # names of objects that moved
+        self.last_edit = 0.0
+        self.settling = set() # names of the objects the exporters tagged, their next update is not an edit
+        self.layout = None # (name, parent name) of every entity of the written SCN
+
+    def path(self, name, ext):
+        return os.path.join(self.directory, bpy.path.clean_name(name) + ext)
+
+    def write(self, path, data):
+        """ writes data unless the file already holds it, returns whether it was written """
+        if os.path.exists(path) and os.path.getsize(path) == len(data):
+            with open(path, 'rb') as f:
+                if f.read() == data:
+                    return False
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
+    def update_manifest(self):
+        if self.settings.get('updateManifest'):
+            manifest.write_manifest(self.directory)
+
+    def export_object(self, obj):
+        """ writes the MDL, PHY and POS files of an object, returns the number written """
+        written = 0
+        try:
+            if obj.type == 'MESH':
+                self.settling.add(obj.name) # the mesh is updated to read its faces
+                written += self.write(self.path(obj.name, ".mdl"), io_export_mdl.write_mdl_mesh(obj, self.settings))
+                arm = obj.find_armature()
+                if self.settings.get('exportPoses') and arm and arm.pose_library:
+                    self.settling.add(arm.name) # posed frame by frame
+                    written += self.write(self.path(obj.name, ".pos"), io_export_pos.write_pos_pose(obj, self.settings))
+        except Exception as e: # keep watching the other objects
+            print("watch: " + obj.name + " not exported: " + str(e))
+        if self.settings.get('exportPhysics'):
+            written += self.export_physics(obj)
+        return written
+
+    def export_physics(self, obj):
+        """ writes the PHY file of an object, returns the number written """
+        try:
+            return self.write(self.path(obj.name, ".phy"), io_export_phy.write_phy_object(obj, self.settings))
+        except Exception as e:
+            print("watch: " + obj.name + " physics not exported: " + str(e))
+            return 0
+
+    def export_scene(self):
+        ents = io_export_scn.get_scn_ent_list(self.scene)
+        self.layout = [(obj.name, obj.parent.name if obj.parent else None) for obj in ents]
+        return self.write(os.path.join(self.directory, "scene.scn"),
+                          io_export_scn.write_scn_scene(self.scene, WATCH_SCN_SETTINGS))
+
+    def export_all(self):
+        start = time.perf_counter()
+        written = sum(self.export_object(obj) for obj in self.scene.objects)
+        written += self.export_scene()
+        self.update_manifest()
+        print("watch: exported %d files to %s in %.2f ms" %
+              (written, self.directory, (time.perf_counter() - start) * 1000.0))
+
+    def changed(self, scene):
+        """ records the objects tagged as updated, called after every scene update """
+        if scene != self.scene or not bpy.data.objects.is_updated:
+            return
+        settled = self.settling
+        self.settling = set()
+        for obj in scene.objects:
+            if obj.name in settled:
+                continue
+            if obj.is_updated_data or (obj.data and obj.data.is_updated):
+                self.geometry.add(obj.name)
+            elif obj.is_updated:
+                self.transform.add(obj.name)
+        self.last_edit = time.perf_counter()
+
+    def flush(self):
+        """ exports what changed once edits have settled """
+        if not (self.geometry or self.transform) or time.perf_counter() - self.last_edit < WATCH_DEBOUNCE:
+            return
+        start = time.perf_counter()
+        objects = self.scene.objects
+        geometry = [objects[name] for name in self.geometry if name in objects]
+        moved = [objects[name] for name in self.geometry | self.transform if name in objects]
+        self.geometry = set()
+        self.transform = set()
+
+        written = 0
+        for obj in geometry:
+            written += self.export_object(obj)
+        if self.settings.get('exportPhysics'):
+            # collision children are part of their parent's PHY, whether they were edited or moved
+            parents = set(obj.parent.name for obj in moved if obj.parent and io_export_phy.is_collision_child(obj))
+            for name in parents - set(obj.name for obj in geometry):
+                if name in objects:
+                    written += self.export_physics(objects[name])
+
+        patched = 0
+        ents = io_export_scn.get_scn_ent_list(self.scene)
+        layout = [(obj.name, obj.parent.name if obj.parent else None) for obj in ents]
+        path = os.path.join(self.directory, "scene.scn")
+        if layout == self.layout and os.path.exists(path) and not io_export_scn.update_scn_transforms(path, moved):
+            patched = len(moved)
+        else:
+            written += self.export_scene()
+        if written or patched:
+            self.update_manifest()
+        print("watch: %d files written, %d entities patched in %.2f ms" %
+              (written, patched, (time.perf_counter() - start) * 1000.0))
+
+_watch = None
+
+def scene_update(scene):
+    if _watch:
+        _watch.changed(scene)
+
+def is_watching():
+    return _watch is not None
+
+def start(context, directory, settings):
+    global _watch
+    stop()
+    _watch = Watch(context.scene, bpy.path.abspath(directory), settings)
+    _watch.export_all()
+    bpy.app.handlers.scene_update_post.append(scene_update)
+
+def flush(context):
+    if _watch:
+        _watch.flush()
+
+def stop():
+    global _watch
+    if scene_update in bpy.app.handlers.scene_update_post:
+        bpy.app.handlers.scene_update_post.remove(scene_update)
+    _watch = None